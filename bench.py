@@ -0,0 +1,1020 @@
+# 华邻易市 · 离线压测
+# hualin0.3.py 在 import 时就建好了 supabase / model / bot 三个客户端，直接压测会烧真实配额。
+# 这里在 import 之前换上本地替身：
+#   - Bot API：子进程里起一个兼容的 HTTP 服务（含 /file 下载），telebot 通过 apihelper.API_URL 指过去
+#   - Supabase：注入一个内存版的 supabase 模块，支持代码里用到的查询链、RPC 和 Storage
+#   - Gemini：注入一个假的 google.generativeai，按提示词类型返回文案 / JSON / 地址，支持流式
+# 三者都能配置延迟和错误注入。然后按设定的并发驱动识图、/search、广播匹配和按钮回调几条路径，
+# 输出吞吐、p50/p95/p99 和峰值 RSS，可存成 JSON 基线，下次对比找回归。
+#
+# 用法：
+#   python bench.py                                   # 默认参数跑一遍
+#   python bench.py --concurrency 16 --photo-ops 80
+#   python bench.py --save-baseline bench_baseline.json
+#   python bench.py --compare bench_baseline.json     # 有回归时退出码为 1
+import argparse
+import collections
+import importlib.util
+import io
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types as pytypes
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hualin0.3.py")
+FAKE_TOKEN = "123456:BENCH"
+VOCAB = ["自行车", "台灯", "显示器", "iPhone", "书桌", "电饭煲", "沙发", "吉他", "相机", "跑步机",
+         "显卡", "婴儿车", "冰箱", "键盘", "耳机", "咖啡机", "行李箱", "微波炉", "空气炸锅", "滑板"]
+PLACES = ["南门", "学5楼", "东区", "图书馆", "北门地铁站", "西区食堂"]
+
+
+# ============================================================
+# 假 Bot API（在子进程里跑，避免压测进程 fork 图片进程池时身上带着服务线程）
+# ============================================================
+def _make_base_image(width=1600, height=1200):
+    from PIL import Image
+    small = Image.new("RGB", (width // 8, height // 8))
+    rng = random.Random(7)
+    small.putdata([((x * 255) // small.width, (y * 255) // small.height, rng.randrange(256))
+                   for y in range(small.height) for x in range(small.width)])
+    return small.resize((width, height))
+
+
+def _render_jpeg(base, key):
+    """每个 file_path 一张不同的图，否则按 JPEG 哈希的识图缓存会全部命中"""
+    from PIL import ImageDraw
+    img = base.copy()
+    seed = sum(key.encode())
+    ImageDraw.Draw(img).rectangle([seed % 1400, seed % 1000, seed % 1400 + 200, seed % 1000 + 200],
+                                  fill=(seed % 256, (seed * 7) % 256, (seed * 13) % 256))
+    ImageDraw.Draw(img).text((20, 20), key, fill=(255, 255, 255))
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def serve_bot_api(port, latency_ms, error_rate, seed):
+    base = _make_base_image()
+    # getFile 报的 file_size 必须和下载到的字节数一致（bot 会核对）。getFile 和下载前后脚到，
+    # 缓存最近渲染的几百张就够，重新渲染出来的字节也一样
+    rendered = collections.OrderedDict()
+    rendered_lock = threading.Lock()
+
+    def file_body(file_path):
+        with rendered_lock:
+            body = rendered.get(file_path)
+        if body is None:
+            body = _render_jpeg(base, f"/file/bot{FAKE_TOKEN}/{file_path}")
+            with rendered_lock:
+                rendered[file_path] = body
+                while len(rendered) > 256:
+                    rendered.popitem(last=False)
+        return body
+
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+    message_ids = itertools.count(1000)
+
+    def message_result(params):
+        chat_id = int(params.get("chat_id", "0") or 0)
+        return {"message_id": next(message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self):
+            url = urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            if url.path.startswith("/file/"):
+                self._send(200, file_body(url.path.split("/", 3)[3]), "image/jpeg")
+                return
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            if raw and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+                params.update({k: v[-1] for k, v in parse_qs(raw.decode()).items()})
+            method = url.path.rsplit("/", 1)[-1]
+
+            with rng_lock:
+                delay = latency_ms * rng.uniform(0.5, 1.5) / 1000
+                roll = rng.random()
+            time.sleep(delay)
+            if roll < error_rate / 2:
+                body = {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                        "parameters": {"retry_after": 1}}
+                self._send(429, json.dumps(body).encode())
+                return
+            if roll < error_rate:
+                self._send(500, json.dumps({"ok": False, "error_code": 500, "description": "Internal"}).encode())
+                return
+
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            elif method == "getFile":
+                file_id = params.get("file_id", "f")
+                file_path = f"photos/{file_id}.jpg"
+                result = {"file_id": file_id, "file_unique_id": file_id[-12:], "file_size": len(file_body(file_path)),
+                          "file_path": file_path}
+            elif method in ("sendMessage", "editMessageText", "sendPhoto", "forwardMessage",
+                            "editMessageReplyMarkup", "copyMessage"):
+                result = message_result(params)
+            else:
+                result = True
+            self._send(200, json.dumps({"ok": True, "result": result}).encode())
+
+        do_GET = _handle
+        do_POST = _handle
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_bot_api(latency_ms, error_rate, seed):
+    port = _free_port()
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve-bot-api", str(port),
+                             "--tg-ms", str(latency_ms), "--tg-error-rate", str(error_rate), "--seed", str(seed)])
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return proc, port
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("假 Bot API 没能启动")
+
+
+# ============================================================
+# 内存版 Supabase
+# ============================================================
+class FakeAPIError(Exception):
+    pass
+
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+PRIMARY_KEYS = {"items": "id", "profiles": "telegram_id", "subscriptions": "id", "credit_ledger": "id",
+                "vision_cache": "cache_key", "geocode_cache": "cell"}
+# 嵌入查询用到的外键：(表, 被嵌入的表) -> (本表列, 对方列)
+FOREIGN_KEYS = {("items", "profiles"): ("telegram_id", "telegram_id")}
+
+
+def _now_iso():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def _parse_ts(value):
+    if isinstance(value, datetime):
+        return value
+    text = str(value).replace("Z", "+00:00")
+    text = re.sub(r"\.(\d+)", lambda m: "." + (m.group(1) + "000000")[:6], text, count=1)
+    return datetime.fromisoformat(text)
+
+
+def _coerce(column, row_value, value):
+    """PostgREST 的过滤值都是字符串，按行里的类型转一下再比较"""
+    if value is None or row_value is None:
+        return row_value, value
+    if column.endswith("_at") or column.endswith("_expiry"):
+        return _parse_ts(row_value), _parse_ts(value)
+    if isinstance(row_value, bool):
+        return row_value, str(value).lower() in ("true", "1")
+    if isinstance(row_value, (int, float)):
+        try:
+            return float(row_value), float(value)
+        except (TypeError, ValueError):
+            return str(row_value), str(value)
+    return str(row_value), str(value)
+
+
+def _ilike(row_value, pattern):
+    if row_value is None:
+        return False
+    regex = "".join(".*" if ch == "%" else "." if ch == "_" else re.escape(ch) for ch in pattern)
+    return re.fullmatch(regex, str(row_value), re.IGNORECASE | re.DOTALL) is not None
+
+
+def _compare(op, column, row_value, value):
+    if op == "ilike":
+        return _ilike(row_value, value)
+    if op == "is":
+        return row_value is None if str(value) == "null" else row_value == value
+    a, b = _coerce(column, row_value, value)
+    if a is None or b is None:
+        return op == "eq" and a is b
+    return {"eq": a == b, "neq": a != b, "lt": a < b, "lte": a <= b, "gt": a > b, "gte": a >= b}[op]
+
+
+def _split_top(expr):
+    parts, depth, quoted, current = [], 0, False, []
+    for ch in expr:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0 and not quoted:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(ch)
+    if current:
+        parts.append("".join(current))
+    return parts
+
+
+def _parse_logic(expr):
+    """解析 or=(...) 里的表达式，支持嵌套 and()/or() 和 列.操作.值"""
+    expr = expr.strip()
+    for combinator, fn in (("and(", all), ("or(", any)):
+        if expr.startswith(combinator) and expr.endswith(")"):
+            preds = [_parse_logic(p) for p in _split_top(expr[len(combinator):-1])]
+            return lambda row, preds=preds, fn=fn: fn(p(row) for p in preds)
+    column, op, value = expr.split(".", 2)
+    if value.startswith('"') and value.endswith('"'):
+        value = value[1:-1]
+    return lambda row: _compare(op, column, row.get(column), value)
+
+
+class FakeQuery:
+    def __init__(self, backend, table):
+        self.backend = backend
+        self.table = table
+        self.op = "select"
+        self.columns = "*"
+        self.filters = []
+        self.orders = []
+        self.offset = 0
+        self.limit_n = None
+        self.payload = None
+        self.single_row = False
+
+    # --- 操作 ---
+    def select(self, columns="*", count=None):
+        self.columns = columns
+        return self
+
+    def insert(self, payload, **kwargs):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, **kwargs):
+        self.op, self.payload = "upsert", payload
+        return self
+
+    def update(self, payload, **kwargs):
+        self.op, self.payload = "update", payload
+        return self
+
+    def delete(self, **kwargs):
+        self.op = "delete"
+        return self
+
+    # --- 过滤 ---
+    def _filter(self, op, column, value):
+        self.filters.append(lambda row: _compare(op, column, row.get(column), value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter("eq", column, value)
+
+    def neq(self, column, value):
+        return self._filter("neq", column, value)
+
+    def lt(self, column, value):
+        return self._filter("lt", column, value)
+
+    def lte(self, column, value):
+        return self._filter("lte", column, value)
+
+    def gt(self, column, value):
+        return self._filter("gt", column, value)
+
+    def gte(self, column, value):
+        return self._filter("gte", column, value)
+
+    def ilike(self, column, pattern):
+        return self._filter("ilike", column, pattern)
+
+    def is_(self, column, value):
+        return self._filter("is", column, value)
+
+    def in_(self, column, values):
+        values = list(values)
+        self.filters.append(lambda row: any(_compare("eq", column, row.get(column), v) for v in values))
+        return self
+
+    def or_(self, expr):
+        self.filters.append(_parse_logic(f"or({expr})"))
+        return self
+
+    @property
+    def not_(self):
+        query = self
+
+        class _Not:
+            def is_(self, column, value):
+                query.filters.append(lambda row: not _compare("is", column, row.get(column), value))
+                return query
+        return _Not()
+
+    # --- 排序/分页 ---
+    def order(self, column, desc=False, **kwargs):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def range(self, start, end):
+        self.offset, self.limit_n = start, end - start + 1
+        return self
+
+    def single(self):
+        self.single_row = True
+        return self
+
+    maybe_single = single
+
+    # --- 执行 ---
+    def _project(self, row):
+        columns = [c.strip() for c in _split_top(self.columns)]
+        out = {}
+        for col in columns:
+            if col == "*":
+                out.update(row)
+            elif "(" in col:
+                alias, _, rest = col.partition(":")
+                if not rest:
+                    alias, rest = col.split("(")[0], col
+                other, inner = rest.split("(", 1)
+                local, remote = FOREIGN_KEYS[(self.table, other)]
+                match = next((r for r in self.backend.tables[other] if r.get(remote) == row.get(local)), None)
+                inner_cols = [c.strip() for c in inner[:-1].split(",")]
+                out[alias] = ({c: match.get(c) for c in inner_cols} if "*" not in inner_cols else dict(match)) if match else None
+            else:
+                out[col] = row.get(col)
+        return out
+
+    def _matching(self):
+        return [r for r in self.backend.tables[self.table] if all(f(r) for f in self.filters)]
+
+    def execute(self):
+        self.backend.simulate("table", self.table, self.op)
+        with self.backend.lock:
+            rows = self._run()
+        if self.single_row:
+            if len(rows) != 1:
+                raise FakeAPIError(f"single() 期望 1 行，实际 {len(rows)} 行")
+            return FakeResponse(rows[0])
+        return FakeResponse(rows)
+
+    def _run(self):
+        table = self.backend.tables[self.table]
+        pk = PRIMARY_KEYS.get(self.table, "id")
+        if self.op in ("insert", "upsert"):
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            out = []
+            for row in payload:
+                row = dict(row)
+                existing = None
+                if self.op == "upsert" and row.get(pk) is not None:
+                    existing = next((r for r in table if r.get(pk) == row[pk]), None)
+                if existing is not None:
+                    existing.update(row)
+                    out.append(dict(existing))
+                    continue
+                if row.get(pk) is None:
+                    row[pk] = next(self.backend.sequences[self.table])
+                row.setdefault("created_at", _now_iso())
+                table.append(row)
+                out.append(dict(row))
+            return out
+        if self.op == "update":
+            out = []
+            for row in self._matching():
+                row.update(self.payload)
+                out.append(dict(row))
+            return out
+        if self.op == "delete":
+            doomed = self._matching()
+            ids = {id(r) for r in doomed}
+            table[:] = [r for r in table if id(r) not in ids]
+            return [dict(r) for r in doomed]
+
+        rows = self._matching()
+        for column, desc in reversed(self.orders):
+            rows.sort(key=lambda r: (r.get(column) is None, _coerce(column, r.get(column), r.get(column))[0]
+                                     if r.get(column) is not None else 0), reverse=desc)
+        rows = rows[self.offset:]
+        if self.limit_n is not None:
+            rows = rows[:self.limit_n]
+        return [self._project(r) for r in rows]
+
+
+class FakeRPC:
+    def __init__(self, backend, name, params):
+        self.backend, self.name, self.params = backend, name, params or {}
+
+    def execute(self):
+        self.backend.simulate("rpc", self.name, "rpc")
+        handler = getattr(self.backend, "rpc_" + self.name, None)
+        if handler is None:
+            raise FakeAPIError(f"未知 RPC: {self.name}")
+        with self.backend.lock:
+            return FakeResponse(handler(**self.params))
+
+
+class FakeBucket:
+    def __init__(self, backend, bucket):
+        self.backend, self.bucket = backend, bucket
+
+    def upload(self, path, file, file_options=None):
+        self.backend.simulate("storage", self.bucket, "upload")
+        with self.backend.lock:
+            self.backend.objects[(self.bucket, path)] = len(file)
+        return {"Key": f"{self.bucket}/{path}"}
+
+    def get_public_url(self, path):
+        return f"{self.backend.url}/storage/v1/object/public/{self.bucket}/{path}"
+
+
+class FakeStorage:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def from_(self, bucket):
+        return FakeBucket(self.backend, bucket)
+
+
+class FakeSupabase:
+    def __init__(self, url, latency_ms, error_rate, seed):
+        self.url = url
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.lock = threading.RLock()
+        self.tables = collections.defaultdict(list)
+        self.sequences = collections.defaultdict(lambda: itertools.count(1))
+        self.objects = {}
+        self.calls = collections.Counter()
+        self.storage = FakeStorage(self)
+
+    def simulate(self, kind, name, op):
+        with self.rng_lock:
+            delay = self.latency_ms * self.rng.uniform(0.5, 1.5) / 1000
+            failed = self.rng.random() < self.error_rate
+            self.calls[f"{kind}:{name}:{op}"] += 1
+        time.sleep(delay)
+        if failed:
+            raise FakeAPIError(f"注入的 Supabase 错误 ({kind} {name} {op})")
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    from_ = table
+
+    def rpc(self, name, params=None):
+        return FakeRPC(self, name, params)
+
+    # --- RPC，对照 supabase_schema.sql ---
+    def _profile(self, user_id):
+        return next((p for p in self.tables["profiles"] if p["telegram_id"] == int(user_id)), None)
+
+    def rpc_apply_ledger(self, p_user_id, p_credits=0, p_trust=0, p_reason=None, p_min_balance=0, p_sign_date=None):
+        profile = self._profile(p_user_id)
+        if profile is None:
+            return []
+        credits = profile.get("credits") or 0
+        if p_credits < 0 and credits + p_credits < p_min_balance:
+            return []
+        if p_sign_date is not None and profile.get("last_sign_date") == p_sign_date:
+            return []
+        profile["credits"] = credits + p_credits
+        profile["trust_score"] = (profile.get("trust_score") or 0) + p_trust
+        if p_sign_date is not None:
+            profile["last_sign_date"] = p_sign_date
+        self.tables["credit_ledger"].append({
+            "id": next(self.sequences["credit_ledger"]), "telegram_id": int(p_user_id),
+            "credits_delta": p_credits, "trust_delta": p_trust, "reason": p_reason, "created_at": _now_iso()})
+        return [dict(profile)]
+
+    def rpc_apply_ledger_batch(self, p_entries):
+        out = []
+        for e in p_entries:
+            out += self.rpc_apply_ledger(e["user_id"], e.get("credits", 0), e.get("trust", 0), e.get("reason"))
+        return out
+
+    def rpc_trim_vision_cache(self, p_max_rows):
+        rows = sorted(self.tables["vision_cache"], key=lambda r: r.get("last_hit_at") or "", reverse=True)
+        removed = len(rows) - p_max_rows
+        if removed > 0:
+            self.tables["vision_cache"][:] = rows[:p_max_rows]
+        return max(0, removed)
+
+    def rpc_touch_vision_cache(self, p_key):
+        for row in self.tables["vision_cache"]:
+            if row["cache_key"] == p_key:
+                row["hits"] = (row.get("hits") or 0) + 1
+                row["last_hit_at"] = _now_iso()
+        return None
+
+    def rpc_touch_geocode_cache(self, p_cell):
+        for row in self.tables["geocode_cache"]:
+            if row["cell"] == p_cell:
+                row["hits"] = (row.get("hits") or 0) + 1
+                row["last_hit_at"] = _now_iso()
+        return None
+
+    def rpc_my_items_dashboard(self, p_user_id, p_cursor_ts=None, p_cursor_id=None, p_backward=False, p_limit=10):
+        mine = [r for r in self.tables["items"] if r.get("telegram_id") == int(p_user_id)]
+        counts = collections.Counter(r.get("status") for r in mine)
+        key = lambda r: (_parse_ts(r["created_at"]), r["id"])
+        mine.sort(key=key, reverse=True)
+        if p_cursor_ts is not None:
+            cursor = (_parse_ts(p_cursor_ts), int(p_cursor_id))
+            if p_backward:
+                mine = [r for r in mine if key(r) > cursor][-(p_limit + 1):]
+            else:
+                mine = [r for r in mine if key(r) < cursor][:p_limit + 1]
+        else:
+            mine = mine[:p_limit + 1]
+        profile = self._profile(p_user_id) or {}
+        return {"trust_score": profile.get("trust_score"), "counts": dict(counts),
+                "items": [{k: r.get(k) for k in ("id", "name", "price", "status", "created_at")} for r in mine]}
+
+
+def make_fake_supabase_module(backend):
+    module = pytypes.ModuleType("supabase")
+
+    class ClientOptions:
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    module.Client = FakeSupabase
+    module.ClientOptions = ClientOptions
+    module.create_client = lambda url, key, options=None: backend
+    return module
+
+
+# ============================================================
+# 假 Gemini
+# ============================================================
+class FakeGemini:
+    def __init__(self, vision_ms, text_ms, ttfc_ms, error_rate, seed):
+        self.vision_ms, self.text_ms, self.ttfc_ms = vision_ms, text_ms, ttfc_ms
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+
+    def _roll(self, kind):
+        with self.lock:
+            self.calls[kind] += 1
+            return self.rng.uniform(0.7, 1.3), self.rng.random() < self.error_rate
+
+    @staticmethod
+    def _kind(contents):
+        text = contents if isinstance(contents, str) else " ".join(c for c in contents if isinstance(c, str))
+        if "坐标" in text:
+            return "geocode", text
+        if "搜索助手" in text:
+            return "search", text
+        return "vision", text
+
+    def _answer(self, kind, text):
+        if kind == "geocode":
+            return "美国加州旧金山市场街"
+        if kind == "search":
+            m = re.search(r'用户输入："(.*?)"', text)
+            query = m.group(1) if m else ""
+            keyword = next((w for w in VOCAB if w.lower() in query.lower()), query[:4])
+            price = re.search(r"(\d+)", query)
+            return json.dumps({"keyword": keyword, "max_price": price.group(1) if price else None, "location": None},
+                              ensure_ascii=False)
+        name = random.choice(VOCAB)
+        return ("【文案部分】\n✨ 宝子们，出一个九成新的" + name + "！\n"
+                "成色很好，功能完好，搬家急出～\n诚心价，可小刀。#二手 #好物\n"
+                f"DATA:{name}|{random.randint(5, 500)}")
+
+    def generate_content(self, contents, stream=False, request_options=None, **kwargs):
+        from google.api_core import exceptions as google_exceptions
+        kind, text = self._kind(contents)
+        jitter, failed = self._roll(kind)
+        total = (self.vision_ms if kind == "vision" else self.text_ms) * jitter / 1000
+        answer = self._answer(kind, text)
+        if not stream:
+            time.sleep(total)
+            if failed:
+                raise google_exceptions.ServiceUnavailable("注入的 Gemini 错误")
+            return pytypes.SimpleNamespace(text=answer)
+
+        def chunks():
+            first = min(total, self.ttfc_ms * jitter / 1000)
+            time.sleep(first)
+            if failed:
+                raise google_exceptions.ServiceUnavailable("注入的 Gemini 错误")
+            pieces = [answer[i:i + 24] for i in range(0, len(answer), 24)]
+            step = (total - first) / max(1, len(pieces) - 1)
+            for i, piece in enumerate(pieces):
+                if i:
+                    time.sleep(step)
+                yield pytypes.SimpleNamespace(text=piece)
+        return chunks()
+
+
+def make_fake_genai_module(fake):
+    module = pytypes.ModuleType("google.generativeai")
+
+    class GenerativeModel:
+        def __init__(self, name, **kwargs):
+            self.model_name = name
+
+        def generate_content(self, contents, **kwargs):
+            return fake.generate_content(contents, **kwargs)
+
+        def start_chat(self, history=None):
+            return pytypes.SimpleNamespace(history=history or [])
+
+    module.configure = lambda **kwargs: None
+    module.GenerativeModel = GenerativeModel
+    return module
+
+
+# ============================================================
+# 装配：起假服务、注入假模块、加载 hualin0.3.py、灌测试数据
+# ============================================================
+class FakeEnvironment:
+    def __init__(self, args):
+        self.args = args
+        self.tmpdir = tempfile.mkdtemp(prefix="hualin-bench-")
+        self.bot_api_proc = None
+        self.supabase = None
+        self.gemini = None
+        self.app = None
+
+    def start(self):
+        args = self.args
+        self.bot_api_proc, port = start_fake_bot_api(args.tg_ms, args.tg_error_rate, args.seed)
+        base = f"http://127.0.0.1:{port}"
+
+        # hualin0.3.py 读取的配置，压测默认不让 Gemini 配额成为瓶颈、trace 写到临时目录
+        os.environ.update({"TELEGRAM_TOKEN": FAKE_TOKEN, "SUPABASE_URL": "http://supabase.bench",
+                           "SUPABASE_KEY": "bench", "GEMINI_API_KEY": "bench",
+                           "TELEGRAM_FILE_URL": base + "/file/bot{0}/{1}"})
+        os.environ.setdefault("GEMINI_RPM", "100000")
+        os.environ.setdefault("TRACE_FILE", os.path.join(self.tmpdir, "traces.jsonl"))
+
+        from telebot import apihelper
+        apihelper.API_URL = base + "/bot{0}/{1}"
+
+        self.supabase = FakeSupabase("http://supabase.bench", args.supabase_ms, args.supabase_error_rate, args.seed)
+        self.gemini = FakeGemini(args.gemini_ms, args.gemini_text_ms, args.gemini_ttfc_ms,
+                                 args.gemini_error_rate, args.seed)
+        sys.modules["supabase"] = make_fake_supabase_module(self.supabase)
+        genai_module = make_fake_genai_module(self.gemini)
+        sys.modules["google.generativeai"] = genai_module
+        import google
+        google.generativeai = genai_module
+
+        spec = importlib.util.spec_from_file_location("hualin", APP_PATH)
+        app = importlib.util.module_from_spec(spec)
+        sys.modules["hualin"] = app
+        spec.loader.exec_module(app)
+        if not args.verbose:
+            # 业务代码里到处是 print，压测时静音，只看汇总
+            app.print = lambda *a, **k: None
+        # 和正式启动一样，先 fork 图片进程池
+        app.warm_image_pool()
+        self.app = app
+        return app
+
+    def seed(self, user_ids, items, subscriptions):
+        rng = random.Random(self.args.seed)
+        db = self.supabase
+        # 灌数据和预热索引时不注入错误，只有正式场景才注入
+        error_rate, db.error_rate = db.error_rate, 0.0
+        now = datetime.now(timezone.utc)
+        with db.lock:
+            for uid in user_ids:
+                db.tables["profiles"].append({
+                    "telegram_id": uid, "username": f"bench{uid}", "credits": 1_000_000,
+                    "trust_score": round(rng.uniform(0, 300), 1), "subscription_expiry": None,
+                    "last_sign_date": None, "created_at": _now_iso()})
+            for _ in range(items):
+                word = rng.choice(VOCAB)
+                created = now - timedelta(minutes=rng.randint(0, 60 * 24 * 60))
+                db.tables["items"].append({
+                    "id": next(db.sequences["items"]), "name": f"{word} {rng.choice(['九成新', '全新', '自用'])}",
+                    "description": f"{word}，成色很好，{rng.choice(PLACES)}自提，价格可小刀。" * 3,
+                    "price": float(rng.randint(5, 800)), "status": rng.choice(["active"] * 8 + ["sold", "draft"]),
+                    "telegram_id": rng.choice(user_ids), "username": "bench",
+                    "location_text": rng.choice(PLACES), "image_url": "http://img/x.jpg",
+                    "created_at": created.strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")})
+            for _ in range(subscriptions):
+                db.tables["subscriptions"].append({
+                    "id": next(db.sequences["subscriptions"]), "telegram_id": rng.choice(user_ids),
+                    "keyword": rng.choice(VOCAB)})
+        self.app.load_item_index()
+        self.app.ensure_subscriptions_loaded()
+        db.error_rate = error_rate
+
+    def stop(self):
+        if self.bot_api_proc:
+            self.bot_api_proc.terminate()
+            self.bot_api_proc.wait(timeout=5)
+        app = self.app
+        if app is not None and getattr(app, "_image_pool", None) is not None:
+            app._image_pool.shutdown(wait=True)
+
+
+# ============================================================
+# 构造 telebot 的更新对象
+# ============================================================
+_message_ids = itertools.count(1)
+_photo_ids = itertools.count(1)
+
+
+def user_dict(uid):
+    return {"id": uid, "is_bot": False, "first_name": "bench", "username": f"bench{uid}"}
+
+
+def message_dict(uid, **fields):
+    return {"message_id": next(_message_ids), "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"}, "from": user_dict(uid), **fields}
+
+
+def photo_sizes(unique):
+    return [{"file_id": f"file-{unique}-{w}", "file_unique_id": f"u{unique}-{w}", "width": w, "height": w * 3 // 4,
+             "file_size": w * w // 8} for w in (320, 800, 1280)]
+
+
+def bench_user_ids(n):
+    return [10_000 + i for i in range(1, n + 1)]
+
+
+def make_message(data):
+    from telebot import types
+    return types.Message.de_json(json.dumps(data))
+
+
+def make_callback(uid, data):
+    from telebot import types
+    return types.CallbackQuery.de_json(json.dumps({
+        "id": str(next(_message_ids)), "from": user_dict(uid), "chat_instance": "bench", "data": data,
+        "message": message_dict(uid, text="预览")}))
+
+
+# ============================================================
+# 压测场景
+# ============================================================
+class Workloads:
+    def __init__(self, env, args):
+        self.env = env
+        self.app = env.app
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.rng_lock = threading.Lock()
+        self.users = bench_user_ids(args.users)
+        self.seen_photos = []
+
+    def _pick(self, seq):
+        with self.rng_lock:
+            return self.rng.choice(seq)
+
+    def _roll(self):
+        with self.rng_lock:
+            return self.rng.random()
+
+    def active_item_ids(self):
+        return [r["id"] for r in self.env.supabase.tables["items"] if r.get("status") == "active"]
+
+    def photo(self):
+        uid = self._pick(self.users)
+        if self.seen_photos and self._roll() < self.args.vision_cache_hit_rate:
+            unique = self._pick(self.seen_photos)
+        else:
+            unique = next(_photo_ids)
+            self.seen_photos.append(unique)
+        message = make_message(message_dict(uid, photo=photo_sizes(unique), caption="自用九成新"))
+        self.app.process_photo_task(message)
+
+    def search(self):
+        uid = self._pick(self.users)
+        word = self._pick(VOCAB)
+        query = self._pick([word, f"{word} 200以内", f"{self._pick(PLACES)}附近的{word}",
+                            f"想要一个便宜点的{word}，最好在{self._pick(PLACES)}"])
+        self.app.handle_smart_search(make_message(message_dict(uid, text=f"/search {query}")))
+
+    def notify(self):
+        item_id = self._pick(self.active_item_ids())
+        self.app.prepare_broadcast(item_id)
+
+    def callbacks(self):
+        uid = self._pick(self.users)
+        data = self._pick([f"view_{self._pick(self.active_item_ids())}", "my_items"])
+        self.app.callback_inline(make_callback(uid, data))
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux 上单位是 KB，macOS 是字节
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_workload(name, fn, ops, concurrency, warmup):
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one():
+        nonlocal errors
+        started = time.perf_counter()
+        ok = True
+        try:
+            fn()
+        except Exception as e:
+            ok = False
+            print(f"[{name}] 出错: {type(e).__name__}: {e}", file=sys.stderr)
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(ops):
+            pool.submit(one)
+    wall = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "ops": ops, "errors": errors, "concurrency": concurrency, "seconds": round(wall, 3),
+        "throughput": round(ops / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50), 1), "p95_ms": round(percentile(latencies, 0.95), 1),
+        "p99_ms": round(percentile(latencies, 0.99), 1), "max_ms": round(latencies[-1], 1) if latencies else 0.0,
+        "rss_mb": round(current_rss_mb() or 0, 1), "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """打印和基线的差异；p95 变慢或吞吐下降超过 tolerance 记为回归"""
+    regressions = []
+    print(f"\n与基线对比（容忍 {tolerance:.0%}）：")
+    print(f"{'场景':<10}{'吞吐':>22}{'p95':>26}")
+    for name, cur in results["workloads"].items():
+        base = baseline.get("workloads", {}).get(name)
+        if not base:
+            print(f"{name:<10}  （基线里没有）")
+            continue
+        d_tp = (cur["throughput"] - base["throughput"]) / base["throughput"] if base["throughput"] else 0.0
+        d_p95 = (cur["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+        flag = ""
+        if d_tp < -tolerance or d_p95 > tolerance:
+            flag = "  ⚠️ 回归"
+            regressions.append(name)
+        print(f"{name:<10}{base['throughput']:>9.1f} → {cur['throughput']:<7.1f}({d_tp:+.0%})"
+              f"{base['p95_ms']:>9.0f} → {cur['p95_ms']:<7.0f}ms ({d_p95:+.0%}){flag}")
+    return regressions
+
+
+def add_fake_arguments(p):
+    """替身服务和测试数据相关的参数，replay.py 也复用"""
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--items", type=int, default=5000)
+    p.add_argument("--subscriptions", type=int, default=2000)
+    p.add_argument("--vision-cache-hit-rate", type=float, default=0.0)
+    p.add_argument("--tg-ms", type=float, default=30, help="假 Bot API 平均延迟")
+    p.add_argument("--tg-error-rate", type=float, default=0.0)
+    p.add_argument("--supabase-ms", type=float, default=15, help="假 Supabase 平均延迟")
+    p.add_argument("--supabase-error-rate", type=float, default=0.0)
+    p.add_argument("--gemini-ms", type=float, default=1500, help="假 Gemini 识图总耗时")
+    p.add_argument("--gemini-text-ms", type=float, default=400, help="假 Gemini 文本调用耗时")
+    p.add_argument("--gemini-ttfc-ms", type=float, default=300, help="假 Gemini 流式首块耗时")
+    p.add_argument("--gemini-error-rate", type=float, default=0.0)
+    p.add_argument("--seed", type=int, default=42)
+    p.add_argument("--verbose", action="store_true", help="保留业务代码的 print 输出")
+    p.add_argument("--serve-bot-api", type=int, help=argparse.SUPPRESS)
+    return p
+
+
+def build_parser():
+    p = argparse.ArgumentParser(description="华邻易市离线压测（本地替身，不消耗真实配额）")
+    p.add_argument("--workloads", default="photo,search,notify,callbacks", help="逗号分隔的场景列表")
+    p.add_argument("--concurrency", type=int, default=8)
+    p.add_argument("--photo-ops", type=int, default=40)
+    p.add_argument("--search-ops", type=int, default=200)
+    p.add_argument("--notify-ops", type=int, default=200)
+    p.add_argument("--callback-ops", type=int, default=200)
+    p.add_argument("--warmup", type=int, default=3, help="每个场景正式计时前先跑几次")
+    add_fake_arguments(p)
+    p.add_argument("--out", help="把本次结果写到这个 JSON 文件")
+    p.add_argument("--save-baseline", help="把本次结果存为基线")
+    p.add_argument("--compare", help="和这个基线文件对比")
+    p.add_argument("--tolerance", type=float, default=0.15)
+    return p
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.serve_bot_api:
+        serve_bot_api(args.serve_bot_api, args.tg_ms, args.tg_error_rate, args.seed)
+        return
+
+    env = FakeEnvironment(args)
+    try:
+        env.start()
+        env.seed(bench_user_ids(args.users), args.items, args.subscriptions)
+        workloads = Workloads(env, args)
+        plan = {"photo": (workloads.photo, args.photo_ops), "search": (workloads.search, args.search_ops),
+                "notify": (workloads.notify, args.notify_ops), "callbacks": (workloads.callbacks, args.callback_ops)}
+        results = {"meta": {"time": datetime.now().isoformat(timespec="seconds"), "python": sys.version.split()[0],
+                            "args": {k: v for k, v in vars(args).items() if k != "serve_bot_api"}},
+                   "workloads": {}}
+        print(f"{'场景':<10}{'次数':>6}{'错误':>6}{'吞吐/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'RSS MB':>9}")
+        for name in [w.strip() for w in args.workloads.split(",") if w.strip()]:
+            if name not in plan:
+                print(f"未知场景: {name}", file=sys.stderr)
+                continue
+            fn, ops = plan[name]
+            r = run_workload(name, fn, ops, args.concurrency, args.warmup)
+            results["workloads"][name] = r
+            print(f"{name:<10}{r['ops']:>6}{r['errors']:>6}{r['throughput']:>9.1f}{r['p50_ms']:>9.0f}"
+                  f"{r['p95_ms']:>9.0f}{r['p99_ms']:>9.0f}{r['rss_mb']:>9.0f}")
+    finally:
+        env.stop()
+
+    results["rss"] = {"peak_main_mb": round(peak_rss_mb(), 1),
+                      "peak_children_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1)}
+    results["calls"] = {"gemini": dict(env.gemini.calls), "supabase": dict(env.supabase.calls.most_common(20))}
+    print(f"\n峰值 RSS：主进程 {results['rss']['peak_main_mb']} MB，"
+          f"子进程（图片进程池 / 假 Bot API）{results['rss']['peak_children_mb']} MB")
+    print(f"Gemini 调用：{results['calls']['gemini']}")
+
+    for path in filter(None, [args.out, args.save_baseline]):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已写入 {path}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,49 @@
 import requests
+import httpx
 import io
 import os
 import telebot
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from telebot.types import MenuButtonWebApp, WebAppInfo
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from supabase import create_client, Client
+from supabase import create_client, Client, ClientOptions
 import threading
-from flask import Flask
+from flask import Flask, jsonify, request as flask_request
 from telebot import TeleBot
 from telebot import types
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
 import re
-from datetime import date
+from datetime import date, datetime, timezone, timedelta
 import time
 import random
+import math
+import hashlib
+import hmac
+import atexit
+import signal
+import sys
+import unicodedata
+import uuid
+import queue
+import heapq
+import itertools
+import collections
+import bisect
+import contextvars
+import json
+import logging
+import logging.handlers
 #import Pillow
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import numpy as np
 
 ADMIN_ID = 7894972034  # 🌟 必须修改：你可以发消息给 @userinfobot 获取你的 ID
 
-# 创建一个专门处理 AI 识图任务的线程池
-executor = ThreadPoolExecutor(max_workers=10)
-
 # 字符清洗
 def escape_markdown(text):
     # Markdown (老版本) 只需要转义 * _ ` [
@@ -37,9 +58,169 @@ GOOGLE_API_KEY = os.getenv("GEMINI_API_KEY")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY") # 记得用 service_role key
+# 自建 Bot API 服务器或压测时可以改成别的地址，{0} 是 token，{1} 是 file_path
+TELEGRAM_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot{0}/{1}")
+
+
+# HTTP 连接池
+# Supabase（PostgREST + Storage）共用一个 httpx 连接池，Telegram Bot API 和图片下载走 requests 连接池，
+# 都开 keep-alive，池子大小按工作线程数配，避免每次请求都重新握手 TCP+TLS。
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(max(16, 4 * (os.cpu_count() or 2)))))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_KEEPALIVE_EXPIRY = 60.0
+
+
+class PoolMeter:
+    """记录一个连接池上的请求数、失败数和同时在途的请求数"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def begin(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def end(self, ok=True):
+        with self.lock:
+            self.in_flight -= 1
+            if not ok:
+                self.errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests, "errors": self.errors, "in_flight": self.in_flight,
+                    "max_in_flight": self.max_in_flight, "pool_size": HTTP_POOL_SIZE}
+
+
+class MeteredTransport(httpx.HTTPTransport):
+    def __init__(self, meter, **kwargs):
+        super().__init__(**kwargs)
+        self.meter = meter
+
+    def handle_request(self, request):
+        self.meter.begin()
+        ok = False
+        labels = supabase_metric_labels(request)
+        started = time.perf_counter()
+        try:
+            with trace_span("supabase", table=labels[0][1], op=labels[1][1]) as span:
+                response = super().handle_request(request)
+                if span is not None:
+                    span.set(status=response.status_code)
+            ok = response.status_code < 500
+            return response
+        finally:
+            self.meter.end(ok)
+            metrics.observe("hualin_supabase_request_seconds", labels, time.perf_counter() - started)
+            if not ok:
+                metrics.inc("hualin_supabase_errors_total", labels)
+
+
+_POSTGREST_OPS = {"GET": "select", "HEAD": "count", "POST": "insert", "PATCH": "update", "DELETE": "delete"}
+
+
+def supabase_metric_labels(request):
+    """/rest/v1/items -> (items, select)；/rest/v1/rpc/xxx -> (rpc:xxx, rpc)；/storage/v1/object/桶 -> (storage:桶, 方法)"""
+    parts = request.url.path.strip("/").split("/")
+    if len(parts) >= 3 and parts[0] == "rest":
+        if parts[2] == "rpc" and len(parts) >= 4:
+            return (("table", f"rpc:{parts[3]}"), ("op", "rpc"))
+        op = _POSTGREST_OPS.get(request.method, request.method.lower())
+        if op == "insert" and "resolution=merge" in request.headers.get("prefer", ""):
+            op = "upsert"
+        return (("table", parts[2]), ("op", op))
+    if len(parts) >= 4 and parts[0] == "storage":
+        return (("table", f"storage:{parts[3]}"), ("op", request.method.lower()))
+    return (("table", "other"), ("op", request.method.lower()))
 
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+supabase_pool_meter = PoolMeter()
+supabase_http = httpx.Client(
+    transport=MeteredTransport(
+        supabase_pool_meter,
+        http2=True,
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE,
+                            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+    ),
+    timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    follow_redirects=True,
+)
+
+
+def new_requests_session(pool_size=HTTP_POOL_SIZE):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+telegram_pool_meter = PoolMeter()
+telegram_session = new_requests_session()
+
+
+def _telegram_request(method, url, params=None, files=None, timeout=None, proxies=None):
+    """telebot 的 CUSTOM_REQUEST_SENDER：所有 Bot API 调用共用一个带连接池的 Session"""
+    telegram_pool_meter.begin()
+    ok = False
+    api_ok = False
+    started = time.perf_counter()
+    try:
+        with trace_span("telegram", method=url.rsplit("/", 1)[-1]):
+            response = telegram_session.request(method, url, params=params, files=files,
+                                                timeout=timeout or (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                                                proxies=proxies)
+        ok = response.status_code < 500
+        api_ok = response.status_code < 300
+        return response
+    finally:
+        telegram_pool_meter.end(ok)
+        labels = (("method", url.rsplit("/", 1)[-1]),)
+        metrics.observe("hualin_telegram_request_seconds", labels, time.perf_counter() - started)
+        if not api_ok:
+            metrics.inc("hualin_telegram_errors_total", labels)
+
+
+apihelper.CUSTOM_REQUEST_SENDER = _telegram_request
+
+
+def _httpx_pool_usage(client):
+    try:
+        connections = client._transport._pool.connections
+        idle = sum(1 for c in connections if c.is_idle())
+        return {"open": len(connections), "idle": idle, "busy": len(connections) - idle}
+    except Exception:
+        return {}
+
+
+def _requests_pool_usage(session):
+    # urllib3 的空闲队列预先塞满了 None 占位，只有非 None 的才是真正保持着的连接
+    usage = {"created": 0, "idle": 0}
+    try:
+        for adapter in set(session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                usage["created"] += pool.num_connections
+                usage["idle"] += sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0
+    except Exception:
+        return {}
+    return usage
+
+
+def http_pool_stats():
+    return {
+        "supabase": {**supabase_pool_meter.snapshot(), **_httpx_pool_usage(supabase_http)},
+        "telegram": {**telegram_pool_meter.snapshot(), **_requests_pool_usage(telegram_session)},
+    }
+
+
+supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY, options=ClientOptions(httpx_client=supabase_http))
 
 
 # 2. 初始化 Gemini (使用你列表里确切的名字)
@@ -58,6 +239,380 @@ app = Flask(__name__)
 def health_check():
     return "Bot is running!"
 
+# 各子系统的运行统计，统一挂在 /stats 下（JSON）
+STATS_PROVIDERS = {"http_pools": http_pool_stats}
+
+@app.route('/stats')
+def stats_endpoint():
+    result = {}
+    for name, provider in STATS_PROVIDERS.items():
+        try:
+            result[name] = provider()
+        except Exception as e:
+            result[name] = {"error": str(e)}
+    return jsonify(result)
+
+
+# Prometheus 指标
+# 埋点只写当前线程自己的累加器（不加锁），/metrics 抓取时再把各线程的数据合并；
+# 已经退出的线程的数据并进 retired，免得列表越积越长。仪表（队列长度之类）在抓取时现算。
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class MetricsRegistry:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []        # (线程, 该线程的累加器)
+        self.retired = {}       # 已退出线程合并后的累加器
+        self.meta = {}          # 指标名 -> (类型, 说明)
+        self.gauges = {}        # 指标名 -> 取值函数
+
+    def describe(self, name, kind, help_text):
+        self.meta[name] = (kind, help_text)
+
+    def gauge(self, name, help_text, fn):
+        self.describe(name, "gauge", help_text)
+        self.gauges[name] = fn
+
+    def _acc(self):
+        acc = getattr(self.local, "acc", None)
+        if acc is None:
+            acc = self.local.acc = {}
+            with self.lock:
+                self.shards.append((threading.current_thread(), acc))
+        return acc
+
+    def observe(self, name, labels, seconds):
+        acc = self._acc()
+        entry = acc.get((name, labels))
+        if entry is None:
+            entry = acc[(name, labels)] = [0, 0.0, [0] * (len(self.buckets) + 1)]
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def inc(self, name, labels, n=1):
+        acc = self._acc()
+        acc[(name, labels)] = acc.get((name, labels), 0) + n
+
+    @staticmethod
+    def _merge_into(target, source):
+        for key, value in list(source.items()):
+            if isinstance(value, list):
+                entry = target.get(key)
+                if entry is None:
+                    entry = target[key] = [0, 0.0, [0] * len(value[2])]
+                entry[0] += value[0]
+                entry[1] += value[1]
+                entry[2] = [a + b for a, b in zip(entry[2], value[2])]
+            else:
+                target[key] = target.get(key, 0) + value
+
+    def collect(self):
+        with self.lock:
+            alive = []
+            for thread, acc in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, acc))
+                else:
+                    self._merge_into(self.retired, acc)
+            self.shards = alive
+            merged = {}
+            self._merge_into(merged, self.retired)
+            for _, acc in alive:
+                self._merge_into(merged, acc)
+        return merged
+
+    @staticmethod
+    def _labels(labels, extra=None):
+        pairs = list(labels) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        merged = self.collect()
+        by_name = collections.defaultdict(list)
+        for (name, labels), value in merged.items():
+            by_name[name].append((labels, value))
+        lines = []
+        for name in sorted(set(by_name) | set(self.gauges)):
+            kind, help_text = self.meta.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self.gauges:
+                try:
+                    lines.append(f"{name} {float(self.gauges[name]())}")
+                except Exception as e:
+                    print(f"指标 {name} 取值失败: {e}")
+                continue
+            for labels, value in sorted(by_name[name], key=lambda x: x[0]):
+                if isinstance(value, list):
+                    count, total, buckets = value
+                    cumulative = 0
+                    for bound, n in zip(list(self.buckets) + ["+Inf"], buckets):
+                        cumulative += n
+                        lines.append(f"{name}_bucket{self._labels(labels, ('le', bound))} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+                else:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(METRIC_BUCKETS)
+metrics.describe("hualin_gemini_request_seconds", "histogram", "Gemini 调用耗时（含重试），按调用点和结果")
+metrics.describe("hualin_gemini_ttfc_seconds", "histogram", "Gemini 流式生成首块到达耗时")
+metrics.describe("hualin_gemini_events_total", "counter", "Gemini 调用事件计数（calls/ok/errors/retries/rejected）")
+metrics.describe("hualin_supabase_request_seconds", "histogram", "Supabase 请求耗时，按表和操作")
+metrics.describe("hualin_supabase_errors_total", "counter", "Supabase 请求失败数（5xx 或网络错误）")
+metrics.describe("hualin_telegram_request_seconds", "histogram", "Telegram Bot API 请求耗时，按方法")
+metrics.describe("hualin_telegram_errors_total", "counter", "Telegram Bot API 非 2xx 或网络错误数")
+metrics.describe("hualin_image_stage_seconds", "histogram", "图片流水线各阶段耗时")
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+# 链路追踪
+# 每条 Telegram 更新开一个 trace，当前 span 放在 contextvars 里；换线程（telebot 线程池、识图调度器）时
+# 用 traced_handoff 把上下文带过去，并把排队时间记成一个 .queue span。外部调用（Supabase、Telegram、Gemini、
+# 图片进程池）各包一个 span。一个 trace 的 span 全部结束后整条写进滚动的 JSONL 文件，用 trace_report.py 分析。
+TRACING = os.getenv("TRACING", "1") == "1"
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(20 * 1024 * 1024)))
+TRACE_BACKUPS = int(os.getenv("TRACE_BACKUPS", "3"))
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_MAX_OPEN = 2000        # 同时未结束的 trace 上限，超了丢掉最早的（防止漏结束的 span 攒着不放）
+# 交给别的线程后一直没开始执行（线程池卡死、任务被丢）的排队 span，超过这么久就按超时结束，trace 才能收尾
+TRACE_QUEUE_TIMEOUT = float(os.getenv("TRACE_QUEUE_TIMEOUT", "300"))
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("tracer", "trace_id", "span_id", "parent_id", "name", "start", "end", "attrs", "error")
+
+    def __init__(self, tracer, trace_id, parent_id, name, attrs):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.attrs = attrs
+        self.error = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, error=None):
+        if self.end is not None:
+            return
+        self.end = time.time()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"[:300]
+        self.tracer.on_finish(self)
+
+    def to_dict(self):
+        return {"span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "start": round(self.start, 6), "duration_ms": round((self.end - self.start) * 1000, 2),
+                "attrs": self.attrs, "error": self.error}
+
+
+class Tracer:
+    def __init__(self, path, max_bytes, backups):
+        self.lock = threading.Lock()
+        self.open = collections.OrderedDict()    # trace_id -> {"spans": [...], "open": 未结束 span 数}
+        self.logger = None
+        self.path, self.max_bytes, self.backups = path, max_bytes, backups
+        self.totals = {"traces": 0, "spans": 0, "dropped": 0, "queue_timeouts": 0}
+        self.watched = {}        # span_id -> (超时时间, span)，traced_handoff 的排队 span
+        self.next_sweep = 0.0
+
+    def _get_logger(self):
+        if self.logger is None:
+            handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                                           backupCount=self.backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("hualin.traces")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(handler)
+            self.logger = logger
+        return self.logger
+
+    def start_span(self, name, parent=None, trace_id=None, **attrs):
+        trace_id = trace_id or (parent.trace_id if parent else uuid.uuid4().hex)
+        span = Span(self, trace_id, parent.span_id if parent else None, name, attrs)
+        with self.lock:
+            entry = self.open.get(trace_id)
+            if entry is None:
+                entry = self.open[trace_id] = {"spans": [], "open": 0}
+                while len(self.open) > TRACE_MAX_OPEN:
+                    self.open.popitem(last=False)
+                    self.totals["dropped"] += 1
+            entry["open"] += 1
+        self._sweep()
+        return span
+
+    def watch(self, span, timeout):
+        with self.lock:
+            self.watched[span.span_id] = (time.monotonic() + timeout, span)
+
+    def _sweep(self):
+        # 顺着 start_span 最多每秒检查一次，不单独起线程
+        now = time.monotonic()
+        if now < self.next_sweep:
+            return
+        with self.lock:
+            self.next_sweep = now + 1.0
+            expired = [sp for deadline, sp in self.watched.values() if deadline <= now]
+            for sp in expired:
+                del self.watched[sp.span_id]
+            self.totals["queue_timeouts"] += len(expired)
+        for sp in expired:
+            sp.finish(TimeoutError("handed-off task never started"))
+
+    def on_finish(self, span):
+        with self.lock:
+            self.watched.pop(span.span_id, None)
+            entry = self.open.get(span.trace_id)
+            if entry is None:
+                return
+            entry["spans"].append(span.to_dict())
+            entry["open"] -= 1
+            if entry["open"] > 0:
+                return
+            del self.open[span.trace_id]
+            self.totals["traces"] += 1
+            self.totals["spans"] += len(entry["spans"])
+        self._export(span.trace_id, entry["spans"])
+
+    def _export(self, trace_id, spans):
+        root = next((sp for sp in spans if sp["parent_id"] is None), spans[-1])
+        end = max(sp["start"] + sp["duration_ms"] / 1000 for sp in spans)
+        record = {"trace_id": trace_id, "root": root["name"], "start": root["start"],
+                  "duration_ms": round((end - root["start"]) * 1000, 2), "spans": spans}
+        try:
+            self._get_logger().info(json.dumps(record, ensure_ascii=False, default=str))
+        except Exception as e:
+            print(f"写入 trace 失败: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"enabled": TRACING, "file": self.path, "open_traces": len(self.open), **self.totals}
+
+
+tracer = Tracer(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUPS)
+STATS_PROVIDERS["tracing"] = tracer.stats
+
+
+class trace_span:
+    """with trace_span("supabase", table="items"): ... —— 只在已有 trace 时记录，否则什么也不做"""
+    __slots__ = ("name", "attrs", "root", "span", "token")
+
+    def __init__(self, name, root=False, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.root = root
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is None and not (self.root and TRACING and random.random() < TRACE_SAMPLE_RATE):
+            return None
+        self.span = tracer.start_span(self.name, parent, **self.attrs)
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.span is not None:
+            _current_span.reset(self.token)
+            self.span.finish(exc)
+        return False
+
+
+def current_trace_id():
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+def _run_handed_off(name, fn, wait, args, kwargs):
+    with trace_span(name, task=getattr(fn, "__name__", str(fn))):
+        # 先开执行 span 再结束排队 span，trace 中途不会出现“全部结束”而被提前写出
+        wait.finish()
+        return fn(*args, **kwargs)
+
+
+def traced_handoff(fn, name):
+    """把 fn 交给别的线程执行前调用：带上当前 trace 上下文，并把交接到开始执行之间记成 name.queue"""
+    parent = _current_span.get()
+    if parent is None:
+        return fn
+    wait = tracer.start_span(name + ".queue", parent)
+    tracer.watch(wait, TRACE_QUEUE_TIMEOUT)
+    ctx = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return ctx.run(_run_handed_off, name, fn, wait, args, kwargs)
+    run.__name__ = getattr(fn, "__name__", name)
+    # 没能交出去（比如队列满了）时调用，结束排队 span，trace 才能正常收尾
+    run.cancel = lambda: wait.finish(RuntimeError("not scheduled"))
+    return run
+
+
+# 挂到 telebot 上：每条更新一个根 span；派给 telebot 线程池的处理函数、多步对话的下一步都沿用 trace
+_bot_process_new_updates = bot.process_new_updates
+_bot_exec_task = bot._exec_task
+_bot_register_next_step_handler = bot.register_next_step_handler
+
+
+def _traced_process_new_updates(updates):
+    for update in updates:
+        kind = next((k for k in ("message", "callback_query", "edited_message", "inline_query")
+                     if getattr(update, k, None) is not None), "other")
+        with trace_span(f"update.{kind}", root=True, update_id=update.update_id) as span:
+            if span is not None:
+                span.set(chat_id=update_chat_id(update))
+            _bot_process_new_updates([update])
+
+
+def _traced_exec_task(task, *args, **kwargs):
+    if not bot.threaded:
+        return _bot_exec_task(task, *args, **kwargs)
+    job = traced_handoff(task, "handler")
+    try:
+        return _bot_exec_task(job, *args, **kwargs)
+    except Exception:
+        getattr(job, "cancel", lambda: None)()
+        raise
+
+
+def _traced_register_next_step_handler(message, callback, *args, **kwargs):
+    # 下一步在用户回复时才执行，属于另一条更新的 trace；这里记下是哪个 trace 注册的，方便串起来看
+    registered_by = current_trace_id()
+
+    # functools.partial、可调用对象没有 __name__
+    callback_name = getattr(callback, "__name__", repr(callback))
+
+    def next_step(*a, **kw):
+        with trace_span(f"next_step.{callback_name}", registered_by=registered_by):
+            return callback(*a, **kw)
+    return _bot_register_next_step_handler(message, next_step, *args, **kwargs)
+
+
+bot.process_new_updates = _traced_process_new_updates
+bot._exec_task = _traced_exec_task
+bot.register_next_step_handler = _traced_register_next_step_handler
+
 def run_flask():
     # Hugging Face 默认使用 7860 端口
     app.run(host='0.0.0.0', port=7860)
@@ -75,12 +630,94 @@ try:
 except Exception as e:
     print(f"设置菜单按钮失败: {e}")
 
+# 通用的过期 + LRU 缓存
+class TTLCache:
+    """线程安全的 LRU 缓存，条目超过 ttl 秒自动失效，带命中/未命中计数"""
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = collections.OrderedDict()  # key -> (过期时间, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, key, fields):
+        """只在缓存里已有这条时原地合并字段，不续期"""
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and isinstance(entry[1], dict):
+                entry[1].update(fields)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size": len(self.data), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_rate": round(self.hits / total, 4) if total else 0.0}
+
+
+# 用户资料缓存：以 telegram_id 为键。写 subscription_expiry 走 update_profile，
+# credits / trust_score / last_sign_date 走账本 ledger_apply，两者写库后都会顺手更新缓存
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "5000"))
+profile_cache = TTLCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+STATS_PROVIDERS["profile_cache"] = profile_cache.stats
+
+
+def get_profile(telegram_id):
+    """读取用户资料（优先走缓存），不存在返回 None"""
+    telegram_id = int(telegram_id)
+    profile = profile_cache.get(telegram_id)
+    if profile is not None:
+        return profile
+    res = supabase.table("profiles").select("*").eq("telegram_id", telegram_id).execute()
+    if not res.data:
+        return None
+    profile_cache.set(telegram_id, res.data[0])
+    return res.data[0]
+
+
+def update_profile(telegram_id, fields):
+    """写 profiles 并同步缓存；库里返回了整行就用整行覆盖，否则只合并改动字段"""
+    telegram_id = int(telegram_id)
+    res = supabase.table("profiles").update(fields).eq("telegram_id", telegram_id).execute()
+    if res.data:
+        profile_cache.set(telegram_id, res.data[0])
+    else:
+        profile_cache.update(telegram_id, fields)
+    return res
+
+
 # 积分处理逻辑
 def get_or_create_profile(user):
     # 尝试获取用户信息
-    res = supabase.table("profiles").select("*").eq("telegram_id", user.id).execute()
+    profile = get_profile(user.id)
     
-    if not res.data:
+    if not profile:
         # 新用户，初始赠送 50 能量
         new_profile = {
             "telegram_id": user.id,
@@ -88,50 +725,362 @@ def get_or_create_profile(user):
             "credits": 50
         }
         res = supabase.table("profiles").insert(new_profile).execute()
+        profile_cache.set(user.id, res.data[0])
         return res.data[0]
-    return res.data[0]
+    return profile
 
 # 积分拦截与扣除
+# 能量 / 信用分统一走服务端 apply_ledger RPC（见 supabase_schema.sql）：
+# 条件扣减和写流水在一次调用里完成，多个识图线程同时扣费也不会丢更新。
+LEDGER_BATCH_INTERVAL = float(os.getenv("LEDGER_BATCH_INTERVAL", "5"))
+LEDGER_BATCH_MAX = int(os.getenv("LEDGER_BATCH_MAX", "100"))
+_pending_debits = {}          # telegram_id -> [待结算扣减总额, 次数, 原因]
+_ledger_lock = threading.Lock()
+_ledger_flush_event = threading.Event()
+_ledger_flusher_started = False
+# 批量结算被拒（预扣之后余额被别的扣费抢先用掉）的扣减：搜索结果已经给出去了，不能免单，
+# 改成单独结算、允许扣成负数。负数余额就是欠费标记，ledger_available < 1 期间搜索和识图都会被拦下，充值后自然补上
+LEDGER_DEBT_FLOOR = -10 ** 9
+ledger_totals = {"applied": 0, "rejected": 0, "batched_debits": 0, "batches": 0, "batch_rejected": 0,
+                 "debts_recorded": 0}
+
+
+def ledger_apply(telegram_id, credits=0, trust=0, reason=None, min_balance=0, sign_date=None):
+    """原子地调整能量/信用分并写一条流水，返回最新资料；余额不足或今天已签到时返回 None"""
+    telegram_id = int(telegram_id)
+    res = supabase.rpc("apply_ledger", {
+        "p_user_id": telegram_id,
+        "p_credits": credits,
+        "p_trust": trust,
+        "p_reason": reason,
+        "p_min_balance": min_balance,
+        "p_sign_date": sign_date,
+    }).execute()
+    with _ledger_lock:
+        ledger_totals["applied" if res.data else "rejected"] += 1
+    if not res.data:
+        return None
+    profile_cache.set(telegram_id, res.data[0])
+    if trust:
+        item_index.set_trust(telegram_id, res.data[0].get('trust_score'))
+    return res.data[0]
+
+
+def ledger_available(telegram_id):
+    """可用余额 = 库里余额 - 本地还没结算的批量扣减"""
+    profile = get_profile(telegram_id)
+    if not profile:
+        return 0
+    with _ledger_lock:
+        pending = _pending_debits.get(int(telegram_id), [0])[0]
+    return (profile.get('credits') or 0) - pending
+
+
+def ledger_debit_batched(telegram_id, amount, reason):
+    """高频小额扣费（如搜索）：本地先预扣，攒一批再用一次 RPC 结算。余额不足返回 False"""
+    telegram_id = int(telegram_id)
+    if ledger_available(telegram_id) < amount:
+        return False
+    _ensure_ledger_flusher()
+    with _ledger_lock:
+        entry = _pending_debits.setdefault(telegram_id, [0, 0, reason])
+        entry[0] += amount
+        entry[1] += 1
+        ledger_totals["batched_debits"] += 1
+        if len(_pending_debits) >= LEDGER_BATCH_MAX:
+            _ledger_flush_event.set()
+    return True
+
+
+def flush_ledger_batch():
+    global _pending_debits
+    with _ledger_lock:
+        if not _pending_debits:
+            return
+        batch, _pending_debits = _pending_debits, {}
+    entries = [
+        {"user_id": uid, "credits": -total, "reason": f"{reason} x{count}"}
+        for uid, (total, count, reason) in batch.items()
+    ]
+    try:
+        res = supabase.rpc("apply_ledger_batch", {"p_entries": entries}).execute()
+    except Exception as e:
+        print(f"批量结算失败，稍后重试: {e}")
+        with _ledger_lock:
+            for uid, (total, count, reason) in batch.items():
+                entry = _pending_debits.setdefault(uid, [0, 0, reason])
+                entry[0] += total
+                entry[1] += count
+        return
+    settled = set()
+    for row in res.data or []:
+        profile_cache.set(int(row['telegram_id']), row)
+        settled.add(int(row['telegram_id']))
+    with _ledger_lock:
+        ledger_totals["batches"] += 1
+        ledger_totals["batch_rejected"] += len(batch) - len(settled)
+    for uid in batch.keys() - settled:
+        total, count, reason = batch[uid]
+        try:
+            row = ledger_apply(uid, credits=-total, reason=f"{reason} x{count} (欠费)", min_balance=LEDGER_DEBT_FLOOR)
+        except Exception as e:
+            row = None
+            print(f"记录用户 {uid} 的欠费失败，稍后重试: {e}")
+        if row is None:
+            with _ledger_lock:
+                entry = _pending_debits.setdefault(uid, [0, 0, reason])
+                entry[0] += total
+                entry[1] += count
+            continue
+        with _ledger_lock:
+            ledger_totals["debts_recorded"] += 1
+        print(f"⚠️ 用户 {uid} 余额不足，{total} 能量记为欠费（当前余额 {row.get('credits')}）")
+
+
+def _ledger_flush_loop():
+    while True:
+        _ledger_flush_event.wait(LEDGER_BATCH_INTERVAL)
+        _ledger_flush_event.clear()
+        flush_ledger_batch()
+
+
+def _flush_ledger_on_exit():
+    # 进程退出时把还没结算的预扣落库，否则这批搜索就白送了
+    with _ledger_lock:
+        pending = len(_pending_debits)
+    if pending:
+        print(f"退出前结算 {pending} 个用户的预扣...")
+        flush_ledger_batch()
+
+
+atexit.register(_flush_ledger_on_exit)
+
+
+def _ensure_ledger_flusher():
+    global _ledger_flusher_started
+    if _ledger_flusher_started:
+        return
+    with _ledger_lock:
+        if _ledger_flusher_started:
+            return
+        threading.Thread(target=_ledger_flush_loop, daemon=True, name="ledger-flusher").start()
+        _ledger_flusher_started = True
+
+
+def ledger_stats():
+    with _ledger_lock:
+        return {"pending_users": len(_pending_debits), "totals": dict(ledger_totals)}
+
+STATS_PROVIDERS["ledger"] = ledger_stats
+
+# 图片处理流水线
+# 解码、缩放、JPEG 编码都是纯 CPU 活，放到进程池里跑，不再和各个 handler 线程抢 GIL。
+# JPEG 用 draft 模式直接按 1/2、1/4、1/8 缩小解码，省掉全尺寸解码；
+# 同一次编码的结果既拿去存储，也直接喂给 Gemini（1280px）。
+# 下载也在子进程里做：边下边写进预分配好的缓冲区，解码器直接读它，原图字节不再来回复制。
+IMAGE_MAX_WIDTH = 1280
+IMAGE_DOWNLOAD_CHUNK = 64 * 1024
+IMAGE_DOWNLOAD_TIMEOUT = (5, 30)
+IMAGE_JPEG_QUALITY = 75
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 2)))
+IMAGE_STAGES = ("download", "decode", "resize", "encode", "upload")
+_image_pool = None
+_image_pool_lock = threading.Lock()
+# 进程池坏掉后不再重建：此时进程里已经有一堆线程，再 fork 可能把别的线程持有的锁带进子进程死锁；
+# 换 forkserver/spawn 又得让子进程重新 import 整个脚本（会重新连 Telegram、Supabase）。
+# 所以之后的图片都在调用线程里处理，慢一些但结果一样，等下次重启再恢复进程池
+_image_pool_broken = False
+image_stage_totals = {stage: {"count": 0, "total_ms": 0.0, "max_ms": 0.0} for stage in IMAGE_STAGES}
+_image_stats_lock = threading.Lock()
+
+
+def select_photo_size(photos, target_width=IMAGE_MAX_WIDTH):
+    """Telegram 会给同一张图的多个尺寸，挑宽度刚好够 1280 的最小那张；都不够就用最大的"""
+    candidates = sorted(photos, key=lambda p: (p.width, p.height))
+    for photo in candidates:
+        if photo.width >= target_width:
+            return photo
+    return candidates[-1]
+
+
+_download_session = None
+_download_session_pid = None
+
+
+def _get_download_session():
+    # 在图片进程里运行：每个进程各自建一个 keep-alive 的 Session，不沿用 fork 前父进程的连接
+    global _download_session, _download_session_pid
+    if _download_session is None or _download_session_pid != os.getpid():
+        _download_session = new_requests_session(pool_size=2)
+        _download_session_pid = os.getpid()
+    return _download_session
+
+
+def _download_image(file_url, expected_size=None):
+    """流式下载到 BytesIO；已知大小时先把空间占好，收到的字节数和预期不符就报错"""
+    with _get_download_session().get(file_url, stream=True, timeout=IMAGE_DOWNLOAD_TIMEOUT) as response:
+        if response.status_code != 200:
+            raise IOError(f"下载原图失败: HTTP {response.status_code}")
+        # 带 Content-Encoding 时 Content-Length 是压缩后的长度，只能拿来核对原始字节
+        encoded = response.headers.get("Content-Encoding", "identity").lower() not in ("", "identity")
+        content_length = None if encoded else int(response.headers.get("Content-Length") or 0) or None
+        size = expected_size or content_length
+        buf = io.BytesIO()
+        if size:
+            # 先占位，后面的 write 从头覆盖，避免 BytesIO 边写边扩容
+            buf.seek(size - 1)
+            buf.write(b"\0")
+            buf.seek(0)
+        received = 0
+        # iter_content 会按 Content-Encoding 解压，不能用 raw.readinto 绕过去
+        for chunk in response.iter_content(IMAGE_DOWNLOAD_CHUNK):
+            buf.write(chunk)
+            received += len(chunk)
+    buf.truncate(received)
+    for label, want in (("file_size", expected_size), ("Content-Length", content_length)):
+        if want and received != want:
+            raise IOError(f"下载原图不完整: 收到 {received} 字节，{label} 为 {want}")
+    buf.seek(0)
+    return buf
+
+
+def _fetch_and_compress(file_url, expected_size=None):
+    """（子进程里执行）下载 + 解码 + 缩放 + 编码"""
+    t = time.perf_counter()
+    buf = _download_image(file_url, expected_size)
+    download_ms = (time.perf_counter() - t) * 1000
+    compressed, timings = _compress_image(buf)
+    timings["download"] = download_ms
+    return compressed, timings
+
+
+def _compress_image(fp):
+    """（子进程里执行）解码 + 缩放 + 编码，返回 (JPEG 字节, 各阶段耗时 ms)"""
+    timings = {}
+    t = time.perf_counter()
+    img = Image.open(fp)
+    if img.format == "JPEG" and img.width > IMAGE_MAX_WIDTH:
+        target_h = max(1, int(img.height * IMAGE_MAX_WIDTH / img.width))
+        img.draft("RGB", (IMAGE_MAX_WIDTH, target_h))
+    img.load()
+    timings["decode"] = (time.perf_counter() - t) * 1000
+
+    # 统一缩放：宽度限制在 1280px（兼顾 Gemini 识别率与体积）
+    # reducing_gap 会先用 reduce() 做整数倍降采样，再用 LANCZOS 收尾
+    t = time.perf_counter()
+    if img.width > IMAGE_MAX_WIDTH:
+        new_height = max(1, int(img.height * IMAGE_MAX_WIDTH / img.width))
+        img = img.resize((IMAGE_MAX_WIDTH, new_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    timings["resize"] = (time.perf_counter() - t) * 1000
+
+    # 转换为 JPEG 字节流并压缩质量至 75%
+    t = time.perf_counter()
+    output_buffer = io.BytesIO()
+    img.save(output_buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    timings["encode"] = (time.perf_counter() - t) * 1000
+    # CPython 的 getvalue() 在缓冲区没被导出时直接交出内部 bytes，不会再复制一份
+    return output_buffer.getvalue(), timings
+
+
+def _get_image_pool():
+    """返回图片进程池；进程池坏过之后返回 None，调用方改在本线程处理"""
+    global _image_pool
+    if _image_pool is None and not _image_pool_broken:
+        with _image_pool_lock:
+            if _image_pool is None and not _image_pool_broken:
+                # fork 出来的子进程直接继承已加载的 Pillow，不用重新 import 整个脚本
+                _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS,
+                                                  mp_context=multiprocessing.get_context("fork"))
+    return _image_pool
+
+
+def warm_image_pool():
+    """启动时先把子进程 fork 好，之后再起其他线程，避免在多线程状态下 fork"""
+    pool = _get_image_pool()
+    if pool is not None:
+        list(pool.map(abs, range(IMAGE_WORKERS)))
+
+
+def fetch_and_compress(file_url, expected_size=None):
+    with trace_span("image.fetch_compress", expected_size=expected_size) as span:
+        compressed, timings = _fetch_and_compress_in_pool(file_url, expected_size)
+        if span is not None:
+            # 子进程里的各阶段耗时没法直接挂 span，作为属性记下来
+            span.set(bytes=len(compressed), **{f"{k}_ms": round(v, 1) for k, v in timings.items()})
+        return compressed, timings
+
+
+def _fetch_and_compress_in_pool(file_url, expected_size):
+    pool = _get_image_pool()
+    if pool is None:
+        return _fetch_and_compress(file_url, expected_size)
+    try:
+        return pool.submit(_fetch_and_compress, file_url, expected_size).result()
+    except BrokenProcessPool as e:
+        # 子进程挂了（比如被 OOM kill）：不在多线程状态下重新 fork，之后都改在本线程处理
+        global _image_pool, _image_pool_broken
+        with _image_pool_lock:
+            if _image_pool is pool:
+                print(f"图片进程池异常，之后改为本地处理（重启后恢复）: {e}")
+                _image_pool_broken = True
+                _image_pool = None
+        return _fetch_and_compress(file_url, expected_size)
+
+
+def record_image_timings(timings):
+    for stage, ms in timings.items():
+        metrics.observe("hualin_image_stage_seconds", (("stage", stage),), ms / 1000)
+    with _image_stats_lock:
+        for stage, ms in timings.items():
+            agg = image_stage_totals.get(stage)
+            if agg is None:
+                continue
+            agg["count"] += 1
+            agg["total_ms"] += ms
+            agg["max_ms"] = max(agg["max_ms"], ms)
+
+
+def image_pipeline_stats():
+    with _image_stats_lock:
+        stats = {
+            stage: {"count": agg["count"], "avg_ms": round(agg["total_ms"] / agg["count"], 1) if agg["count"] else 0.0,
+                    "max_ms": round(agg["max_ms"], 1)}
+            for stage, agg in image_stage_totals.items()
+        }
+    stats["pool"] = {"workers": IMAGE_WORKERS, "mode": "in_thread" if _image_pool_broken else "process"}
+    return stats
+
+STATS_PROVIDERS["image_pipeline"] = image_pipeline_stats
+
 
 # 处理图片上传
 def upload_to_supabase(file_id):
     try:
         # 1. 获取文件路径
+        t = time.perf_counter()
         file_info = bot.get_file(file_id)
-        file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_info.file_path}"
-        
-        # 2. 下载原始图片
-        response = requests.get(file_url)
-        if response.status_code != 200:
-            return None
+        file_url = TELEGRAM_FILE_URL.format(TELEGRAM_TOKEN, file_info.file_path)
+        get_file_ms = (time.perf_counter() - t) * 1000
             
-        # --- 🚀 核心优化：Pillow 内存压缩 ---
-        img_data = io.BytesIO(response.content)
-        img = Image.open(img_data)
-        
-        # 统一缩放：宽度限制在 1280px（兼顾 Gemini 识别率与体积）
-        if img.width > 1280:
-            ratio = 1280 / float(img.width)
-            new_height = int(float(img.height) * float(ratio))
-            img = img.resize((1280, new_height), Image.Resampling.LANCZOS)
-        
-        # 转换为 JPEG 字节流并压缩质量至 75%
-        output_buffer = io.BytesIO()
-        if img.mode in ("RGBA", "P"): 
-            img = img.convert("RGB")
-        img.save(output_buffer, format="JPEG", quality=75, optimize=True)
-        compressed_bits = output_buffer.getvalue()
-        # --- 压缩结束 ---
+        # 2. --- 🚀 核心优化：进程池里完成流式下载 + 解码/缩放/压缩 ---
+        compressed_bits, timings = fetch_and_compress(file_url, file_info.file_size)
+        timings["download"] += get_file_ms
 
         # 3. 生成唯一文件名
         file_name = f"{file_id}_{int(time.time())}.jpg"
         
         # 4. 上传至 Supabase
+        t = time.perf_counter()
         supabase.storage.from_("item-images").upload(
             path=file_name,
             file=compressed_bits,
             file_options={"content-type": "image/jpeg"}
         )
+        timings["upload"] = (time.perf_counter() - t) * 1000
+        record_image_timings(timings)
+        print("图片流水线耗时(ms): " + ", ".join(f"{k}={timings[k]:.0f}" for k in IMAGE_STAGES if k in timings))
         
         # 返回公网访问链接以及压缩后的字节流（用于后续给 AI，避免二次下载）
         public_url = supabase.storage.from_("item-images").get_public_url(file_name)
@@ -140,15 +1089,202 @@ def upload_to_supabase(file_id):
         print(f"I/O 链路异常: {e}")
         return None, None
 
-# 处理广播逻辑 (增强版)
-def notify_subscribers(item_id):
+
+# 相册里的多张图并行下载/压缩/上传（压缩本身仍在进程池里）
+album_upload_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="album-upload")
+
+# 缓存命中后的续期（hits + 1、刷新 last_hit_at）不影响本次结果，丢给后台线程，不占命中路径的往返
+cache_touch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-touch")
+
+
+def _touch_cache(rpc_name, params):
+    try:
+        supabase.rpc(rpc_name, params).execute()
+    except Exception as e:
+        print(f"缓存续期失败 ({rpc_name}): {e}")
+
+
+def touch_cache_async(rpc_name, params):
+    cache_touch_pool.submit(_touch_cache, rpc_name, params)
+
+
+def upload_photos(file_ids):
+    """批量版 upload_to_supabase，按原顺序返回 [(url, bytes), ...]"""
+    if len(file_ids) == 1:
+        return [upload_to_supabase(file_ids[0])]
+    futures = []
+    for file_id in file_ids:
+        job = traced_handoff(upload_to_supabase, "album.upload")
+        try:
+            futures.append(album_upload_pool.submit(job, file_id))
+        except RuntimeError:
+            # 线程池已关闭（进程正在退出），排队 span 要结束掉
+            getattr(job, "cancel", lambda: None)()
+            raise
+    return [f.result() for f in futures]
+
+# 订阅关键词匹配引擎 (Aho-Corasick)
+# 把所有订阅词（统一小写）编进一台自动机，商品文案只需扫一遍就能找出全部命中的订阅者。
+# /sub、/unsub 直接在内存里增删，不再每次发布都把整张 subscriptions 表拉下来。
+class KeywordMatcher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.goto = [{}]         # 节点 -> {字符: 子节点}
+        self.fail = [0]          # 失配指针
+        self.dict_link = [0]     # 沿失配链最近的“关键词结尾”节点，0 表示没有
+        self.word = [None]       # 节点是哪个关键词的结尾
+        self.subscribers = {}    # 小写关键词 -> {telegram_id: 订阅条数}
+        self.dirty = False       # 新增过关键词，失配指针需要重算
+        self.stale = 0           # 已无人订阅但还留在树里的关键词数量
+        self.loaded = False
+
+    def _insert(self, keyword):
+        node = 0
+        for ch in keyword:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.dict_link.append(0)
+                self.word.append(None)
+            node = nxt
+        self.word[node] = keyword
+
+    def _rebuild_links(self):
+        # 废弃词太多时整树重建，否则只在现有树上 BFS 重算失配指针（都不读数据库）
+        if self.stale > max(64, len(self.subscribers)):
+            self.goto, self.fail, self.dict_link, self.word = [{}], [0], [0], [None]
+            for kw in self.subscribers:
+                self._insert(kw)
+            self.stale = 0
+
+        queue = []
+        for child in self.goto[0].values():
+            self.fail[child] = 0
+            self.dict_link[child] = 0
+            queue.append(child)
+        for node in queue:
+            for ch, child in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(ch, 0)
+                self.fail[child] = target if target != child else 0
+                fb = self.fail[child]
+                self.dict_link[child] = fb if self.word[fb] is not None else self.dict_link[fb]
+                queue.append(child)
+        self.dirty = False
+
+    def add(self, keyword, telegram_id):
+        kw = keyword.strip().lower()
+        if not kw:
+            return
+        with self.lock:
+            subs = self.subscribers.get(kw)
+            if subs is None:
+                subs = self.subscribers[kw] = {}
+                node = 0
+                for ch in kw:
+                    node = self.goto[node].get(ch)
+                    if node is None:
+                        break
+                if node is not None and self.word[node] == kw:
+                    self.stale = max(0, self.stale - 1)  # 老词复活，树里本来就有
+                else:
+                    self._insert(kw)
+                    self.dirty = True
+            subs[telegram_id] = subs.get(telegram_id, 0) + 1
+
+    def remove(self, keyword, telegram_id, count=None):
+        kw = keyword.strip().lower()
+        with self.lock:
+            subs = self.subscribers.get(kw)
+            if not subs or telegram_id not in subs:
+                return
+            left = 0 if count is None else subs[telegram_id] - count
+            if left > 0:
+                subs[telegram_id] = left
+            else:
+                del subs[telegram_id]
+            if not subs:
+                # 节点先留在树里，匹配时按 subscribers 过滤即可，攒多了再整树重建
+                del self.subscribers[kw]
+                self.stale += 1
+
+    def load(self, rows):
+        with self.lock:
+            self.goto, self.fail, self.dict_link, self.word = [{}], [0], [0], [None]
+            self.subscribers = {}
+            self.stale = 0
+            for row in rows:
+                kw = (row.get('keyword') or '').strip().lower()
+                if not kw:
+                    continue
+                subs = self.subscribers.get(kw)
+                if subs is None:
+                    subs = self.subscribers[kw] = {}
+                    self._insert(kw)
+                uid = row['telegram_id']
+                subs[uid] = subs.get(uid, 0) + 1
+            self._rebuild_links()
+            self.loaded = True
+
+    def match(self, text):
+        """扫描一遍文案，返回所有命中订阅者的 telegram_id 集合"""
+        hits = set()
+        with self.lock:
+            if self.dirty:
+                self._rebuild_links()
+            goto, fail, dict_link, word = self.goto, self.fail, self.dict_link, self.word
+            node = 0
+            for ch in text.lower():
+                while node and ch not in goto[node]:
+                    node = fail[node]
+                node = goto[node].get(ch, 0)
+                out = node if word[node] is not None else dict_link[node]
+                while out:
+                    subs = self.subscribers.get(word[out])
+                    if subs:
+                        hits.update(subs)
+                    out = dict_link[out]
+        return hits
+
+    def stats(self):
+        return {"keywords": len(self.subscribers), "nodes": len(self.goto), "stale": self.stale}
+
+
+sub_matcher = KeywordMatcher()
+STATS_PROVIDERS["subscriptions"] = sub_matcher.stats
+
+
+def load_subscriptions(page_size=1000):
+    """启动时把 subscriptions 表分页读一次，之后全靠 /sub /unsub 增量维护"""
+    rows = []
+    start = 0
+    while True:
+        res = supabase.table("subscriptions").select("telegram_id, keyword").range(start, start + page_size - 1).execute()
+        rows.extend(res.data or [])
+        if not res.data or len(res.data) < page_size:
+            break
+        start += page_size
+    sub_matcher.load(rows)
+    print(f"订阅匹配引擎已加载：{sub_matcher.stats()}")
+
+
+def ensure_subscriptions_loaded():
+    if not sub_matcher.loaded:
+        load_subscriptions()
+
+# 处理广播逻辑 (增强版)：准备好文案和收件人，真正的发送交给广播引擎
+def prepare_broadcast(item_id):
     try:
         # 1. 获取商品和卖家信息
-        item = supabase.table("items").select("*").eq("id", item_id).single().execute().data
-        if not item: return
+        item = fetch_item_with_seller(item_id)
+        if not item: return None
         
-        seller = supabase.table("profiles").select("trust_score").eq("telegram_id", item['telegram_id']).single().execute().data
-        score = seller.get('trust_score', 0) if seller else 0
+        score = seller_trust(item)
         
         # 2. 准备 HTML 格式的精美文案
         # 使用 <b> 替代 **，避免 Markdown 解析失败
@@ -173,34 +1309,481 @@ def notify_subscribers(item_id):
         markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton("🔍 查看商品详情", callback_data=f"view_{item_id}"))
 
-        # 4. 匹配并推送
-        search_content = f"{item['name']} {item['description']}".lower()
-        all_subs = supabase.table("subscriptions").select("*").execute()
-        
-        for sub in all_subs.data:
-            if sub['keyword'].lower() in search_content and str(sub['telegram_id']) != str(item['telegram_id']):
-                try:
-                    bot.send_message(sub['telegram_id'], notification_html, 
-                                     parse_mode="HTML", 
-                                     reply_markup=markup)
-                except Exception as e:
-                    print(f"推送单条失败: {e}")
+        # 4. 匹配：一次扫描文案即可拿到所有命中的订阅者（排除卖家自己）
+        ensure_subscriptions_loaded()
+        search_content = f"{item['name']} {item['description']}"
+        recipients = [sub_id for sub_id in sub_matcher.match(search_content)
+                      if str(sub_id) != str(item['telegram_id'])]
+        return recipients, notification_html, markup
                     
     except Exception as e:
         print(f"推送逻辑全局异常: {e}")
+        return None
+
+
+# 通知广播引擎
+# 发布事件先进有界队列，后台线程按 Telegram 限流（全局约 30 条/秒、同一聊天 1 条/秒）匀速推送，
+# 遇到 429 按 retry_after 自动重排，每次广播都留一份送达统计。确认发布的回调只负责入队。
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", "500"))
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))  # 留点余量，不顶着 30 跑
+TG_PER_CHAT_INTERVAL = float(os.getenv("TG_PER_CHAT_INTERVAL", "1.0"))
+# send_message 是阻塞调用，一个线程的吞吐只有 1/往返时延；按“速率 × 预估时延”开够发送线程，令牌桶才真正起限流作用
+TG_SEND_LATENCY = float(os.getenv("TG_SEND_LATENCY", "0.3"))
+NOTIFY_SENDERS = int(os.getenv("NOTIFY_SENDERS", "0")) or max(2, math.ceil(TG_GLOBAL_RATE * TG_SEND_LATENCY))
+NOTIFY_MAX_RETRIES = 3
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个，最多攒 capacity 个"""
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, n=1):
+        """拿到令牌返回 0，否则返回还需等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0.0
+            return (n - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        # 被 429 限流时把桶“透支”掉，相当于整体暂停 seconds 秒
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+            self.updated = time.monotonic()
+
+
+notify_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+tg_global_bucket = TokenBucket(TG_GLOBAL_RATE)
+_send_heap = []              # (可发送时间, 序号, chat_id, 广播记录)
+_send_cond = threading.Condition()
+_send_seq = itertools.count()
+_chat_next_send = {}         # chat_id -> 该聊天下次允许发送的时间
+broadcast_history = collections.deque(maxlen=50)
+broadcast_totals = {"broadcasts": 0, "sent": 0, "failed": 0, "retried": 0, "dropped_events": 0}
+_broadcast_lock = threading.Lock()
+_broadcast_started = False
+
+
+def notify_subscribers(item_id):
+    """发布事件入队后立即返回；队列满了就丢弃这次广播并记一笔"""
+    _ensure_broadcast_workers()
+    try:
+        notify_queue.put_nowait((item_id, time.time()))
+        return True
+    except queue.Full:
+        with _broadcast_lock:
+            broadcast_totals["dropped_events"] += 1
+        print(f"⚠️ 通知队列已满，商品 {item_id} 的广播被丢弃")
+        return False
+
+
+def _ensure_broadcast_workers():
+    global _broadcast_started
+    if _broadcast_started:
+        return
+    with _broadcast_lock:
+        if _broadcast_started:
+            return
+        threading.Thread(target=_broadcast_intake_loop, daemon=True, name="broadcast-intake").start()
+        for i in range(NOTIFY_SENDERS):
+            threading.Thread(target=_broadcast_send_loop, daemon=True, name=f"broadcast-sender-{i}").start()
+        _broadcast_started = True
+
+
+def _schedule_send(chat_id, job, ready_at):
+    with _send_cond:
+        heapq.heappush(_send_heap, (ready_at, next(_send_seq), chat_id, job))
+        _send_cond.notify()
+
+
+def _broadcast_intake_loop():
+    while True:
+        item_id, enqueued_at = notify_queue.get()
+        try:
+            prepared = prepare_broadcast(item_id)
+            if not prepared:
+                continue
+            recipients, html, markup = prepared
+            job = {
+                "item_id": item_id,
+                "recipients": len(recipients),
+                "pending": len(recipients),
+                "sent": 0, "failed": 0, "retried": 0,
+                "attempts": {},
+                "enqueued_at": enqueued_at,
+                "started_at": time.time(),
+                "finished_at": None,
+                "html": html, "markup": markup,
+            }
+            with _broadcast_lock:
+                broadcast_totals["broadcasts"] += 1
+                broadcast_history.append(job)
+            if not recipients:
+                job["finished_at"] = time.time()
+                continue
+            now = time.monotonic()
+            for chat_id in recipients:
+                _schedule_send(chat_id, job, now)
+        except Exception as e:
+            print(f"广播准备失败: {e}")
+        finally:
+            notify_queue.task_done()
+
+
+def _broadcast_send_loop():
+    while True:
+        with _send_cond:
+            while True:
+                now = time.monotonic()
+                if _send_heap and _send_heap[0][0] <= now:
+                    break
+                _send_cond.wait(timeout=(_send_heap[0][0] - now) if _send_heap else None)
+            _, _, chat_id, job = heapq.heappop(_send_heap)
+            chat_ready = _chat_next_send.get(chat_id, 0)
+            if chat_ready > now:
+                # 这个聊天 1 秒内刚发过，排到它的下一个空档
+                heapq.heappush(_send_heap, (chat_ready, next(_send_seq), chat_id, job))
+                continue
+            # 多个发送线程共用这张表，在锁里先占住这个聊天的下一个空档
+            _chat_next_send[chat_id] = now + TG_PER_CHAT_INTERVAL
+            if len(_chat_next_send) > 10000:
+                for cid in [c for c, t in _chat_next_send.items() if t < now]:
+                    _chat_next_send.pop(cid, None)
+
+        # 全局速率由所有发送线程共享的令牌桶控制
+        wait = tg_global_bucket.try_acquire()
+        while wait:
+            time.sleep(wait)
+            wait = tg_global_bucket.try_acquire()
+
+        try:
+            bot.send_message(chat_id, job["html"], parse_mode="HTML", reply_markup=job["markup"])
+            _finish_send(job, "sent")
+        except ApiTelegramException as e:
+            attempts = job["attempts"].get(chat_id, 0)
+            if e.error_code == 429 and attempts < NOTIFY_MAX_RETRIES:
+                retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                job["attempts"][chat_id] = attempts + 1
+                with _broadcast_lock:
+                    job["retried"] += 1
+                    broadcast_totals["retried"] += 1
+                tg_global_bucket.pause(retry_after)
+                with _send_cond:
+                    _chat_next_send[chat_id] = time.monotonic() + retry_after
+                _schedule_send(chat_id, job, time.monotonic() + retry_after)
+                print(f"⏳ 触发 Telegram 限流，{retry_after}s 后重试 (chat {chat_id})")
+            else:
+                print(f"推送单条失败: {e}")
+                _finish_send(job, "failed")
+        except Exception as e:
+            print(f"推送单条失败: {e}")
+            _finish_send(job, "failed")
+
+
+def _finish_send(job, result):
+    with _broadcast_lock:
+        job[result] += 1
+        broadcast_totals[result] += 1
+        job["pending"] -= 1
+        if job["pending"] > 0:
+            return
+        job["finished_at"] = time.time()
+        job.pop("html", None)
+        job.pop("markup", None)
+        job.pop("attempts", None)
+    print(f"📣 商品 {job['item_id']} 广播完成：送达 {job['sent']}/{job['recipients']}，"
+          f"失败 {job['failed']}，重试 {job['retried']}，耗时 {job['finished_at'] - job['started_at']:.1f}s")
+
+
+def broadcast_stats():
+    with _broadcast_lock:
+        recent = [
+            {k: job[k] for k in ("item_id", "recipients", "sent", "failed", "retried", "pending",
+                                 "enqueued_at", "started_at", "finished_at")}
+            for job in broadcast_history
+        ]
+        return {"queue_depth": notify_queue.qsize(), "pending_sends": len(_send_heap), "senders": NOTIFY_SENDERS,
+                "totals": dict(broadcast_totals), "recent": recent}
+
+STATS_PROVIDERS["broadcast"] = broadcast_stats
+metrics.gauge("hualin_notifications_queued", "待处理的广播事件数", notify_queue.qsize)
+metrics.gauge("hualin_notification_sends_pending", "已排进发送队列、尚未发出的通知条数", lambda: len(_send_heap))
+
+
+# Gemini 调用封装
+# 所有 generate_content 都走 gemini_generate(调用点, 内容)：全局并发上限 + 令牌桶配额，
+# 每次调用有总截止时间；429/5xx/超时按带抖动的指数退避重试；连续失败太多就熔断，
+# 熔断期间直接失败，不再把工作线程耗在一个挂掉的上游上。按调用点统计延迟和错误率。
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "3"))
+GEMINI_BACKOFF_BASE = 0.5
+GEMINI_BACKOFF_CAP = 8.0
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_RESET = float(os.getenv("GEMINI_BREAKER_RESET", "30"))
+GEMINI_TIMEOUTS = {"vision": 60.0, "search": 10.0, "geocode": 15.0}
+GEMINI_RETRYABLE = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+    TimeoutError,
+    ConnectionError,
+)
+
+
+class GeminiUnavailable(Exception):
+    """熔断中、排不上队或重试用尽时抛出"""
+
+
+class CircuitBreaker:
+    """连续失败 threshold 次后打开，reset_timeout 秒后放一个试探请求，成功就恢复"""
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.probe_thread = None
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.probing = True
+                self.probe_thread = threading.get_ident()
+                return True
+            return False
+
+    def release_probe(self):
+        """试探请求没能给出成败（排队超时、非上游错误）时调用，让下一个请求接着试探，否则会一直半开"""
+        with self.lock:
+            if self.probing and self.probe_thread == threading.get_ident():
+                self.probing = False
+                self.probe_thread = None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            self.probe_thread = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    self.trips += 1
+                self.opened_at = time.monotonic()
+                self.probing = False
+                self.probe_thread = None
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half_open" if self.probing else "open"
+
+
+gemini_semaphore = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+gemini_bucket = TokenBucket(GEMINI_RPM / 60.0, max(1.0, GEMINI_MAX_CONCURRENCY))
+gemini_breaker = CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_RESET)
+_gemini_stats_lock = threading.Lock()
+gemini_site_stats = {}       # 调用点 -> 计数和最近的延迟样本
+
+
+def _gemini_site(site):
+    agg = gemini_site_stats.get(site)
+    if agg is None:
+        agg = gemini_site_stats[site] = {"calls": 0, "ok": 0, "errors": 0, "retries": 0, "rejected": 0,
+                                         "latency_ms": collections.deque(maxlen=200),
+                                         "ttfc_ms": collections.deque(maxlen=200)}
+    return agg
+
+
+def _gemini_record(site, **counts):
+    if "latency_ms" in counts:
+        outcome = "ok" if counts.get("ok") else "error"
+        metrics.observe("hualin_gemini_request_seconds", (("site", site), ("outcome", outcome)),
+                        counts["latency_ms"] / 1000)
+    if "ttfc_ms" in counts:
+        metrics.observe("hualin_gemini_ttfc_seconds", (("site", site),), counts["ttfc_ms"] / 1000)
+    for key, n in counts.items():
+        if not key.endswith("_ms"):
+            metrics.inc("hualin_gemini_events_total", (("site", site), ("event", key)), n)
+    with _gemini_stats_lock:
+        agg = _gemini_site(site)
+        for sample_key in ("latency_ms", "ttfc_ms"):
+            value = counts.pop(sample_key, None)
+            if value is not None:
+                agg[sample_key].append(value)
+        for key, n in counts.items():
+            agg[key] += n
+
+
+def _gemini_acquire(deadline):
+    """拿一个令牌和一个并发名额，截止时间前拿不到就放弃"""
+    while True:
+        wait = gemini_bucket.try_acquire()
+        if wait == 0:
+            break
+        if time.monotonic() + wait > deadline:
+            return False
+        time.sleep(wait)
+    return gemini_semaphore.acquire(timeout=max(0.0, deadline - time.monotonic()))
+
+
+def gemini_generate(site, contents, timeout=None, **kwargs):
+    """带限流/超时/重试/熔断的 model.generate_content；失败时抛出最后一次的异常或 GeminiUnavailable"""
+    return _gemini_call(site, timeout, lambda remaining: model.generate_content(
+        contents, request_options={"timeout": remaining}, **kwargs))
+
+
+def gemini_stream_text(site, contents, on_text, timeout=None):
+    """流式生成：每来一块就用目前累积的全文回调 on_text，结束后返回全文；首块到达时间记为 TTFC"""
+    started = time.perf_counter()
+
+    def attempt(remaining):
+        parts = []
+        for chunk in model.generate_content(contents, stream=True, request_options={"timeout": remaining}):
+            try:
+                piece = chunk.text
+            except ValueError:
+                # 安全拦截等原因产生的空块没有 text
+                continue
+            if not parts:
+                _gemini_record(site, ttfc_ms=(time.perf_counter() - started) * 1000)
+            parts.append(piece)
+            on_text("".join(parts))
+        return "".join(parts)
+
+    return _gemini_call(site, timeout, attempt)
+
+
+def _gemini_call(site, timeout, attempt_fn):
+    timeout = timeout or GEMINI_TIMEOUTS.get(site, 30.0)
+    deadline = time.monotonic() + timeout
+    _gemini_record(site, calls=1)
+    started = time.perf_counter()
+    attempt = 0
+    while True:
+        if not gemini_breaker.allow():
+            _gemini_record(site, rejected=1)
+            raise GeminiUnavailable("Gemini 熔断中")
+        backoff = None
+        settled = False      # 这次放行是否已经向熔断器报告了成败
+        try:
+            if not _gemini_acquire(deadline):
+                _gemini_record(site, rejected=1)
+                raise GeminiUnavailable("Gemini 排队超时")
+            attempt += 1
+            try:
+                remaining = max(1.0, deadline - time.monotonic())
+                with trace_span("gemini", site=site, attempt=attempt):
+                    response = attempt_fn(remaining)
+            except GEMINI_RETRYABLE as e:
+                gemini_breaker.record_failure()
+                settled = True
+                backoff = random.uniform(0, min(GEMINI_BACKOFF_CAP, GEMINI_BACKOFF_BASE * 2 ** attempt))
+                if isinstance(e, google_exceptions.TooManyRequests):
+                    gemini_bucket.pause(backoff)
+                if attempt >= GEMINI_MAX_ATTEMPTS or time.monotonic() + backoff >= deadline:
+                    _gemini_record(site, errors=1, latency_ms=(time.perf_counter() - started) * 1000)
+                    raise
+                print(f"Gemini[{site}] 第 {attempt} 次调用失败，{backoff:.1f}s 后重试: {e}")
+                _gemini_record(site, retries=1)
+            except Exception:
+                # 参数错误、内容被拦截之类不是上游故障，不计入熔断
+                _gemini_record(site, errors=1, latency_ms=(time.perf_counter() - started) * 1000)
+                raise
+            else:
+                gemini_breaker.record_success()
+                settled = True
+            finally:
+                gemini_semaphore.release()
+        finally:
+            if not settled:
+                gemini_breaker.release_probe()
+        if backoff is None:
+            _gemini_record(site, ok=1, latency_ms=(time.perf_counter() - started) * 1000)
+            return response
+        # 退避期间不占并发名额
+        time.sleep(backoff)
+
+
+def gemini_stats():
+    with _gemini_stats_lock:
+        sites = {}
+        for site, agg in gemini_site_stats.items():
+            samples = sorted(agg["latency_ms"])
+            ttfc = sorted(agg["ttfc_ms"])
+            sites[site] = {
+                "calls": agg["calls"], "ok": agg["ok"], "errors": agg["errors"],
+                "retries": agg["retries"], "rejected": agg["rejected"],
+                "error_rate": round((agg["errors"] + agg["rejected"]) / agg["calls"], 3) if agg["calls"] else 0.0,
+                "avg_ms": round(sum(samples) / len(samples), 1) if samples else 0.0,
+                "p95_ms": round(samples[int(0.95 * (len(samples) - 1))], 1) if samples else 0.0,
+            }
+            if ttfc:
+                sites[site]["ttfc_avg_ms"] = round(sum(ttfc) / len(ttfc), 1)
+                sites[site]["ttfc_p95_ms"] = round(ttfc[int(0.95 * (len(ttfc) - 1))], 1)
+    return {"breaker": gemini_breaker.state(), "breaker_trips": gemini_breaker.trips,
+            "max_concurrency": GEMINI_MAX_CONCURRENCY, "rpm": GEMINI_RPM, "sites": sites}
+
+STATS_PROVIDERS["gemini"] = gemini_stats
 
 # 汇总更新描述
 # (Deleted duplicate function)
 
 
+# 商品数据访问
+# 商品和卖家信用分用 PostgREST 嵌入查询一次取回（依赖 items.telegram_id -> profiles 的外键）；
+# 写操作直接用 update 返回的整行刷新索引和预览，不再回头 select 一遍。
+ITEM_WITH_SELLER = "*, seller:profiles(trust_score)"
+
+
+def fetch_item_with_seller(item_id):
+    """取商品及卖家信用分，商品不存在返回 None；信用分在 item['seller']['trust_score']"""
+    res = supabase.table("items").select(ITEM_WITH_SELLER).eq("id", item_id).limit(1).execute()
+    return res.data[0] if res.data else None
+
+
+def seller_trust(item):
+    return (item.get('seller') or {}).get('trust_score') or 0
+
+
+def update_item(item_id, fields):
+    """更新商品并返回更新后的整行（没匹配到返回 None），顺带同步本地搜索索引"""
+    res = supabase.table("items").update(fields).eq("id", item_id).execute()
+    item_index.refresh(res.data)
+    return res.data[0] if res.data else None
+
+
 def get_latest_preview_text(item_id):
-    # 1. 从数据库获取最新状态
-    res = supabase.table("items").select("*").eq("id", item_id).single().execute()
-    item = res.data
+    # 从数据库获取最新状态
+    res = supabase.table("items").select("*").eq("id", item_id).limit(1).execute()
+    return render_preview_text(res.data[0] if res.data else None)
+
+
+def render_preview_text(item):
     if not item:
         return "⚠️ 数据丢失"
 
-    # 2. 这里的 item['description'] 包含了 AI 最初生成的带价格的文案
+    # 这里的 item['description'] 包含了 AI 最初生成的带价格的文案
     # 我们不直接删除它，而是通过拼接，让数据库的真实字段（price/location）成为“法官”
     
     # 🌟 重点：如果描述中包含 "DATA:" 这种原始标记，先切掉它
@@ -240,10 +1823,10 @@ def update_price_logic(message, item_id, original_msg_id):
     if new_price.isdigit():
         try:
             # 1. 更新数据库
-            supabase.table("items").update({"price": new_price}).eq("id", item_id).execute()
+            item = update_item(item_id, {"price": new_price})
             
-            # 2. 获取最新合成文案
-            new_text = get_latest_preview_text(item_id)
+            # 2. 用返回的最新行合成文案
+            new_text = render_preview_text(item)
             
             # 3. 编辑原来的预览消息（关键步骤！）
             # 需要在 callback 触发时把预览消息的 message_id 传进来
@@ -274,10 +1857,10 @@ def update_description_logic(message, item_id, original_msg_id):
     
     try:
         # 更新数据库中的描述
-        supabase.table("items").update({"description": new_desc}).eq("id", item_id).execute()     
+        item = update_item(item_id, {"description": new_desc})
         
-        # 2. 🌟 关键：调用统一刷新函数
-        new_text = get_latest_preview_text(item_id)
+        # 2. 🌟 关键：用返回的最新行调用统一渲染函数
+        new_text = render_preview_text(item)
         # 净化文案用于预览
         safe_text = escape_markdown(new_text)
 
@@ -303,9 +1886,9 @@ def update_description_logic(message, item_id, original_msg_id):
 def update_location_logic(message, item_id, original_msg_id):
     loc_text = message.text.strip()
     try:
-        supabase.table("items").update({"location_text": loc_text}).eq("id", item_id).execute()
-        # 2. 获取最新合成文案
-        new_text = get_latest_preview_text(item_id)
+        item = update_item(item_id, {"location_text": loc_text, "location_source": "manual"})
+        # 2. 用返回的最新行合成文案
+        new_text = render_preview_text(item)
         
         # 3. 编辑原来的预览消息（关键步骤！）
         # 需要在 callback 触发时把预览消息的 message_id 传进来
@@ -325,58 +1908,105 @@ def update_location_logic(message, item_id, original_msg_id):
         bot.reply_to(message, "❌ 位置保存失败。")
 
 # 我的发布的处理逻辑
-def handle_my_items_list(call):
+# 看板只取 id/name/price/status 四列，按 (created_at, id) 键集分页；
+# 信用分、各状态数量和当前页在 my_items_dashboard 一次 RPC 里一起拿回来。
+MY_ITEMS_PAGE_SIZE = 10
+MY_ITEMS_STATUS_LABELS = {"active": "✅在售", "sold": "💰已售", "draft": "📝草稿"}
+
+
+def fetch_my_items_page(user_id, cursor=None):
+    """cursor 为空取第一页；否则是 n<键集>（往后翻）或 p<键集>（往前翻）"""
+    params = {"p_user_id": user_id, "p_limit": MY_ITEMS_PAGE_SIZE}
+    backward = bool(cursor) and cursor[0] == "p"
+    if cursor:
+        ts, last_id = _decode_keyset(cursor[1:])
+        params.update({"p_cursor_ts": ts, "p_cursor_id": last_id, "p_backward": backward})
+    data = supabase.rpc("my_items_dashboard", params).execute().data or {}
+    rows = data.get("items") or []
+
+    has_more = len(rows) > MY_ITEMS_PAGE_SIZE
+    if has_more:
+        # 多取的那一条：往后翻时在末尾，往前翻时在开头（结果已统一按时间倒序）
+        rows = rows[1:] if backward else rows[:MY_ITEMS_PAGE_SIZE]
+    prev_cursor = next_cursor = None
+    if rows:
+        if backward:
+            prev_cursor = "p" + _encode_keyset(rows[0]) if has_more else None
+            next_cursor = "n" + _encode_keyset(rows[-1])
+        else:
+            prev_cursor = "p" + _encode_keyset(rows[0]) if cursor else None
+            next_cursor = "n" + _encode_keyset(rows[-1]) if has_more else None
+    return data, rows, prev_cursor, next_cursor
+
+
+def format_item_price(raw_price):
+    # 价格格式化：去掉无意义的小数点，并加上单位
+    try:
+        # 将 "1000.0" 转换为 1000，如果是文字则保持不变
+        price_num = float(raw_price)
+        if price_num == int(price_num):
+            return f"{int(price_num)}刀"
+        return f"{price_num}刀"
+    except (ValueError, TypeError):
+        # 如果价格本身就是文字（如“面议”），则直接使用
+        return str(raw_price)
+
+
+def render_my_items_page(data, rows, page_no):
+    score = data.get('trust_score') or 0
+    counts = data.get('counts') or {}
+    summary = " | ".join(f"{label} {counts.get(status, 0)}" for status, label in MY_ITEMS_STATUS_LABELS.items())
+
+    # 标题部分使用 Markdown
+    response_text = f"👤 **个人看板**\n⭐️ 华邻信用分：{score}\n{summary}\n━━━━━━━━━━━━━━\n"
+    first_no = (page_no - 1) * MY_ITEMS_PAGE_SIZE + 1
+    for i, item in enumerate(rows, first_no):
+        status = MY_ITEMS_STATUS_LABELS.get(item.get('status'), "💰已售")
+        # 拼装（这里使用 rf 原始字符串解决之前的语法警告）
+        safe_name = escape_markdown(item.get('name') or '未命名')
+        safe_price = escape_markdown(format_item_price(item.get('price', '0')))
+        response_text += (
+            rf"{i}\. *{safe_name}*" + "\n"
+            rf"   价格：`{safe_price}` | {status}" + "\n"
+            rf"   管理：/view\_{item['id']}" + "\n\n"
+        )
+    return response_text
+
+
+def my_items_markup(page_no, prev_cursor, next_cursor):
+    buttons = []
+    if prev_cursor:
+        buttons.append(types.InlineKeyboardButton("⬅️ 上一页", callback_data=f"mi_{page_no - 1}_{prev_cursor}"))
+    if next_cursor:
+        buttons.append(types.InlineKeyboardButton("下一页 ➡️", callback_data=f"mi_{page_no + 1}_{next_cursor}"))
+    if not buttons:
+        return None
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*buttons)
+    return markup
+
+
+def handle_my_items_list(call, page_no=1, cursor=None):
+    # 第一页发一条新消息；翻页（mi_页码_游标）时原地编辑那条消息
     user_id = call.from_user.id
     bot.answer_callback_query(call.id)
+    response_text = ""
     
     try:
-        # 1. 修正 order 参数为 desc=True [根据报错反馈修正]
-        res = supabase.table("items").select("*").eq("telegram_id", user_id).order("created_at", desc=True).execute()
-        prof = supabase.table("profiles").select("trust_score").eq("telegram_id", user_id).single().execute()
-        
-        score = prof.data.get('trust_score', 0) if prof.data else 0
+        data, rows, prev_cursor, next_cursor = fetch_my_items_page(user_id, cursor)
         
-        if not res.data:
-            bot.send_message(call.message.chat.id, "📭 您目前没有任何发布记录。")
+        if not rows:
+            if not cursor:
+                bot.send_message(call.message.chat.id, "📭 您目前没有任何发布记录。")
             return
 
-        # 2. 这里的标题部分使用 Markdown
-        response_text = f"👤 **个人看板**\n⭐️ 华邻信用分：{score}\n━━━━━━━━━━━━━━\n"
-        
-        # 在循环内部
-        for i, item in enumerate(res.data, 1):
-            # 1. 价格格式化：去掉无意义的小数点，并加上单位
-            raw_price = item.get('price', '0')
-            try:
-                # 将 "1000.0" 转换为 1000，如果是文字则保持不变
-                price_num = float(raw_price)
-                if price_num == int(price_num):
-                    formatted_price = f"{int(price_num)}刀"
-                else:
-                    formatted_price = f"{price_num}刀"
-            except (ValueError, TypeError):
-                # 如果价格本身就是文字（如“面议”），则直接使用
-                formatted_price = str(raw_price)
-
-            # 2. 状态图标
-            status = "✅在售" if item.get('status') == 'active' else "💰已售"
-            
-            # 3. 拼装（这里使用 rf 原始字符串解决你之前的语法警告）
-            safe_name = escape_markdown(item.get('name', '未命名'))
-            safe_price = escape_markdown(formatted_price)
-            
-            line = (
-                rf"{i}\. *{safe_name}*" + "\n"
-                rf"   价格：`{safe_price}` | {status}" + "\n"
-                rf"   管理：/view\_{item['id']}" + "\n\n"
-            )
-            response_text += line
-
-        # 3. 如果内容太长，分段发送或截断（Telegram 单条消息上限约 4000 字符）
-        if len(response_text) > 4000:
-            response_text = response_text[:3900] + "\n...(内容过多已截断)"
-
-        bot.send_message(call.message.chat.id, response_text, parse_mode="Markdown")
+        response_text = render_my_items_page(data, rows, page_no)
+        markup = my_items_markup(page_no, prev_cursor, next_cursor)
+        if cursor:
+            bot.edit_message_text(response_text, call.message.chat.id, call.message.message_id,
+                                  parse_mode="Markdown", reply_markup=markup)
+        else:
+            bot.send_message(call.message.chat.id, response_text, parse_mode="Markdown", reply_markup=markup)
         
     except Exception as e:
         print(f"获取记录失败: {e}")
@@ -408,20 +2038,20 @@ def handle_admin_refill(call, data_parts):
         try:
             if plan == "credits":
                 # --- 方案 A: 增加 100 能量 ---
-                # 使用你已有的 increment_credits RPC
-                supabase.rpc('increment_credits', {'user_id': int(target_user_id), 'amount': 100}).execute()
+                # 走统一账本 RPC，顺带记一条充值流水
+                ledger_apply(target_user_id, credits=100, reason="refill")
                 res_text = "100 能量 (⚡)"
             
             if plan == "monthly":
                 # 增加 31 天，并转为符合 Postgres 要求的字符串格式
                 expiry_date = (now + timedelta(days=31)).strftime('%Y-%m-%d %H:%M:%S')
-                supabase.table("profiles").update({"subscription_expiry": expiry_date}).eq("telegram_id", target_user_id).execute()
+                update_profile(target_user_id, {"subscription_expiry": expiry_date})
                 res_text = "月度会员 (31天)"
 
             elif plan == "yearly":
                 # 增加 365 天
                 expiry_date = (now + timedelta(days=365)).strftime('%Y-%m-%d %H:%M:%S')
-                supabase.table("profiles").update({"subscription_expiry": expiry_date}).eq("telegram_id", target_user_id).execute()
+                update_profile(target_user_id, {"subscription_expiry": expiry_date})
                 res_text = "年度会员 (365天)"
 
             # 通知用户
@@ -496,7 +2126,7 @@ def callback_inline(call):
             # 🌟 这里的逻辑应该和你的 me_command(message) 函数内容保持高度一致
             # 获取用户信用和发布记录
             user_id = call.from_user.id
-            profile = supabase.table("profiles").select("*").eq("telegram_id", user_id).single().execute().data
+            profile = get_profile(user_id)
             
             credits = profile.get('credits', 0) if profile else 10
             score = profile.get('trust_score', 0) if profile else 10
@@ -515,8 +2145,22 @@ def callback_inline(call):
             handle_my_items_list(call)
             return
         
+        # --- 分支 B1: 我的发布翻页 (匹配 mi_页码_游标) ---
+        if action == "mi":
+            handle_my_items_list(call, int(data_parts[1]), data_parts[2])
+            return
+
+        # --- 分支 B2: 搜索结果翻页 (匹配 sp_会话_页码_游标) ---
+        if action == "sp":
+            handle_search_page(call, data_parts)
+            return
+
         # --- 分支 C: 处理管理员审批 (匹配 refill_xxx) ---
         if action == "refill":
+            # 审批按钮只发给了管理员，但 callback_data 可以伪造，必须校验点按的人
+            if call.from_user.id != ADMIN_ID:
+                bot.answer_callback_query(call.id, "⛔ 只有管理员可以审批充值")
+                return
             # 保持你现有的 refill_ok/no 逻辑，但注意参数下标
             handle_admin_refill(call, data_parts)
             return
@@ -526,14 +2170,12 @@ def callback_inline(call):
             item_id = data_parts[1]
             bot.answer_callback_query(call.id)
             
-            item = supabase.table("items").select("*").eq("id", item_id).single().execute().data
+            # 商品和最新的卖家信用分一次取回
+            item = fetch_item_with_seller(item_id)
             if not item:
                 bot.send_message(call.message.chat.id, "❌ 该商品已下架或被删除。")
                 return
-                
-            # 再次获取最新的信用分
-            seller = supabase.table("profiles").select("trust_score").eq("telegram_id", item['telegram_id']).single().execute().data
-            score = seller.get('trust_score', 0) if seller else 0
+            score = seller_trust(item)
 
             # 2. 这里的核心修复：对 HTML 特殊字符进行转义，防止描述里的 < > 导致解析失败
             safe_name = item['name'].replace('<','&lt;').replace('>','&gt;')
@@ -656,19 +2298,22 @@ def callback_inline(call):
                 return 
 
             # 如果有用户名，则更新数据库：状态改为 active，并存入用户名
-            res = supabase.table("items").update({
+            item = update_item(item_id, {
                 "status": "active",
                 "username": username
-            }).eq("id", item_id).execute()
+            })
             
-            if res.data:
+            if item:
+                seller = get_profile(user_id)
+                if seller:
+                    item_index.set_trust(user_id, seller.get('trust_score'))
                 bot.edit_message_text(
                     f"✅ 发布成功！\n邻居现在可以通过 @{call.from_user.username} 联系你啦。", 
                     call.message.chat.id, 
                     call.message.message_id
                 )
                 
-                # 🌟 在这里调用广播函数
+                # 🌟 在这里调用广播函数（只入队，立即返回）
                 notify_subscribers(item_id)
             
         elif action == "editp":
@@ -724,26 +2369,23 @@ def callback_inline(call):
 
         elif action == "del":
             supabase.table("items").delete().eq("id", item_id).execute()
+            item_index.remove(item_id)
             bot.edit_message_text("🗑️ 已删除该草稿。", call.message.chat.id, call.message.message_id)
         # --- 在 callback_inline 函数中添加以下逻辑 ---
         elif action == "sold":
             try:
                 # 1. 更新商品状态为已售
-                supabase.table("items").update({"status": "sold"}).eq("id", item_id).execute()
+                item_data = update_item(item_id, {"status": "sold"})
                 
-                # 2. 增加信用积分 (profiles 表)
+                # 2. 增加信用积分 (走账本 RPC，原子 +10)
                 user_id = call.from_user.id
-                profile_res = supabase.table("profiles").select("trust_score").eq("telegram_id", user_id).execute()
-                
                 new_score = 10 # 默认加 10 分
-                if profile_res.data:
-                    current_score = profile_res.data[0].get('trust_score') or 0
-                    new_score = current_score + 10
-                    supabase.table("profiles").update({"trust_score": new_score}).eq("telegram_id", user_id).execute()
+                row = ledger_apply(user_id, trust=10, reason=f"sold:{item_id}")
+                if row:
+                    new_score = row.get('trust_score') or new_score
                 
                 # 3. 彻底刷新预览消息：移除所有按钮，替换为成交文案
-                # 获取商品标题用于展示
-                item_data = supabase.table("items").select("name").eq("id", item_id).single().execute().data
+                # 商品标题直接取自上面 update 返回的行
                 item_name = item_data.get('name', '该宝贝') if item_data else "该宝贝"
                 
                 bot.edit_message_text(
@@ -829,65 +2471,698 @@ def handle_my_info(message):
     
     try:
         # 从 profiles 查数据
-        res = supabase.table("profiles").select("*").eq("telegram_id", user_id).execute()
+        profile = get_profile(user_id)
         
         # 兜底：如果数据库没这人，说明是新用户
-        if not res.data:
+        if not profile:
             display_name = message.from_user.first_name or "宝藏邻居"
             trust_score = 0
             credits = 0
             expiry = "尚未开通"
         else:
-            profile = res.data[0]
             # 解决“未知邻居”：优先用 TG 名字，其次用表里存的 username
             display_name = message.from_user.first_name or profile.get('username') or "宝藏邻居"
             trust_score = profile.get('trust_score', 0)
             credits = profile.get('credits', 0)
             expiry = profile.get('subscription_expiry') or "尚未开通"
 
-        text = (
-            f"👤 **个人中心**\n"
-            f"━━━━━━━━━━━━━━\n"
-            f"🏷 昵称：{display_name}\n"
-            f"⭐️ 信用分：{trust_score}\n"
-            f"💰 能量值：{credits}\n"
-            f"📅 会员到期：{expiry}\n"
+        text = (
+            f"👤 **个人中心**\n"
+            f"━━━━━━━━━━━━━━\n"
+            f"🏷 昵称：{display_name}\n"
+            f"⭐️ 信用分：{trust_score}\n"
+            f"💰 能量值：{credits}\n"
+            f"📅 会员到期：{expiry}\n"
+            f"━━━━━━━━━━━━━━\n"
+            f"💡 *温馨提示：点击下方按钮查看或管理您的发布。*"
+        )
+        
+        # 按钮保持原有逻辑（查看我的发布等）
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton("📦 我的发布记录", callback_data="my_items"))
+        bot.reply_to(message, text, reply_markup=markup, parse_mode="Markdown")
+        
+    except Exception as e:
+        print(f"获取个人中心失败: {e}")
+        bot.reply_to(message, "⚠️ 无法读取个人资料，请稍后再试。")
+
+# 0.4.1 将模糊的搜索词转化为结构化的 SQL 查询条件。
+# 热门搜索词（“自行车”“100块以内的杯子”）反复出现，解析结果按规范化后的查询串缓存；
+# 同一时刻的相同查询只发一次 Gemini，其余线程等着共享结果。
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "2000"))
+SEARCH_INFLIGHT_TIMEOUT = 30
+search_intent_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+_inflight_searches = {}      # 规范化查询 -> {"event": Event, "result": 解析结果}
+_inflight_lock = threading.Lock()
+# 每条 /search 走了哪条路：本地规则 / 缓存 / 与别人共享的 Gemini 调用 / 自己调 Gemini
+search_intent_totals = {"rule": 0, "cache": 0, "coalesced": 0, "gemini": 0}
+
+
+def normalize_search_query(text):
+    """全角转半角、大小写折叠、空白压缩，让“ＩＰｈｏｎｅ  ”和“iphone”落到同一个缓存键"""
+    text = unicodedata.normalize("NFKC", text or "").casefold()
+    return " ".join(text.split())
+
+
+def parse_search_query(user_text):
+    key = normalize_search_query(user_text)
+    cached = search_intent_cache.get(key)
+    if cached is not None:
+        with _inflight_lock:
+            search_intent_totals["cache"] += 1
+        return dict(cached)
+
+    with _inflight_lock:
+        call = _inflight_searches.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight_searches[key] = {"event": threading.Event(), "result": None}
+        else:
+            search_intent_totals["coalesced"] += 1
+
+    if not leader:
+        # 已经有人在问 Gemini 同样的问题了，等它的结果
+        call["event"].wait(SEARCH_INFLIGHT_TIMEOUT)
+        return dict(call["result"]) if call["result"] else None
+
+    try:
+        with _inflight_lock:
+            search_intent_totals["gemini"] += 1
+        result = _parse_search_query_llm(key)
+        if result:
+            search_intent_cache.set(key, result)
+        call["result"] = result
+        return dict(result) if result else None
+    finally:
+        with _inflight_lock:
+            _inflight_searches.pop(key, None)
+        call["event"].set()
+
+
+# 本地快速解析：纯关键词、“XX元以内”“under 300”、已知地名这类简单输入用正则就能拆出来，
+# 只有把握不大时才交给 Gemini
+SEARCH_FAST_PATH_CONFIDENCE = float(os.getenv("SEARCH_FAST_PATH_CONFIDENCE", "0.8"))
+# 本地地名表，可用逗号分隔的环境变量覆盖，例如 SEARCH_GAZETTEER="北门,南门,教学楼"
+SEARCH_GAZETTEER = [
+    name.strip() for name in os.getenv(
+        "SEARCH_GAZETTEER",
+        "北门,南门,东门,西门,教学楼,图书馆,食堂,宿舍,体育馆,操场,地铁站,公交站,超市,华人超市,中国城,唐人街,市中心",
+    ).split(",") if name.strip()
+]
+_NUM = r'(\d+(?:\.\d+)?)'
+_PRICE_CEILING_PATTERNS = [
+    re.compile(_NUM + r'\s*(?:块钱|块|元|刀|美元|rmb|usd|\$)?\s*(?:以内|以下|之内|内)'),
+    re.compile(r'(?:不超过|不高于|低于|少于|最多|预算|under|below|less than|max|<=|<|≤)\s*\$?\s*' + _NUM
+               + r'\s*(?:块钱|块|元|刀|美元|rmb|usd)?'),
+]
+# 出现这些说明是组合/排除/区间之类的复杂条件，规则搞不定
+_COMPLEX_MARKERS = ("或者", "或", "还是", "不要", "除了", "而且", "但是", "以上", "之间", "至少", "高于", "超过",
+                    "~", "～", " or ", " and ", " not ", "between", "above", "over ", "without")
+_FILLER_WORDS = ("我想要", "我想买", "想要", "想买", "求购", "有没有", "有无", "帮我找", "找一个", "找个", "找",
+                 "搜索", "搜", "附近", "一个", "一辆", "一台", "一张", "便宜的", "二手的", "二手", "的")
+
+
+def fast_parse_search_query(user_text):
+    """规则解析，返回 (criteria, 置信度)；criteria 的格式与 Gemini 解析结果一致"""
+    text = normalize_search_query(user_text)
+    if not text:
+        return None, 0.0
+
+    max_price = None
+    for pattern in _PRICE_CEILING_PATTERNS:
+        m = pattern.search(text)
+        if m:
+            max_price = float(m.group(1))
+            text = text[:m.start()] + " " + text[m.end():]
+            break
+
+    if any(marker in f" {text} " for marker in _COMPLEX_MARKERS):
+        return None, 0.0
+
+    location = None
+    for name in sorted(SEARCH_GAZETTEER, key=len, reverse=True):
+        if name.casefold() in text:
+            location = name
+            text = text.replace(name.casefold(), " ", 1)
+            break
+
+    for word in _FILLER_WORDS:
+        text = text.replace(word, " ")
+    keyword = " ".join(re.sub(r'[，。！？、,.!?;；:：]', " ", text).split())
+
+    if re.search(r'\d', keyword):
+        # 剩下还有数字（“300元”“9成新”之类），含义不确定
+        return None, 0.2
+    if not keyword and max_price is None and location is None:
+        return None, 0.0
+
+    cjk_chars = len(re.findall(r'[\u4e00-\u9fff]', keyword))
+    latin_words = len(re.findall(r'[a-z]+', keyword))
+    if cjk_chars > 6 or latin_words > 3:
+        # 关键词太长，多半是描述性的需求（“适合送女朋友的礼物”），交给 Gemini
+        confidence = 0.4
+    elif cjk_chars and latin_words:
+        confidence = 0.7
+    else:
+        confidence = 0.95
+
+    criteria = {"keyword": keyword or None, "max_price": max_price, "location": location}
+    return criteria, confidence
+
+
+def resolve_search_criteria(user_text):
+    """先走本地规则，把握不够再走（带缓存的）Gemini 解析"""
+    criteria, confidence = fast_parse_search_query(user_text)
+    if criteria and confidence >= SEARCH_FAST_PATH_CONFIDENCE:
+        with _inflight_lock:
+            search_intent_totals["rule"] += 1
+        return criteria
+    return parse_search_query(user_text)
+
+
+def search_intent_stats():
+    stats = search_intent_cache.stats()
+    with _inflight_lock:
+        stats.update(search_intent_totals)
+        stats["inflight"] = len(_inflight_searches)
+    return stats
+
+STATS_PROVIDERS["search_intent"] = search_intent_stats
+
+
+def _parse_search_query_llm(user_text):
+    search_prompt = f"""
+    你是一个二手交易平台的搜索助手。请从用户的输入中提取结构化搜索条件。
+    用户输入："{user_text}"
+    
+    请严格输出以下 JSON 格式（不要有任何额外文字）：
+    {{
+      "keyword": "提取的商品核心词",
+      "max_price": "提取的价格上限，若无则为 null",
+      "location": "提取的地名/校区，若无则为 null"
+    }}
+    """
+    try:
+        response = gemini_generate("search", search_prompt)
+        # 提取并解析 JSON
+        import json
+        # 有时 AI 会带 ```json 标签，需要清理
+        clean_json = response.text.replace('```json', '').replace('```', '').strip()
+        return json.loads(clean_json)
+    except Exception as e:
+        print(f"Agent 解析搜索失败: {e}")
+        return None
+# 0.4.2 在售商品的本地倒排索引
+# 中文按双字切分（单字的片段保留单字），英文/数字按单词切分。/search 的关键词、价格、地点过滤
+# 全在内存里完成，只把命中的前几条拿去 Supabase 取完整数据；确认发布、已售、删除、改价/改描述/改位置
+# 时增量更新。索引没加载好之前，搜索仍走原来的数据库 ilike 查询。
+SEARCH_INDEX_FIELDS = "id, name, description, price, location_text, created_at, telegram_id"
+SEARCH_HYDRATE_LIMIT = 5
+_TOKEN_RE = re.compile(r'[\u4e00-\u9fff]+|[a-z0-9]+')
+
+# 排序：BM25 文本相关度 + 卖家信用 + 价格贴合度 + 发布新鲜度，按权重线性加权。
+# 权重可用 RANK_WEIGHTS="bm25=1.0,trust=0.3,price=0.2,recency=0.3" 调整。
+BM25_K1 = 1.2
+BM25_B = 0.75
+RANK_RECENCY_HALF_LIFE_DAYS = float(os.getenv("RANK_RECENCY_HALF_LIFE_DAYS", "14"))
+RANK_TRUST_PIVOT = 50.0   # 信用分到 50 时记 0.5 分，越高越接近 1
+RANK_WEIGHTS = {"bm25": 1.0, "trust": 0.3, "price": 0.2, "recency": 0.3}
+for _pair in os.getenv("RANK_WEIGHTS", "").split(","):
+    if "=" in _pair:
+        _name, _value = _pair.split("=", 1)
+        if _name.strip() in RANK_WEIGHTS:
+            RANK_WEIGHTS[_name.strip()] = float(_value)
+
+
+def parse_timestamp(value):
+    """Supabase 返回的时间字符串转成时间戳；小数位不是 6 位时 Python 3.9 的 fromisoformat 会报错，先补齐"""
+    if not value:
+        return time.time()
+    text = str(value).replace('Z', '+00:00')
+    text = re.sub(r'\.(\d+)', lambda m: "." + (m.group(1) + "000000")[:6], text, count=1)
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        return time.time()
+
+
+def tokenize_for_index(text):
+    tokens = []
+    for run in _TOKEN_RE.findall(normalize_search_query(text)):
+        if '\u4e00' <= run[0] <= '\u9fff':
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class ItemSearchIndex:
+    # 排序用到的数值按列存成 NumPy 数组，每个商品占一行（下架后行号回收复用）；
+    # 词频是稀疏的“词 -> 行”矩阵：每个词一组 (行号数组, 词频数组)，rank 时按行号直接取数向量化打分
+    COLUMNS = {"price": (np.float64, np.nan), "created_ts": (np.float64, 0.0),
+               "length": (np.float64, 0.0), "seller_slot": (np.int64, 0)}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = False
+        self._reset_locked()
+
+    def _reset_locked(self):
+        self.docs = {}       # item_id -> 文档（规范化文本、地点、发布时间、token 计数），过滤用
+        self.postings = {}   # token -> {item_id}
+        self.term_tf = {}    # token -> {行号: 词频}
+        self._term_arrays = {}   # token -> (行号数组, 词频数组)，term_tf 变了就丢掉重建
+        self._expansions = {}    # 查询词 -> 包含它的词表 token（单字、英文子串用），词表一变就清空
+        self.row_of = {}     # item_id -> 行号
+        self.free_rows = []
+        self.n_rows = 0
+        self.cols = {name: np.full(0, fill, dtype) for name, (dtype, fill) in self.COLUMNS.items()}
+        self.seller_trust = {}   # telegram_id -> trust_score
+        self.seller_slot = {}    # telegram_id -> trust 数组下标；0 号留给没有资料的卖家
+        self.trust_by_slot = np.zeros(1, dtype=np.float64)
+        self.total_length = 0    # 所有文档的 token 数之和，算 BM25 的平均文档长度用
+
+    def _alloc_row_locked(self):
+        if self.free_rows:
+            return self.free_rows.pop()
+        row = self.n_rows
+        capacity = len(self.cols["price"])
+        if row >= capacity:
+            new_capacity = max(1024, capacity * 2)
+            for name, (dtype, fill) in self.COLUMNS.items():
+                grown = np.full(new_capacity, fill, dtype)
+                grown[:capacity] = self.cols[name]
+                self.cols[name] = grown
+        self.n_rows += 1
+        return row
+
+    def _seller_slot_locked(self, telegram_id):
+        if telegram_id is None:
+            return 0
+        telegram_id = int(telegram_id)
+        slot = self.seller_slot.get(telegram_id)
+        if slot is None:
+            slot = self.seller_slot[telegram_id] = len(self.trust_by_slot)
+            self.trust_by_slot = np.append(self.trust_by_slot, self.seller_trust.get(telegram_id, 0.0))
+        return slot
+
+    def _add_locked(self, row):
+        item_id = row['id']
+        if item_id in self.docs:
+            self._remove_locked(item_id)
+        text = normalize_search_query(f"{row.get('name') or ''} {row.get('description') or ''}")
+        tokens = collections.Counter(tokenize_for_index(text))
+        try:
+            price = float(row.get('price'))
+        except (TypeError, ValueError):
+            price = np.nan
+        length = sum(tokens.values())
+        self.docs[item_id] = {
+            "text": text,
+            "tokens": tokens,
+            "location": normalize_search_query(row.get('location_text') or ""),
+            "created_at": row.get('created_at') or "",
+        }
+        r = self.row_of[item_id] = self._alloc_row_locked()
+        self.cols["price"][r] = price
+        self.cols["created_ts"][r] = parse_timestamp(row.get('created_at'))
+        self.cols["length"][r] = length
+        self.cols["seller_slot"][r] = self._seller_slot_locked(row.get('telegram_id'))
+        self.total_length += length
+        for token, count in tokens.items():
+            if token not in self.postings:
+                self._expansions.clear()
+            self.postings.setdefault(token, set()).add(item_id)
+            self.term_tf.setdefault(token, {})[r] = count
+            self._term_arrays.pop(token, None)
+
+    def _remove_locked(self, item_id):
+        doc = self.docs.pop(item_id, None)
+        if not doc:
+            return
+        r = self.row_of.pop(item_id)
+        self.total_length -= int(self.cols["length"][r])
+        for name, (_, fill) in self.COLUMNS.items():
+            self.cols[name][r] = fill
+        self.free_rows.append(r)
+        for token in doc["tokens"]:
+            self._term_arrays.pop(token, None)
+            tfs = self.term_tf.get(token)
+            if tfs:
+                tfs.pop(r, None)
+                if not tfs:
+                    del self.term_tf[token]
+            ids = self.postings.get(token)
+            if ids:
+                ids.discard(item_id)
+                if not ids:
+                    del self.postings[token]
+                    self._expansions.clear()
+
+    def add(self, row):
+        with self.lock:
+            self._add_locked(row)
+
+    def remove(self, item_id):
+        with self.lock:
+            self._remove_locked(int(item_id))
+
+    def refresh(self, rows):
+        """写库后用返回的整行更新索引：只处理在售商品，下架/草稿的顺手移除"""
+        with self.lock:
+            for row in rows or []:
+                if row.get('status') == 'active':
+                    self._add_locked(row)
+                else:
+                    self._remove_locked(row['id'])
+
+    def set_trust(self, telegram_id, trust_score):
+        with self.lock:
+            telegram_id = int(telegram_id)
+            self.seller_trust[telegram_id] = float(trust_score or 0)
+            slot = self.seller_slot.get(telegram_id)
+            if slot is not None:
+                self.trust_by_slot[slot] = self.seller_trust[telegram_id]
+
+    def load(self, rows, seller_trust=None):
+        with self.lock:
+            self._reset_locked()
+            self.seller_trust = {int(k): float(v or 0) for k, v in (seller_trust or {}).items()}
+            for row in rows:
+                self._add_locked(row)
+            self.ready = True
+
+    def _expand_locked(self, token):
+        """查询词对应的词表 token：双字词直接查；单个汉字、英文单词保留 ilike 的子串语义（“phone”能搜到“iphone”），
+        扫一遍词表（远小于商品数），结果缓存到词表变化为止"""
+        if len(token) == 2 and '\u4e00' <= token[0] <= '\u9fff':
+            return [token] if token in self.postings else []
+        expanded = self._expansions.get(token)
+        if expanded is None:
+            expanded = self._expansions[token] = [vocab for vocab in self.postings if token in vocab]
+        return expanded
+
+    def _postings_for(self, token):
+        ids = set()
+        for vocab in self._expand_locked(token):
+            ids |= self.postings[vocab]
+        return ids
+
+    def _term_column_locked(self, token):
+        arrays = self._term_arrays.get(token)
+        if arrays is None:
+            tfs = self.term_tf.get(token, {})
+            arrays = self._term_arrays[token] = (
+                np.fromiter(tfs.keys(), dtype=np.int64, count=len(tfs)),
+                np.fromiter(tfs.values(), dtype=np.float64, count=len(tfs)))
+        return arrays
+
+    def search(self, keyword=None, max_price=None, location=None):
+        """返回满足条件的 item_id 列表（按发布时间从新到旧）"""
+        keyword = normalize_search_query(keyword) if keyword else ""
+        location = normalize_search_query(location) if location else ""
+        tokens = set(tokenize_for_index(keyword))
+        with self.lock:
+            if tokens:
+                lists = sorted((self._postings_for(t) for t in tokens), key=len)
+                candidates = set(lists[0])
+                for ids in lists[1:]:
+                    candidates &= ids
+                    if not candidates:
+                        break
+            else:
+                candidates = set(self.docs)
+            hits = []
+            for item_id in candidates:
+                doc = self.docs[item_id]
+                # 双字命中不代表连续出现，最后按原来 ilike 的语义再核对一次子串
+                if keyword and keyword not in doc["text"]:
+                    continue
+                if max_price is not None:
+                    price = self.cols["price"][self.row_of[item_id]]
+                    # NaN（没填价格）和任何数比较都是 False
+                    if not price <= max_price:
+                        continue
+                if location and location not in doc["location"]:
+                    continue
+                hits.append(item_id)
+            hits.sort(key=lambda i: (self.docs[i]["created_at"], i), reverse=True)
+        return hits
+
+    def rank(self, item_ids, keyword=None, max_price=None, top_k=SEARCH_HYDRATE_LIMIT):
+        """给候选商品打分，返回得分最高的 top_k 个 item_id。按行号从列数组取数，打分全部用 NumPy 向量运算"""
+        if not item_ids:
+            return []
+        keyword = normalize_search_query(keyword) if keyword else ""
+        terms = sorted(set(tokenize_for_index(keyword)))
+        with self.lock:
+            n_docs = len(self.docs) or 1
+            avg_len = (self.total_length / n_docs) or 1.0
+            rows = np.fromiter((self.row_of[i] for i in item_ids), dtype=np.int64, count=len(item_ids))
+            lengths = self.cols["length"][rows]
+            prices = self.cols["price"][rows]
+            created = self.cols["created_ts"][rows]
+            trust = self.trust_by_slot[self.cols["seller_slot"][rows]]
+            # 词频矩阵（候选 × 查询词）：把每个词的稀疏列按行号散射到候选的位置上。
+            # tf 和文档长度都按 token 计数，BM25 的长度归一化才一致
+            position = np.full(self.n_rows, -1, dtype=np.int64)
+            position[rows] = np.arange(len(rows))
+            tf = np.zeros((len(rows), len(terms)), dtype=np.float64)
+            df = np.zeros(len(terms), dtype=np.float64)
+            for j, term in enumerate(terms):
+                columns = [self._term_column_locked(t) for t in self._expand_locked(term)]
+                if not columns:
+                    continue
+                term_rows = np.concatenate([c[0] for c in columns])
+                term_tf = np.concatenate([c[1] for c in columns])
+                df[j] = np.unique(term_rows).size
+                pos = position[term_rows]
+                hit = pos >= 0
+                np.add.at(tf[:, j], pos[hit], term_tf[hit])
+
+        # BM25
+        if terms:
+            idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / avg_len)
+            bm25 = (idf * tf * (BM25_K1 + 1) / (tf + norm[:, None])).sum(axis=1)
+            top = bm25.max()
+            bm25 = bm25 / top if top > 0 else bm25
+        else:
+            bm25 = np.zeros(len(rows))
+
+        trust_score = trust / (trust + RANK_TRUST_PIVOT)
+        if max_price:
+            # 预算以内越便宜越贴合
+            price_fit = np.clip(1 - np.nan_to_num(prices, nan=max_price) / max_price, 0, 1)
+        else:
+            price_fit = np.zeros(len(rows))
+        age_days = np.maximum(time.time() - created, 0) / 86400
+        recency = np.exp(-np.log(2) * age_days / RANK_RECENCY_HALF_LIFE_DAYS)
+
+        score = (RANK_WEIGHTS["bm25"] * bm25 + RANK_WEIGHTS["trust"] * trust_score
+                 + RANK_WEIGHTS["price"] * price_fit + RANK_WEIGHTS["recency"] * recency)
+        k = min(top_k, len(score))
+        top_idx = np.argpartition(-score, k - 1)[:k]
+        top_idx = top_idx[np.argsort(-score[top_idx], kind="stable")]
+        return [item_ids[i] for i in top_idx]
+
+    def stats(self):
+        with self.lock:
+            return {"ready": self.ready, "items": len(self.docs), "tokens": len(self.postings),
+                    "sellers": len(self.seller_trust), "weights": dict(RANK_WEIGHTS)}
+
+
+item_index = ItemSearchIndex()
+STATS_PROVIDERS["search_index"] = item_index.stats
+
+
+def load_item_index(page_size=1000):
+    rows = []
+    start = 0
+    while True:
+        res = (supabase.table("items").select(SEARCH_INDEX_FIELDS).eq("status", "active")
+               .order("id").range(start, start + page_size - 1).execute())
+        rows.extend(res.data or [])
+        if not res.data or len(res.data) < page_size:
+            break
+        start += page_size
+
+    # 顺带把这些卖家的信用分取回来，排序要用
+    seller_ids = sorted({row['telegram_id'] for row in rows if row.get('telegram_id')})
+    seller_trust = {}
+    for i in range(0, len(seller_ids), 200):
+        res = supabase.table("profiles").select("telegram_id, trust_score").in_("telegram_id", seller_ids[i:i + 200]).execute()
+        for row in res.data or []:
+            seller_trust[row['telegram_id']] = float(row.get('trust_score') or 0)
+    item_index.load(rows, seller_trust)
+    print(f"商品搜索索引已加载：{item_index.stats()}")
+
+
+def hydrate_items(item_ids):
+    """按给定顺序从 Supabase 取回完整商品数据"""
+    if not item_ids:
+        return []
+    res = supabase.table("items").select("*").in_("id", item_ids).execute()
+    by_id = {row['id']: row for row in res.data or []}
+    return [by_id[i] for i in item_ids if i in by_id]
+
+
+# 0.4.2.1 搜索结果分页
+# 每次 /search 建一个短期会话（意图解析结果 + 候选列表 + 已取过的页），按钮的 callback_data 里
+# 只带会话 ID、页码和一个紧凑游标：
+#   o<偏移>            走本地索引时，在排好序的候选列表里的位置
+#   n/p<时间戳>.<id>   走数据库时，(created_at, id) 键集游标，n 往后翻、p 往前翻
+SEARCH_PAGE_SIZE = SEARCH_HYDRATE_LIMIT
+SEARCH_MAX_RANKED = 100
+SEARCH_SESSION_TTL = float(os.getenv("SEARCH_SESSION_TTL", "600"))
+search_sessions = TTLCache(5000, SEARCH_SESSION_TTL)
+STATS_PROVIDERS["search_sessions"] = search_sessions.stats
+
+
+def new_search_session(criteria, query_text):
+    max_price = float(criteria['max_price']) if criteria.get('max_price') else None
+    session = {
+        "qid": uuid.uuid4().hex[:8],
+        "criteria": criteria,
+        "max_price": max_price,
+        "query_text": query_text,
+        "pages": {},      # 游标 -> (rows, 上一页游标, 下一页游标)
+    }
+    if item_index.ready:
+        hit_ids = item_index.search(criteria.get('keyword'), max_price, criteria.get('location'))
+        session["ranked_ids"] = item_index.rank(hit_ids, criteria.get('keyword'), max_price, SEARCH_MAX_RANKED)
+        session["first_cursor"] = "o0"
+    else:
+        session["first_cursor"] = "n"
+    search_sessions.set(session["qid"], session)
+    return session
+
+
+def _encode_keyset(row):
+    micros = int(round(parse_timestamp(row['created_at']) * 1_000_000))
+    return f"{micros:x}.{int(row['id']):x}"
+
+
+def _decode_keyset(token):
+    micros, item_id = token.split(".")
+    ts = datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=int(micros, 16))
+    return ts.isoformat(), int(item_id, 16)
+
+
+def _db_search_page(criteria, max_price, cursor):
+    """数据库键集分页：按 (created_at, id) 倒序，每次只取一页 + 1 条用来判断还有没有下一页"""
+    direction = cursor[0]
+    query = supabase.table("items").select("*").eq("status", "active")
+
+    # 使用 or 逻辑：匹配标题 或者 匹配描述；有游标时把键集条件一起并进同一个 or 里
+    keyword_filter = None
+    if criteria.get('keyword'):
+        k = f"%{criteria['keyword']}%"
+        keyword_filter = f"or(name.ilike.{k},description.ilike.{k})"
+    if len(cursor) > 1:
+        ts, last_id = _decode_keyset(cursor[1:])
+        op = "lt" if direction == "n" else "gt"
+        branches = [f'created_at.{op}."{ts}"', f'and(created_at.eq."{ts}",id.{op}.{last_id})']
+        if keyword_filter:
+            branches = [f"and({keyword_filter},{branches[0]})",
+                        f'and({keyword_filter},created_at.eq."{ts}",id.{op}.{last_id})']
+        query = query.or_(",".join(branches))
+    elif keyword_filter:
+        query = query.or_(keyword_filter[3:-1])
+
+    if max_price is not None:
+        query = query.lte("price", max_price)
+    if criteria.get('location'):
+        query = query.ilike("location_text", f"%{criteria['location']}%")
+
+    descending = direction == "n"
+    rows = (query.order("created_at", desc=descending).order("id", desc=descending)
+            .limit(SEARCH_PAGE_SIZE + 1).execute().data) or []
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    if not descending:
+        rows.reverse()
+    if not rows:
+        return [], None, None
+
+    if direction == "n":
+        prev_cursor = "p" + _encode_keyset(rows[0]) if len(cursor) > 1 else None
+        next_cursor = "n" + _encode_keyset(rows[-1]) if has_more else None
+    else:
+        prev_cursor = "p" + _encode_keyset(rows[0]) if has_more else None
+        next_cursor = "n" + _encode_keyset(rows[-1])
+    return rows, prev_cursor, next_cursor
+
+
+def fetch_search_page(session, cursor):
+    cached = session["pages"].get(cursor)
+    if cached:
+        return cached
+    if cursor.startswith("o"):
+        offset = int(cursor[1:])
+        ranked = session["ranked_ids"]
+        rows = hydrate_items(ranked[offset:offset + SEARCH_PAGE_SIZE])
+        prev_cursor = f"o{max(0, offset - SEARCH_PAGE_SIZE)}" if offset > 0 else None
+        next_cursor = f"o{offset + SEARCH_PAGE_SIZE}" if offset + SEARCH_PAGE_SIZE < len(ranked) else None
+        page = (rows, prev_cursor, next_cursor)
+    else:
+        page = _db_search_page(session["criteria"], session["max_price"], cursor)
+    session["pages"][cursor] = page
+    return page
+
+
+def render_search_page(rows, page_no):
+    results_text = f"🔎 **为您找到以下宝贝：**（第 {page_no} 页）\n\n"
+    for item in rows:
+        seller_id = item.get('telegram_id')
+        # 构造一个直接拉起私聊的链接
+        # 注意：tg://user?id= 仅在手机端点对点生效，t.me/ 则更通用
+        contact_url = f"tg://user?id={seller_id}"
+        
+        results_text += (
+            f"📦 **{item['name']}**\n"
+            f"💰 价格：{item['price']}\n"
+            f"📍 位置：{item.get('location_text') or '未标注'}\n"
+            f"👤 [点击这里联系卖家]({contact_url})\n"
             f"━━━━━━━━━━━━━━\n"
-            f"💡 *温馨提示：点击下方按钮查看或管理您的发布。*"
         )
-        
-        # 按钮保持原有逻辑（查看我的发布等）
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("📦 我的发布记录", callback_data="my_items"))
-        bot.reply_to(message, text, reply_markup=markup, parse_mode="Markdown")
-        
-    except Exception as e:
-        print(f"获取个人中心失败: {e}")
-        bot.reply_to(message, "⚠️ 无法读取个人资料，请稍后再试。")
+    return results_text
 
-# 0.4.1 将模糊的搜索词转化为结构化的 SQL 查询条件。
-def parse_search_query(user_text):
-    search_prompt = f"""
-    你是一个二手交易平台的搜索助手。请从用户的输入中提取结构化搜索条件。
-    用户输入："{user_text}"
-    
-    请严格输出以下 JSON 格式（不要有任何额外文字）：
-    {{
-      "keyword": "提取的商品核心词",
-      "max_price": "提取的价格上限，若无则为 null",
-      "location": "提取的地名/校区，若无则为 null"
-    }}
-    """
-    try:
-        response = model.generate_content(search_prompt)
-        # 提取并解析 JSON
-        import json
-        # 有时 AI 会带 ```json 标签，需要清理
-        clean_json = response.text.replace('```json', '').replace('```', '').strip()
-        return json.loads(clean_json)
-    except Exception as e:
-        print(f"Agent 解析搜索失败: {e}")
+
+def search_page_markup(qid, page_no, prev_cursor, next_cursor):
+    buttons = []
+    if prev_cursor:
+        buttons.append(types.InlineKeyboardButton("⬅️ 上一页", callback_data=f"sp_{qid}_{page_no - 1}_{prev_cursor}"))
+    if next_cursor:
+        buttons.append(types.InlineKeyboardButton("下一页 ➡️", callback_data=f"sp_{qid}_{page_no + 1}_{next_cursor}"))
+    if not buttons:
         return None
+    markup = types.InlineKeyboardMarkup()
+    markup.row(*buttons)
+    return markup
+
+
+def handle_search_page(call, data_parts):
+    # data_parts 格式: ['sp', 会话ID, 页码, 游标]
+    qid, page_no, cursor = data_parts[1], int(data_parts[2]), data_parts[3]
+    session = search_sessions.get(qid)
+    if not session:
+        bot.answer_callback_query(call.id, "⌛ 搜索结果已过期，请重新 /search", show_alert=True)
+        return
+    rows, prev_cursor, next_cursor = fetch_search_page(session, cursor)
+    if not rows:
+        bot.answer_callback_query(call.id, "没有更多了")
+        return
+    bot.answer_callback_query(call.id)
+    bot.edit_message_text(render_search_page(rows, page_no), call.message.chat.id, call.message.message_id,
+                          parse_mode="Markdown",
+                          reply_markup=search_page_markup(qid, page_no, prev_cursor, next_cursor))
+
+
 # 0.4.2实现搜索指令逻辑
 @bot.message_handler(commands=['search'])
 def handle_smart_search(message):
@@ -897,58 +3172,34 @@ def handle_smart_search(message):
         return
 
     # 1. 检查积分（智能搜索消耗 1 能量）
-    profile = get_or_create_profile(message.from_user)
-    if profile['credits'] < 1:
+    get_or_create_profile(message.from_user)
+    if ledger_available(message.from_user.id) < 1:
         bot.reply_to(message, "❌ 能量不足，无法进行智能搜索。")
         return
 
     bot.send_chat_action(message.chat.id, 'typing')
     
-    # 2. 调用 Agent 解析意图
-    criteria = parse_search_query(query_text)
+    # 2. 解析意图：简单输入本地规则秒出，复杂的才调用 Agent
+    criteria = resolve_search_criteria(query_text)
     if not criteria:
         bot.reply_to(message, "😵 AI 没听懂你的搜索需求，请换个说法。")
         return
 
-    # 3. 构造数据库查询
-    query = supabase.table("items").select("*").eq("status", "active")
-    
-    # 3. 构造数据库查询 (升级版)
-    # 使用 or 逻辑：匹配标题 或者 匹配描述
-    if criteria.get('keyword'):
-        k = f"%{criteria['keyword']}%"
-        # Supabase 的 or 语法：.or_("name.ilike.%key%,description.ilike.%key%")
-        query = query.or_(f"name.ilike.{k},description.ilike.{k}")
-    
-    if criteria.get('max_price'):
-        query = query.lte("price", float(criteria['max_price']))
-    
-    if criteria.get('location'):
-        query = query.ilike("location_text", f"%{criteria['location']}%")
+    # 3. 建一个搜索会话，后面翻页直接用它，不再重新解析意图、重新扫描
+    session = new_search_session(criteria, query_text)
+    rows, prev_cursor, next_cursor = fetch_search_page(session, session["first_cursor"])
 
-    res = query.execute()
+    # 4. 扣除 1 能量（批量结算）并反馈结果；翻页不再收费
+    # 解析意图期间余额可能被并发的识图扣掉，预扣失败就不给结果
+    if not ledger_debit_batched(message.from_user.id, 1, "search"):
+        bot.reply_to(message, "❌ 能量不足，无法进行智能搜索。")
+        return
 
-    # 4. 扣除 1 能量并反馈结果
-    supabase.table("profiles").update({"credits": profile['credits'] - 1}).eq("telegram_id", message.from_user.id).execute()
-    
-    if not res.data:
+    if not rows:
         bot.reply_to(message, f"😿 没找到符合条件【{query_text}】的宝贝呢。")
     else:
-        results_text = "🔎 **为您找到以下宝贝：**\n\n"
-        for item in res.data[:5]: # 仅显示前5个
-            seller_id = item.get('telegram_id')
-            # 构造一个直接拉起私聊的链接
-            # 注意：tg://user?id= 仅在手机端点对点生效，t.me/ 则更通用
-            contact_url = f"tg://user?id={seller_id}"
-            
-            results_text += (
-                f"📦 **{item['name']}**\n"
-                f"💰 价格：{item['price']}\n"
-                f"📍 位置：{item.get('location_text') or '未标注'}\n"
-                f"👤 [点击这里联系卖家]({contact_url})\n"
-                f"━━━━━━━━━━━━━━\n"
-            )
-        bot.reply_to(message, results_text, parse_mode="Markdown")
+        bot.reply_to(message, render_search_page(rows, 1), parse_mode="Markdown",
+                     reply_markup=search_page_markup(session["qid"], 1, prev_cursor, next_cursor))
 
 # 0.4.3 实现显示我的货架_old
 #@bot.message_handler(commands=['my'])
@@ -973,7 +3224,138 @@ def handle_smart_search(message):
 #             reply_markup=markup
 #         )
 # 0.4.3.1 处理用户发送的位置信息经纬度翻译
+# 卖家集中在几个街区，同一个 geohash 格子里的坐标问 Gemini 得到的答案基本一样。
+# 先查内存，再查 geocode_cache 表，都没有才调用 Gemini；启动时用 items 里历史的
+# (location_geohash, location_text) 预热，只取 location_source = 'geocode' 的行（卖家手填的地址不算）。格子大小由 GEOHASH_PRECISION 控制（7 位约 150 米）。
+GEOHASH_PRECISION = int(os.getenv("GEOHASH_PRECISION", "7"))
+GEOHASH_STORE_PRECISION = 12   # items 里存完整精度，以后调整格子大小也能重新预热
+_GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+geocode_memory = TTLCache(20000, 7 * 24 * 3600)
+geocode_totals = {"lookups": 0, "memory_hits": 0, "table_hits": 0, "misses": 0,
+                  "gemini_ms_total": 0.0, "seeded": 0}
+_geocode_lock = threading.Lock()
+
+
+def geohash_encode(lat, lon, precision=GEOHASH_PRECISION):
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lon_range, lon) if even else (lat_range, lat)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(_GEOHASH_BASE32[bits])
+            bits, bit_count = 0, 0
+    return "".join(chars)
+
+
+def seed_geocode_cache(page_size=1000):
+    """把 geocode_cache 表和历史商品里带坐标的地址读进内存，每个格子取最常见的写法"""
+    seeded = 0
+    start = 0
+    while True:
+        res = supabase.table("geocode_cache").select("cell, address").range(start, start + page_size - 1).execute()
+        for row in res.data or []:
+            geocode_memory.set(row['cell'], row['address'])
+            seeded += 1
+        if not res.data or len(res.data) < page_size:
+            break
+        start += page_size
+
+    votes = {}
+    start = 0
+    while True:
+        res = (supabase.table("items").select("location_geohash, location_text")
+               .not_.is_("location_geohash", "null").eq("location_source", "geocode")
+               .range(start, start + page_size - 1).execute())
+        for row in res.data or []:
+            if row.get('location_text'):
+                cell = row['location_geohash'][:GEOHASH_PRECISION]
+                counter = votes.setdefault(cell, collections.Counter())
+                counter[row['location_text']] += 1
+        if not res.data or len(res.data) < page_size:
+            break
+        start += page_size
+
+    fresh = []
+    for cell, counter in votes.items():
+        if geocode_memory.get(cell) is None:
+            address = counter.most_common(1)[0][0]
+            geocode_memory.set(cell, address)
+            fresh.append({"cell": cell, "address": address})
+    if fresh:
+        supabase.table("geocode_cache").upsert(fresh).execute()
+    with _geocode_lock:
+        geocode_totals["seeded"] = seeded + len(fresh)
+    print(f"逆地理编码缓存已预热：{seeded + len(fresh)} 个格子")
+
+
 def gemini_reverse_geocoding(lat, lon):
+    cell = geohash_encode(lat, lon)
+    with _geocode_lock:
+        geocode_totals["lookups"] += 1
+
+    address = geocode_memory.get(cell)
+    if address:
+        with _geocode_lock:
+            geocode_totals["memory_hits"] += 1
+        return address
+
+    try:
+        res = supabase.table("geocode_cache").select("address").eq("cell", cell).limit(1).execute()
+        if res.data:
+            address = res.data[0]['address']
+            geocode_memory.set(cell, address)
+            # hits 在库里原子 +1，后台去做，命中只花一次查询
+            touch_cache_async("touch_geocode_cache", {"p_cell": cell})
+            with _geocode_lock:
+                geocode_totals["table_hits"] += 1
+            return address
+    except Exception as e:
+        print(f"地址缓存查询失败: {e}")
+
+    with _geocode_lock:
+        geocode_totals["misses"] += 1
+    t = time.perf_counter()
+    try:
+        address = _ask_gemini_address(lat, lon)
+    except Exception as e:
+        print(f"Gemini 地址转换失败: {e}")
+        return f"坐标 ({lat:.3f}, {lon:.3f})"
+    with _geocode_lock:
+        geocode_totals["gemini_ms_total"] += (time.perf_counter() - t) * 1000
+
+    geocode_memory.set(cell, address)
+    try:
+        supabase.table("geocode_cache").upsert({"cell": cell, "address": address}).execute()
+    except Exception as e:
+        print(f"地址缓存写入失败: {e}")
+    return address
+
+
+def geocode_stats():
+    with _geocode_lock:
+        stats = dict(geocode_totals)
+    hits = stats["memory_hits"] + stats["table_hits"]
+    avg_gemini_ms = stats["gemini_ms_total"] / stats["misses"] if stats["misses"] else 0.0
+    stats["hit_ratio"] = round(hits / stats["lookups"], 4) if stats["lookups"] else 0.0
+    stats["avg_gemini_ms"] = round(avg_gemini_ms, 1)
+    # 每次命中按一次 Gemini 调用的平均耗时折算
+    stats["saved_ms"] = round(hits * avg_gemini_ms, 1)
+    stats["precision"] = GEOHASH_PRECISION
+    return stats
+
+STATS_PROVIDERS["geocode"] = geocode_stats
+
+
+def _ask_gemini_address(lat, lon):
     prompt = f"""
     你是一个地理信息专家。我给你一个坐标：纬度 {lat}, 经度 {lon}。
     请根据这个坐标，告诉该位置所在的：国家、城市、区域（或街道/著名地标）。
@@ -982,13 +3364,9 @@ def gemini_reverse_geocoding(lat, lon):
     2. 只输出具体地址，不要有任何多余的解释。
     例如：美国纽约曼哈顿第五大道。
     """
-    try:
-        # 使用你代码里已有的 model 对象
-        response = model.generate_content(prompt)
-        return response.text.strip()
-    except Exception as e:
-        print(f"Gemini 地址转换失败: {e}")
-        return f"坐标 ({lat:.3f}, {lon:.3f})"
+    # 使用你代码里已有的 model 对象（经统一封装限流/重试）
+    response = gemini_generate("geocode", prompt)
+    return response.text.strip()
 
 # 0.4.3.2 处理收到的地理位置数据
 def handle_location_input_old(message, item_id, original_msg_id):
@@ -1003,7 +3381,7 @@ def handle_location_input_old(message, item_id, original_msg_id):
         readable_address = gemini_reverse_geocoding(lat, lon)
         
         # 更新到数据库
-        supabase.table("items").update({"location_text": readable_address}).eq("id", item_id).execute()
+        supabase.table("items").update({"location_text": readable_address, "location_source": "geocode"}).eq("id", item_id).execute()
         
         bot.reply_to(
             message, 
@@ -1013,22 +3391,26 @@ def handle_location_input_old(message, item_id, original_msg_id):
     else:
         # 处理文字输入
         loc_text = message.text.strip()
-        supabase.table("items").update({"location_text": loc_text}).eq("id", item_id).execute()
+        supabase.table("items").update({"location_text": loc_text, "location_source": "manual"}).eq("id", item_id).execute()
         bot.reply_to(message, f"✅ 位置已更新为：{loc_text}", reply_markup=types.ReplyKeyboardRemove())
 
 def handle_location_input(message, item_id, original_msg_id):
     readable_address = ""
+    location_fields = {}
     
     # 情况 A：用户通过按钮发送了地理位置坐标
     if message.location:
         lat = message.location.latitude
         lon = message.location.longitude
         bot.send_chat_action(message.chat.id, 'find_location')
-        # 调用您已有的 Gemini 逆地理编码函数
+        # 调用逆地理编码（同一 geohash 格子命中缓存就不再问 Gemini）
         readable_address = gemini_reverse_geocoding(lat, lon)
+        location_fields["location_geohash"] = geohash_encode(lat, lon, GEOHASH_STORE_PRECISION)
+        location_fields["location_source"] = "geocode"
     # 情况 B：用户直接回复了文字地点
     else:
         readable_address = message.text.strip()
+        location_fields["location_source"] = "manual"
 
     if not readable_address:
         bot.reply_to(message, "⚠️ 未能识别位置，请重新输入。")
@@ -1036,10 +3418,10 @@ def handle_location_input(message, item_id, original_msg_id):
 
     try:
         # 1. 更新数据库中的位置字段
-        supabase.table("items").update({"location_text": readable_address}).eq("id", item_id).execute()
+        item = update_item(item_id, {"location_text": readable_address, **location_fields})
         
-        # 2. 获取包含最新位置、价格、描述的完整文案
-        new_text = get_latest_preview_text(item_id)
+        # 2. 用返回的最新行（位置、价格、描述）合成完整文案
+        new_text = render_preview_text(item)
         
         # 3. 核心：编辑原来的预览消息
         bot.edit_message_text(
@@ -1081,13 +3463,13 @@ def handle_sign_in(message):
     if last_date == today:
         bot.reply_to(message, f"👋 宝子，你今天已经领过能量啦！\n明天再来吧～ 保持好心情！✨")
     else:
-        # 3. 更新积分和日期
-        new_credits = profile['credits'] + 5
+        # 3. 更新积分和日期（同一次 RPC 里判断“今天没签过”，并发点两次也只加一次）
         try:
-            supabase.table("profiles").update({
-                "credits": new_credits,
-                "last_sign_date": today
-            }).eq("telegram_id", user_id).execute()
+            row = ledger_apply(user_id, credits=5, reason="daily_sign", sign_date=today)
+            if not row:
+                bot.reply_to(message, f"👋 宝子，你今天已经领过能量啦！\n明天再来吧～ 保持好心情！✨")
+                return
+            new_credits = row['credits']
             
             bot.reply_to(message, f"🎉 签到成功！\n获得：+5 ⚡\n当前余额：{new_credits} ⚡\n明天也要记得来哦！")
         except Exception as e:
@@ -1115,6 +3497,7 @@ def handle_subscribe(message):
         "telegram_id": message.from_user.id,
         "keyword": keyword
     }).execute()
+    sub_matcher.add(keyword, message.from_user.id)
     
     bot.reply_to(message, f"✅ 订阅成功！一旦有邻居发布【{keyword}】，我会立刻通知你。")
 
@@ -1149,6 +3532,7 @@ def handle_unsubscribe(message):
         
         # 判断是否真的删除了数据（res.data 包含被删除的行）
         if res.data and len(res.data) > 0:
+            sub_matcher.remove(keyword, message.from_user.id, count=len(res.data))
             bot.reply_to(message, f"✅ 已成功取消对【{keyword}】的捡漏订阅。")
         else:
             bot.reply_to(message, f"❓ 未找到关于【{keyword}】的订阅，请检查拼写是否一致。")
@@ -1190,7 +3574,200 @@ def handle_view_item(message):
     markup = gen_draft_markup(item_id) 
     bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode="Markdown")
 
-def process_photo_task(message):
+# 识图结果缓存
+# 卖家撤回草稿或解析失败后经常把同一张图再发一次。以 file_unique_id、压缩后 JPEG 的哈希
+# 再加上附言作为键，把解析好的标题/价格/描述存进 vision_cache 表，命中就直接生成草稿，
+# 不再调用 Gemini，也不扣能量。
+VISION_CACHE_MAX_ROWS = int(os.getenv("VISION_CACHE_MAX_ROWS", "20000"))
+VISION_CACHE_TRIM_EVERY = 50
+vision_cache_totals = {"lookups": 0, "hits": 0, "hits_by_file_id": 0, "hits_by_hash": 0, "stores": 0, "trims": 0}
+_vision_cache_lock = threading.Lock()
+
+
+def vision_cache_key(kind, ident, caption):
+    caption_hash = hashlib.sha1((caption or "").strip().encode("utf-8")).hexdigest()[:16]
+    return f"{kind}:{ident}:{caption_hash}"
+
+
+def vision_cache_lookup(cache_key):
+    try:
+        res = supabase.table("vision_cache").select("*").eq("cache_key", cache_key).limit(1).execute()
+    except Exception as e:
+        print(f"识图缓存查询失败: {e}")
+        return None
+    kind = cache_key.split(":", 1)[0]
+    with _vision_cache_lock:
+        vision_cache_totals["lookups"] += 1
+        if res.data:
+            vision_cache_totals["hits"] += 1
+            vision_cache_totals["hits_by_file_id" if kind == "fu" else "hits_by_hash"] += 1
+    if not res.data:
+        return None
+    # hits 在库里原子 +1，不用读出来再写回（并发命中会丢计数）
+    touch_cache_async("touch_vision_cache", {"p_key": cache_key})
+    return res.data[0]
+
+
+def vision_cache_store(cache_keys, title, price, description, image_url, image_urls=None):
+    rows = [{
+        "cache_key": key,
+        "title": title,
+        "price": price,
+        "description": description,
+        "image_url": image_url,
+        "image_urls": image_urls or [image_url],
+        "last_hit_at": datetime.now(timezone.utc).isoformat(),
+    } for key in cache_keys]
+    try:
+        supabase.table("vision_cache").upsert(rows).execute()
+    except Exception as e:
+        print(f"识图缓存写入失败: {e}")
+        return
+    with _vision_cache_lock:
+        vision_cache_totals["stores"] += 1
+        need_trim = vision_cache_totals["stores"] % VISION_CACHE_TRIM_EVERY == 0
+    if need_trim:
+        threading.Thread(target=trim_vision_cache, daemon=True).start()
+
+
+def trim_vision_cache():
+    try:
+        res = supabase.rpc("trim_vision_cache", {"p_max_rows": VISION_CACHE_MAX_ROWS}).execute()
+        with _vision_cache_lock:
+            vision_cache_totals["trims"] += 1
+        print(f"识图缓存清理完成，删除 {res.data} 行")
+    except Exception as e:
+        print(f"识图缓存清理失败: {e}")
+
+
+def vision_cache_stats():
+    with _vision_cache_lock:
+        stats = dict(vision_cache_totals)
+    stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+    return stats
+
+STATS_PROVIDERS["vision_cache"] = vision_cache_stats
+
+
+def parse_marketing_text(full_text):
+    """拆出 AI 文案里的 DATA:名称|价格，返回 (名称, 价格, 展示文案)；格式不对会抛异常"""
+    # 我们使用 splitlines 处理，过滤掉包含特定关键词的行
+    clean_lines = [
+        line for line in full_text.splitlines()
+        if "【文案部分】" not in line and "【数据部分】" not in line
+    ]
+    # 重新组合成纯净的文案
+    display_text1 = "\n".join(clean_lines).strip()
+
+    item_title = "未知商品" # 默认值
+    price_val = "0"        # 默认值
+    for line in display_text1.split('\n'):
+        if line.startswith("DATA:"):
+            data_part = line.replace("DATA:", "").strip()
+            item_title, price_val = data_part.split('|')
+            break
+    display_text = display_text1.split("DATA:")[0].strip()
+    return item_title.strip(), float(price_val), display_text
+
+
+# 流式预览
+# 开始生成时先回一条占位消息，文案一块块到达时按节流间隔编辑它（同时占用广播共用的全局令牌桶，
+# 不会和通知推送一起把 Telegram 的限额挤爆），生成结束、草稿入库后再把它换成带按钮的正式预览。
+GEMINI_STREAMING = os.getenv("GEMINI_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+
+class StreamingPreview:
+    def __init__(self, message, placeholder="🤖 AI 正在为宝贝写文案，请稍等…"):
+        self.source = message
+        self.message = bot.reply_to(message, placeholder)
+        self.last_edit = time.monotonic()
+        self.last_text = ""
+        self.blocked_until = 0.0
+
+    def update(self, full_text):
+        # 只展示文案部分；DATA 行要等生成结束统一解析
+        shown = "\n".join(line for line in full_text.split("DATA:")[0].splitlines()
+                          if "【文案部分】" not in line and "【数据部分】" not in line).strip()
+        now = time.monotonic()
+        if not shown or shown == self.last_text:
+            return
+        if now - self.last_edit < STREAM_EDIT_INTERVAL or now < self.blocked_until:
+            return
+        if tg_global_bucket.try_acquire() > 0:
+            return
+        self.last_edit = now
+        try:
+            # 半截文案里的 Markdown 标记可能不成对，过程中一律按纯文本显示
+            bot.edit_message_text(shown[:4000] + " ▌", self.message.chat.id, self.message.message_id)
+            self.last_text = shown
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = ((e.result_json or {}).get('parameters') or {}).get('retry_after', 5)
+                self.blocked_until = now + retry_after
+        except Exception as e:
+            print(f"流式预览编辑失败: {e}")
+
+    def finish(self, text, reply_markup=None):
+        try:
+            bot.edit_message_text(text, self.message.chat.id, self.message.message_id,
+                                  parse_mode="Markdown", reply_markup=reply_markup)
+        except Exception as e:
+            print(f"流式预览收尾失败，改为新发一条: {e}")
+            self.discard()
+            bot.reply_to(self.source, text, reply_markup=reply_markup, parse_mode="Markdown")
+
+    def discard(self):
+        try:
+            bot.delete_message(self.message.chat.id, self.message.message_id)
+        except Exception:
+            pass
+
+
+def create_draft_and_reply(message, item_title, price, description, image_url, headline="🤖 **AI 预览生成成功！**", preview=None,
+                           image_urls=None):
+    # 插入数据库，状态设为 draft
+    res = supabase.table("items").insert({
+        "name": item_title,
+        "price": float(price),
+        "description": description,
+        "username": message.from_user.username,
+        "status": "draft", # 关键：初始为草稿
+        "telegram_id": message.from_user.id,
+        "image_url": image_url, # 🌟 存入图片直连（封面）
+        "image_urls": image_urls or [image_url] # 相册的全部图片
+    }).execute()
+    
+    item_id = res.data[0]['id'] # 获取这条记录的 ID
+
+    # 净化文案后带上 V1.2 交互按钮回复
+    safe_text = escape_markdown(description)
+    text = f"{headline}\n\n{safe_text}\n\n当前状态：⏳ 草稿（未上架）"
+    if preview:
+        # 流式生成时直接把占位消息换成正式预览
+        preview.finish(text, gen_draft_markup(item_id))
+    else:
+        bot.reply_to(message, text, reply_markup=gen_draft_markup(item_id), parse_mode="Markdown")
+    return item_id
+
+
+def profile_is_vip(profile):
+    """会员有效期未过就算 VIP"""
+    if not profile or not profile.get('subscription_expiry'):
+        return False
+    # 解析数据库存的时间字符串
+    try:
+        expiry_date = datetime.fromisoformat(str(profile['subscription_expiry']).replace('Z', '+00:00'))
+        if expiry_date.tzinfo is None:
+            expiry_date = expiry_date.replace(tzinfo=timezone.utc)
+        return expiry_date > datetime.now(timezone.utc)
+    except Exception as e:
+        print(f"日期解析出错: {e}")
+        return False
+
+
+def process_photo_task(message, album=None):
+    # album：同一 media_group_id 的全部消息（按顺序），单张图时为 None；message 是带附言的那一条
     # 1. 定义一个卖货专家的系统指令
     MARKETING_PROMPT = """
     你是一个精通小红书流量密码的海外二手交易专家。
@@ -1234,154 +3811,582 @@ def process_photo_task(message):
             return
         # --- 识图流程优化 ---
         print(f"收到照片分析请求，附言: {caption}")
+        # 草稿要写进 items，而 items.telegram_id 有指向 profiles 的外键：缓存命中直接出草稿之前，
+        # 新用户的资料必须已经建好
+        profile = get_or_create_profile(message.from_user)
         
-        # 获取最高画质的照片
-        photo_file_id = message.photo[-1].file_id
+        # 挑宽度刚好够 1280 的那一档，不必下载最大原图
+        photos = [select_photo_size(m.photo) for m in (album or [message])]
+        cache_headline = "🤖 **AI 预览生成成功！**（之前识别过这张图，本次不消耗能量）"
+
+        # 同一张图（相册则是同一组图）+ 同样的附言之前识别过：连下载都省了，直接出草稿
+        file_key = vision_cache_key("fu", ",".join(p.file_unique_id for p in photos), caption)
+        cached = vision_cache_lookup(file_key)
+        if cached:
+            print("命中识图缓存 (file_unique_id)，跳过 Gemini。")
+            create_draft_and_reply(message, cached['title'], cached['price'], cached['description'], cached['image_url'],
+                                   headline=cache_headline, image_urls=cached.get('image_urls'))
+            return
         
-        print("正在压缩并上传图片...")
+        print(f"正在压缩并上传图片（{len(photos)} 张）...")
         # 2. 【执行前置】先压缩并上传，同时拿回压缩后的二进制数据供 AI 使用
         bot.send_chat_action(message.chat.id, 'upload_photo')
-        image_url, compressed_data = upload_to_supabase(photo_file_id)
+        uploads = upload_photos([p.file_id for p in photos])
         
-        if not image_url or not compressed_data:
+        if not all(url and data for url, data in uploads):
             bot.reply_to(message, "❌ 图片处理失败，请稍后再试。")
             return
+        image_urls = [url for url, _ in uploads]
+        image_url = image_urls[0]
+
+        # 换了 file_id 但内容一模一样（压缩后哈希相同）也算命中
+        content_hash = ",".join(hashlib.sha256(data).hexdigest() for _, data in uploads)
+        if len(uploads) > 1:
+            content_hash = hashlib.sha256(content_hash.encode()).hexdigest()
+        hash_key = vision_cache_key("sha", content_hash, caption)
+        cached = vision_cache_lookup(hash_key)
+        if cached:
+            print("命中识图缓存 (内容哈希)，跳过 Gemini。")
+            vision_cache_store([file_key], cached['title'], cached['price'], cached['description'], cached['image_url'],
+                               cached.get('image_urls'))
+            create_draft_and_reply(message, cached['title'], cached['price'], cached['description'], cached['image_url'],
+                                   headline=cache_headline, image_urls=cached.get('image_urls'))
+            return
         
-        # 构造符合 Gemini SDK 要求的图片部分
-        #image_parts = [
-        #    {
-        #        "mime_type": "image/jpeg",
-        #        "data": downloaded_file
-        #    }
-        #]
-        
-        # 组合指令
-        prompt_parts = [
-            MARKETING_PROMPT, 
-            {"mime_type": "image/jpeg", "data": compressed_data},
-            f"用户补充信息（极其重要，若与图片冲突以此为准）: {caption}" 
-        ]           
+        # 组合指令：相册的多张图放进同一个 prompt，只识别一次
+        prompt_parts = [MARKETING_PROMPT]
+        prompt_parts += [{"mime_type": "image/jpeg", "data": data} for _, data in uploads]
+        if len(uploads) > 1:
+            prompt_parts.append(f"以上 {len(uploads)} 张图片是同一件商品的不同角度，请综合所有图片只写一份文案。")
+        prompt_parts.append(f"用户补充信息（极其重要，若与图片冲突以此为准）: {caption}")
         # --- 新增：积分检查 ---
-        profile = get_or_create_profile(message.from_user)
         # 1. 检查会员是否有效
-        is_vip = False
-        if profile.get('subscription_expiry'):
-            from datetime import datetime, timezone
-            # 解析数据库存的时间字符串
-            try:
-                expiry_date = datetime.fromisoformat(profile['subscription_expiry'].replace('Z', '+00:00'))
-                if expiry_date > datetime.now(timezone.utc):
-                    is_vip = True
-            except Exception as e:
-                print(f"日期解析出错: {e}")
+        is_vip = profile_is_vip(profile)
 
         # 2. 判定逻辑
         if is_vip:
             print(f"用户 {message.from_user.id} 是会员，免扣费识图。")
             bot.send_chat_action(message.chat.id, 'typing') # 给个反馈提示
-        elif profile['credits'] < 10:
-            bot.reply_to(message, f"❌ 能量不足！\n当前余额：{profile['credits']} ⚡\n识图需消耗 10 ⚡，请回复“充值”发送截图或等待明日签到。")
+        elif ledger_available(message.from_user.id) < 10:
+            bot.reply_to(message, f"❌ 能量不足！\n当前余额：{ledger_available(message.from_user.id)} ⚡\n识图需消耗 10 ⚡，请回复“充值”发送截图或等待明日签到。")
             return 
         
         print(f"用户 {message.from_user.id} 余额充足，准备识图...")
 
-        # 获取 AI 生成的高质量文案
-        response = model.generate_content(prompt_parts)
-        full_text = response.text
-
-        # 我们使用 splitlines 处理，过滤掉包含特定关键词的行
-        lines = full_text.splitlines()
-        clean_lines = [
-            line for line in lines 
-            if "【文案部分】" not in line and "【数据部分】" not in line
-        ]
-
-        # 重新组合成纯净的文案
-        display_text1 = "\n".join(clean_lines).strip()
+        # 获取 AI 生成的高质量文案：流式模式下边生成边刷新占位消息
+        preview = None
+        if GEMINI_STREAMING:
+            preview = StreamingPreview(message)
+            try:
+                full_text = gemini_stream_text("vision", prompt_parts, preview.update)
+            except Exception:
+                preview.discard()
+                raise
+        else:
+            response = gemini_generate("vision", prompt_parts)
+            full_text = response.text
 
-        # --- 核心提取逻辑 ---
-        item_title = "未知商品" # 默认值
-        price_val = "0"        # 默认值
+        # 生成一结束先解析 DATA 行：格式不对就不扣费，把占位消息改成错误提示，别让用户白等
+        try:
+            item_title, price_val, display_text = parse_marketing_text(full_text)
+        except Exception as e:
+            print(f"解析数据失败: {e}")
+            parse_failed = "❌ 文案格式解析失败，本次未扣能量，请重发图片～"
+            if preview:
+                preview.finish(parse_failed)
+            else:
+                bot.reply_to(message, parse_failed)
+            return
         
         # --- 识图成功后：正式扣除 10 积分 ---
         # --- 识图成功后：扣费判定 ---
         if not is_vip:
-            new_balance = profile['credits'] - 10
-            supabase.table("profiles").update({"credits": new_balance}).eq("telegram_id", message.from_user.id).execute()
+            row = ledger_apply(message.from_user.id, credits=-10, reason="vision")
+            if not row:
+                # 并发的其他识图任务先把余额扣光了
+                if preview:
+                    preview.discard()
+                bot.reply_to(message, "❌ 能量不足！识图需消耗 10 ⚡，请回复“充值”发送截图或等待明日签到。")
+                return
+            new_balance = row['credits']
             print(f"非会员积分已扣除，剩余：{new_balance}")
         else:
             print("会员用户，跳过扣费步骤。")
         # ---------------------
 
         try:
-            # 1. 提取 AI 数据（逻辑同前）
-            for line in display_text1.split('\n'):
-                if line.startswith("DATA:"):
-                    data_part = line.replace("DATA:", "").strip()
-                    item_title, price_val = data_part.split('|')
-                    break
-            display_text = display_text1.split("DATA:")[0].strip()
-
-            # 2. 插入数据库，状态设为 draft
-            res = supabase.table("items").insert({
-                "name": item_title,
-                "price": float(price_val),
-                "description": display_text,
-                "username": message.from_user.username,
-                "status": "draft", # 关键：初始为草稿
-                "telegram_id": message.from_user.id,
-                "image_url": image_url # 🌟 存入图片直连
-            }).execute()
-            
-            item_id = res.data[0]['id'] # 获取这条记录的 ID
-
-            # 3. 创建 V1.2 交互按钮
-            markup = types.InlineKeyboardMarkup(row_width=2)
-            btn_confirm = types.InlineKeyboardButton("✅ 确认发布", callback_data=f"conf_{item_id}")
-            btn_edit_price = types.InlineKeyboardButton("💰 改价格", callback_data=f"editp_{item_id}")
-            btn_edit_desc = types.InlineKeyboardButton("📝 改描述", callback_data=f"editd_{item_id}") # 🌟 新增
-            btn_location = types.InlineKeyboardButton("📍 加位置", callback_data=f"loc_{item_id}")
-            btn_cancel = types.InlineKeyboardButton("❌ 撤回", callback_data=f"del_{item_id}")
-            # 建议排列方式：确认按钮独占一行，其他两两一排
-            markup.add(btn_confirm)
-            markup.add(btn_edit_price, btn_edit_desc)
-            markup.add(btn_location, btn_cancel)
-
-            # 1. 净化文案
-            raw_text = display_text # Gemini 生成的原始文案
-            safe_text = escape_markdown(raw_text)
-            
-            bot.reply_to(message, f"🤖 **AI 预览生成成功！**\n\n{safe_text}\n\n当前状态：⏳ 草稿（未上架）", reply_markup=markup, parse_mode="Markdown")
-            
-        except Exception as e:
-            print(f"解析数据失败: {e}")
-            display_text = display_text1.split("DATA:")[0].strip()
+            # 1. 记进识图缓存，下次同图同附言直接复用
+            vision_cache_store([file_key, hash_key], item_title, price_val, display_text, image_url, image_urls)
+
+            # 2. 插入草稿并回复带按钮的预览
+            create_draft_and_reply(message, item_title, price_val, display_text, image_url, preview=preview,
+                                   image_urls=image_urls)
+        except Exception:
+            # 入库失败交给外层统一回复，先把停在半截的流式占位消息收掉
+            if preview:
+                preview.discard()
+            raise
 
         
         print("照片分析完成并回复。")
+    except GeminiUnavailable as e:
+        print(f"Gemini 不可用: {e}")
+        bot.reply_to(message, "宝子，AI 这会儿太忙了，本次没有扣能量，请过几分钟再试～")
     except Exception as e:
         print(f"Error: {e}")
         bot.reply_to(message, "宝子，AI 大脑卡壳了，请稍后再试～")
 
+# 识图任务调度
+# 固定数量的工作线程 + 有界优先队列：会员的图先处理，同一用户最多同时跑 PHOTO_PER_USER_CAP 张，
+# 多出来的先挂起，等他自己的任务做完再放回队列；队列满了直接回复用户稍后再发，不再无限开线程。
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", "6"))
+PHOTO_QUEUE_SIZE = int(os.getenv("PHOTO_QUEUE_SIZE", "100"))
+PHOTO_PER_USER_CAP = int(os.getenv("PHOTO_PER_USER_CAP", "2"))
+PHOTO_PRIORITY_VIP = 0
+PHOTO_PRIORITY_NORMAL = 1
+
+
+class PhotoJobScheduler:
+    def __init__(self, workers, max_queued, per_user_cap):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.per_user_cap = per_user_cap
+        self.cond = threading.Condition()
+        self.heap = []                                   # (优先级, 序号, 用户, 入队时间, 任务)
+        self.parked = collections.defaultdict(collections.deque)  # 用户 -> 超出并发上限、暂时挂起的任务
+        self.running = collections.Counter()             # 用户 -> 正在跑的任务数
+        self.queued = 0                                  # heap + parked 里的任务总数
+        self.seq = itertools.count()
+        self.started = False
+        self.totals = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "vip": 0}
+        self.wait_ms = collections.deque(maxlen=500)
+        self.service_ms = collections.deque(maxlen=500)
+        self.max_depth = 0
+
+    def _ensure_workers(self):
+        if self.started:
+            return
+        with self.cond:
+            if self.started:
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self._worker_loop, daemon=True, name=f"photo-worker-{i}").start()
+            self.started = True
+
+    def submit(self, user_id, fn, args=(), priority=PHOTO_PRIORITY_NORMAL):
+        """入队成功返回 True；队列已满返回 False，由调用方提示用户"""
+        self._ensure_workers()
+        with self.cond:
+            if self.queued >= self.max_queued:
+                self.totals["rejected"] += 1
+                return False
+            entry = (priority, next(self.seq), user_id, time.monotonic(), (fn, args))
+            self.queued += 1
+            self.totals["submitted"] += 1
+            if priority == PHOTO_PRIORITY_VIP:
+                self.totals["vip"] += 1
+            if self.running[user_id] >= self.per_user_cap:
+                self.parked[user_id].append(entry)
+            else:
+                heapq.heappush(self.heap, entry)
+                self.cond.notify()
+            self.max_depth = max(self.max_depth, self.queued)
+            return True
+
+    def _next_job(self):
+        with self.cond:
+            while True:
+                while self.heap:
+                    entry = heapq.heappop(self.heap)
+                    user_id = entry[2]
+                    if self.running[user_id] >= self.per_user_cap:
+                        self.parked[user_id].append(entry)
+                        continue
+                    self.queued -= 1
+                    self.running[user_id] += 1
+                    return entry
+                self.cond.wait()
+
+    def _release(self, user_id):
+        with self.cond:
+            self.running[user_id] -= 1
+            if self.running[user_id] <= 0:
+                del self.running[user_id]
+            parked = self.parked.get(user_id)
+            if parked:
+                heapq.heappush(self.heap, parked.popleft())
+                if not parked:
+                    del self.parked[user_id]
+                self.cond.notify()
+
+    def _worker_loop(self):
+        while True:
+            _, _, user_id, enqueued_at, (fn, args) = self._next_job()
+            started = time.monotonic()
+            ok = True
+            try:
+                fn(*args)
+            except Exception as e:
+                ok = False
+                print(f"识图任务异常: {e}")
+            finally:
+                finished = time.monotonic()
+                with self.cond:
+                    self.wait_ms.append((started - enqueued_at) * 1000)
+                    self.service_ms.append((finished - started) * 1000)
+                    self.totals["completed" if ok else "failed"] += 1
+                self._release(user_id)
+
+    def depth(self):
+        with self.cond:
+            return self.queued
+
+    def stats(self):
+        def summary(samples):
+            if not samples:
+                return {"count": 0, "avg_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+            ordered = sorted(samples)
+            return {"count": len(ordered), "avg_ms": round(sum(ordered) / len(ordered), 1),
+                    "p95_ms": round(ordered[int(0.95 * (len(ordered) - 1))], 1),
+                    "max_ms": round(ordered[-1], 1)}
+        with self.cond:
+            return {"queue_depth": self.queued, "max_depth": self.max_depth,
+                    "parked_users": len(self.parked), "running": sum(self.running.values()),
+                    "workers": self.workers, "totals": dict(self.totals),
+                    "wait": summary(self.wait_ms), "service": summary(self.service_ms)}
+
+
+photo_scheduler = PhotoJobScheduler(PHOTO_WORKERS, PHOTO_QUEUE_SIZE, PHOTO_PER_USER_CAP)
+STATS_PROVIDERS["photo_jobs"] = photo_scheduler.stats
+metrics.gauge("hualin_photo_tasks_in_flight", "正在执行的识图任务数",
+              lambda: sum(photo_scheduler.running.values()))
+metrics.gauge("hualin_photo_tasks_queued", "排队（含因单用户并发上限挂起）的识图任务数", photo_scheduler.depth)
+
+
+def dispatch_photo_job(message, album=None):
+    # 交给识图调度器，实现“秒派发”；会员插队
+    user_id = message.from_user.id
+    priority = PHOTO_PRIORITY_VIP if profile_is_vip(get_profile(user_id)) else PHOTO_PRIORITY_NORMAL
+    job = traced_handoff(process_photo_task, "photo_job")
+    if not photo_scheduler.submit(user_id, job, (message, album), priority):
+        getattr(job, "cancel", lambda: None)()
+        bot.reply_to(message, "🚦 现在识图的人太多啦，请过一两分钟再发这张图～")
+        print(f"⚠️ 识图队列已满，拒绝任务 (Message ID: {message.message_id})")
+        return
+    print(f"🚀 图片任务已派发 (Message ID: {message.message_id}, {len(album or [message])} 张, 排队 {photo_scheduler.depth()})")
+
+
+# 相册合并
+# 同一相册（media_group_id 相同）的照片是一条条分开到达的。先攒 ALBUM_WINDOW 秒，
+# 期间每来一张就把计时重新开始，攒齐后作为一个任务识别：一次 Gemini、一次扣费、一条草稿。
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.5"))
+_album_buffers = {}          # media_group_id -> {"messages": [...], "timer": Timer}
+_album_lock = threading.Lock()
+album_totals = {"albums": 0, "photos": 0}
+
+
+def buffer_album_photo(message):
+    group_id = message.media_group_id
+    with _album_lock:
+        buf = _album_buffers.setdefault(group_id, {"messages": [], "timer": None})
+        buf["messages"].append(message)
+        if buf["timer"]:
+            buf["timer"].cancel()
+        buf["timer"] = threading.Timer(ALBUM_WINDOW, _flush_album, (group_id,))
+        buf["timer"].daemon = True
+        buf["timer"].start()
+
+
+def _flush_album(group_id):
+    with _album_lock:
+        buf = _album_buffers.pop(group_id, None)
+        if not buf:
+            return
+        album_totals["albums"] += 1
+        album_totals["photos"] += len(buf["messages"])
+    messages = sorted(buf["messages"], key=lambda m: m.message_id)
+    # 相册的附言只挂在其中一条消息上
+    primary = next((m for m in messages if m.caption), messages[0])
+    # 计时器线程里没有原来那几条更新的 trace，相册单独起一个
+    with trace_span("album", root=True, media_group_id=group_id, photos=len(messages)):
+        dispatch_photo_job(primary, messages if len(messages) > 1 else None)
+
+
+def album_stats():
+    with _album_lock:
+        return {"buffering": len(_album_buffers), "window_s": ALBUM_WINDOW, **album_totals}
+
+STATS_PROVIDERS["albums"] = album_stats
+
+
 # 0.4.3.6 处理用户智能分析
 @bot.message_handler(func=lambda m: True, content_types=['text', 'photo'])
 def handle_message(message):
     if message.content_type == 'photo':
-        # 启动后台线程处理图片，实现“秒派发”
-        threading.Thread(target=process_photo_task, args=(message,)).start()
-        print(f"🚀 图片任务已派发 (Message ID: {message.message_id})")
+        if message.media_group_id:
+            buffer_album_photo(message)
+            return
+        dispatch_photo_job(message)
 
 
 # print("🚀 华邻助手正式启动 (Gemini 2.5 Flash)...")
 # bot.infinity_polling()
 
+# Webhook 模式
+# BOT_MODE=webhook 时不再长轮询，由现有的 Flask 应用接收 Telegram 推送。更新按 chat_id 分片，
+# 每个分片一个单线程队列：同一个聊天的消息严格按顺序处理（register_next_step_handler 的多步对话依赖这一点），
+# 不同用户之间并行，一个卡在 Gemini 上的会话不会拖住其他人。
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # 对外的 https 根地址，例如 https://xxx.hf.space
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")   # webhook 模式必填，Telegram 每次推送都带在请求头里
+WEBHOOK_SHARDS = int(os.getenv("WEBHOOK_SHARDS", "8"))
+WEBHOOK_SHARD_QUEUE = int(os.getenv("WEBHOOK_SHARD_QUEUE", "200"))
+
+
+def update_chat_id(update):
+    """取出一条更新所属的聊天，用来决定分片；拿不到的归到 0 号分片"""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        cq = update.callback_query
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    for attr in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query"):
+        obj = getattr(update, attr, None)
+        if obj is not None:
+            return obj.from_user.id
+    return 0
+
+
+class ShardedDispatcher:
+    def __init__(self, shards, queue_size):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(shards)]
+        self.lock = threading.Lock()
+        self.totals = {"received": 0, "processed": 0, "failed": 0, "rejected": 0}
+        self.started = False
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        for i, q in enumerate(self.queues):
+            threading.Thread(target=self._shard_loop, args=(q,), daemon=True, name=f"update-shard-{i}").start()
+
+    def submit(self, update):
+        """入队成功返回 True；分片队列满了返回 False，让 Telegram 稍后重发"""
+        q = self.queues[update_chat_id(update) % len(self.queues)]
+        try:
+            q.put_nowait(update)
+        except queue.Full:
+            with self.lock:
+                self.totals["rejected"] += 1
+            return False
+        with self.lock:
+            self.totals["received"] += 1
+        return True
+
+    def _shard_loop(self, q):
+        while True:
+            update = q.get()
+            ok = True
+            try:
+                bot.process_new_updates([update])
+            except Exception as e:
+                ok = False
+                print(f"处理更新 {update.update_id} 失败: {e}")
+            with self.lock:
+                self.totals["processed" if ok else "failed"] += 1
+
+    def stats(self):
+        depths = [q.qsize() for q in self.queues]
+        with self.lock:
+            return {"mode": BOT_MODE, "shards": len(self.queues), "depths": depths,
+                    "max_depth": max(depths) if depths else 0, "totals": dict(self.totals)}
+
+
+update_dispatcher = ShardedDispatcher(WEBHOOK_SHARDS, WEBHOOK_SHARD_QUEUE)
+STATS_PROVIDERS["updates"] = update_dispatcher.stats
+
+
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    if BOT_MODE != "webhook":
+        return "webhook disabled", 404
+    # 这个端口是公开的，没有密钥就谁都能伪造更新（包括按钮回调），所以密钥为空时一律拒绝
+    token = flask_request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not WEBHOOK_SECRET or not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+        return "forbidden", 403
+    update = types.Update.de_json(flask_request.get_data(as_text=True))
+    if not update:
+        return "", 200
+    if not update_dispatcher.submit(update):
+        # 返回非 2xx，Telegram 会过一会儿重发这条更新
+        return "busy", 503
+    # 被拒的那次不录，Telegram 重发成功时再录，避免回放时出现重复更新
+    update_recorder.record(update)
+    return "", 200
+
+
+def start_webhook():
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("webhook 模式必须设置 WEBHOOK_SECRET，否则任何人都能向公开端口伪造更新")
+    # 分片线程里直接执行处理函数，不再转交 telebot 自带的线程池，否则同一聊天的顺序就保证不了
+    bot.threaded = False
+    update_dispatcher.start()
+    bot.remove_webhook()
+    bot.set_webhook(url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                    max_connections=40)
+    print(f"Webhook 已设置：{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}（{WEBHOOK_SHARDS} 个分片）")
+
+
+# 录制真实流量
+# RECORD_FILE 不为空时，把收到的每条更新脱敏后连同到达时间追加写入 JSONL（按大小滚动），
+# 供 replay.py 按 1x/10x/100x 回放压测。脱敏规则：
+#   - 所有整数 id（User、Chat，不管挂在 from/chat/new_chat_members 还是别处）和 user_id 换成带盐哈希，
+#     同一次录制内保持一致，多步对话还能串起来
+#   - callback_data（含消息里 reply_markup 的按钮）里的纯数字段也按同样规则哈希：refill_ok_<用户ID>_... 这类按钮带着真实 ID
+#   - 名字统一换成 user（first_name 是必填字段），手机号等联系方式去掉
+#   - 正文、附言、inline 查询、地点名称/地址只保留开头的命令，其余字符一律换成 x
+#   - file_id 换成哈希，坐标只保留两位小数
+RECORD_FILE = os.getenv("RECORD_FILE", "")
+RECORD_MAX_BYTES = int(os.getenv("RECORD_MAX_BYTES", str(50 * 1024 * 1024)))
+RECORD_BACKUPS = int(os.getenv("RECORD_BACKUPS", "5"))
+# 不设置就每次启动随机生成，不同录制之间的 ID 对不上
+RECORD_SALT = os.getenv("RECORD_SALT", "") or uuid.uuid4().hex
+
+RECORD_ID_FIELDS = ("id", "user_id", "chat_id")
+RECORD_TEXT_FIELDS = ("text", "caption", "query", "title", "address", "url", "description")
+RECORD_DROP_FIELDS = ("last_name", "phone_number", "vcard", "bio", "email", "foursquare_id", "google_place_id")
+_record_command = re.compile(r"^/[A-Za-z0-9_]+(@\w+)?")
+
+
+def _pseudonym(value):
+    digest = hashlib.sha256(f"{RECORD_SALT}:{value}".encode()).hexdigest()
+    n = int(digest[:12], 16) % 10 ** 12 + 1
+    return -n if isinstance(value, int) and value < 0 else n
+
+
+def _scrub_text(text):
+    m = _record_command.match(text)
+    head = m.group(0) if m else ""
+    return head + re.sub(r"\w", "x", text[len(head):])
+
+
+def _scrub_callback_data(data):
+    # 和用户 ID 用同一个哈希，refill_ok_<ID> 里的 ID 和 from.id 还能对上
+    return "_".join(str(_pseudonym(int(part))) if part.isdigit() else part for part in data.split("_"))
+
+
+def anonymize_update_part(obj):
+    if isinstance(obj, list):
+        return [anonymize_update_part(v) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for key, value in obj.items():
+        if key in RECORD_DROP_FIELDS:
+            continue
+        if key in RECORD_ID_FIELDS and isinstance(value, int) and not isinstance(value, bool):
+            out[key] = _pseudonym(value)
+        elif key == "first_name":
+            out[key] = "user"
+        elif key == "username" and value:
+            out[key] = f"u{_pseudonym(value)}"
+        elif key in ("data", "callback_data") and isinstance(value, str):
+            out[key] = _scrub_callback_data(value)
+        elif key in RECORD_TEXT_FIELDS and isinstance(value, str):
+            out[key] = _scrub_text(value)
+        elif key in ("file_id", "file_unique_id") and isinstance(value, str):
+            out[key] = hashlib.sha256(f"{RECORD_SALT}:{value}".encode()).hexdigest()[:32]
+        elif key in ("latitude", "longitude") and isinstance(value, (int, float)):
+            out[key] = round(value, 2)
+        else:
+            out[key] = anonymize_update_part(value)
+    return out
+
+
+class UpdateRecorder:
+    def __init__(self, path, max_bytes, backups):
+        self.path, self.max_bytes, self.backups = path, max_bytes, backups
+        self.logger = None
+        self.lock = threading.Lock()
+        self.totals = {"recorded": 0, "failed": 0}
+
+    def _get_logger(self):
+        if self.logger is None:
+            handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes,
+                                                           backupCount=self.backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger("hualin.recording")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(handler)
+            self.logger = logger
+        return self.logger
+
+    def record(self, update):
+        if not self.path:
+            return
+        try:
+            # Update 本身不保留原始 JSON，各部分（Message、CallbackQuery……）有 .json
+            raw = {"update_id": update.update_id}
+            for kind in ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result"):
+                part = getattr(update, kind, None)
+                if part is not None and getattr(part, "json", None) is not None:
+                    raw[kind] = anonymize_update_part(part.json)
+            line = json.dumps({"t": round(time.time(), 3), "update": raw}, ensure_ascii=False)
+            with self.lock:
+                self._get_logger().info(line)
+                self.totals["recorded"] += 1
+        except Exception as e:
+            with self.lock:
+                self.totals["failed"] += 1
+            print(f"录制更新失败: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"enabled": bool(self.path), "file": self.path or None, **self.totals}
+
+
+update_recorder = UpdateRecorder(RECORD_FILE, RECORD_MAX_BYTES, RECORD_BACKUPS)
+STATS_PROVIDERS["recording"] = update_recorder.stats
+_bot_traced_process_new_updates = bot.process_new_updates
+
+
+def _recorded_process_new_updates(updates):
+    # Webhook 模式在收到推送时就录了（记的是到达时间，而不是排完分片队列之后的时间）
+    if BOT_MODE != "webhook":
+        for update in updates:
+            update_recorder.record(update)
+    return _bot_traced_process_new_updates(updates)
+
+
+bot.process_new_updates = _recorded_process_new_updates
+
+
 # --- 在启动 Bot 前开启 Flask 线程 ---
 # 修改启动部分
 if __name__ == "__main__":
-    threading.Thread(target=run_flask, daemon=True).start()
-    
-    print("Bot 正在尝试连接 Telegram 服务器...")
+    # 平台停容器时发 SIGTERM：转成正常退出，atexit 里的收尾（结算预扣等）才会执行
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # 先 fork 好图片处理进程，再启动其他线程
+    warm_image_pool()
+    if BOT_MODE != "webhook":
+        threading.Thread(target=run_flask, daemon=True).start()
+    # 预热订阅匹配引擎和逆地理编码缓存，避免第一次用到时才去读表
+    threading.Thread(target=ensure_subscriptions_loaded, daemon=True).start()
+    threading.Thread(target=seed_geocode_cache, daemon=True).start()
+    threading.Thread(target=load_item_index, daemon=True).start()
     
-    # 使用更加鲁棒的启动方式
-    # timeout 设置长一点，并且开启 non_stop 重试
-    bot.infinity_polling(timeout=60, long_polling_timeout=60)
+    if BOT_MODE == "webhook":
+        # Webhook 模式：Flask 在主线程里接收 Telegram 推送
+        start_webhook()
+        run_flask()
+    else:
+        print("Bot 正在尝试连接 Telegram 服务器...")
+        
+        # 使用更加鲁棒的启动方式
+        # timeout 设置长一点，并且开启 non_stop 重试
+        bot.infinity_polling(timeout=60, long_polling_timeout=60)
@@ -0,0 +1,394 @@
+# 华邻易市 · 真实流量回放
+# 读取 hualin0.3.py 录制模式（RECORD_FILE）写出的脱敏更新，按原始时间间隔的 1x/10x/100x
+# 喂回 bot 的处理链路。Telegram、Supabase、Gemini 全部用 bench.py 的本地替身，不消耗真实配额。
+# 输出每个处理函数的执行耗时和排队等待，以及各队列（telebot 线程池、webhook 分片、识图调度器、
+# 广播队列）的积压峰值，用来看流量涨上去以后先卡在哪。
+#
+# 用法：
+#   python replay.py updates.jsonl                        # 默认 1x
+#   python replay.py updates.jsonl --speeds 1,10,100      # 每个倍速单独起一个进程，最后汇总
+#   python replay.py updates.jsonl --speeds 10 --mode webhook --max-gap 5 --limit 2000
+import argparse
+import bisect
+import collections
+import functools
+import glob
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import bench
+from bench import FakeEnvironment, PLACES, VOCAB, add_fake_arguments, percentile, peak_rss_mb
+
+# callback_data 第二段是商品 ID 的按钮；录下来的 ID 在替身库里不存在，换成库里的商品
+ITEM_ACTIONS = ("view", "conf", "editp", "editd", "loc", "del", "sold")
+_view_command = re.compile(r"^/view_\d+")
+
+
+def load_recording(path):
+    # 和 trace_report.py 一样：滚动出来的 .1 最新、.N 最旧，先读旧的
+    rotated = [p for p in glob.glob(path + ".*") if p.rsplit(".", 1)[-1].isdigit()]
+    files = sorted(rotated, key=lambda p: int(p.rsplit(".", 1)[-1]), reverse=True)
+    if os.path.exists(path):
+        files.append(path)
+    records = []
+    for name in files:
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"跳过无法解析的行: {name}", file=sys.stderr)
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+def schedule(records, speed, max_gap):
+    """把录制时间换成相对回放开始的偏移（秒）；超过 max_gap 的空闲（比如夜里）先压缩再按倍速缩放"""
+    offsets = []
+    elapsed, last = 0.0, None
+    for r in records:
+        if last is not None:
+            gap = r["t"] - last
+            elapsed += min(gap, max_gap) if max_gap else gap
+        last = r["t"]
+        offsets.append(elapsed / speed)
+    return offsets
+
+
+def update_kind(raw):
+    return next((k for k in ("message", "edited_message", "callback_query", "inline_query")
+                 if k in raw), "other")
+
+
+def recorded_user_ids(records):
+    ids = set()
+    for r in records:
+        part = r["update"].get(update_kind(r["update"])) or {}
+        uid = (part.get("from") or {}).get("id")
+        if isinstance(uid, int) and uid > 0:
+            ids.add(uid)
+    return sorted(ids)
+
+
+class UpdateBuilder:
+    """把脱敏后的更新还原成可处理的样子：被换成 x 的正文用词表补上，商品 ID 指向替身库里的商品"""
+
+    def __init__(self, item_ids, seed):
+        self.item_ids = item_ids
+        self.rng = random.Random(seed)
+
+    def _fill(self, text):
+        return re.sub(r"x+", lambda m: self.rng.choice(VOCAB + PLACES), text)
+
+    def _fix_message(self, msg):
+        for key in ("text", "caption"):
+            if isinstance(msg.get(key), str):
+                text = self._fill(msg[key])
+                if _view_command.match(text):
+                    text = _view_command.sub(f"/view_{self.rng.choice(self.item_ids)}", text, count=1)
+                msg[key] = text
+
+    def build(self, raw):
+        from telebot import types
+        raw = json.loads(json.dumps(raw))
+        for key in ("message", "edited_message"):
+            if key in raw:
+                self._fix_message(raw[key])
+        cq = raw.get("callback_query")
+        if cq and isinstance(cq.get("data"), str):
+            parts = cq["data"].split("_")
+            if parts[0] in ITEM_ACTIONS and len(parts) > 1 and parts[1].isdigit():
+                parts[1] = str(self.rng.choice(self.item_ids))
+                cq["data"] = "_".join(parts)
+        return types.Update.de_json(raw)
+
+
+class HandlerStats:
+    """按处理函数统计执行耗时，以及从（按计划）到达到开始执行之间的等待"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.exec_ms = collections.defaultdict(list)
+        self.wait_ms = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.in_flight = 0
+
+    def wrap(self, fn, name=None):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            obj = args[0] if args else None
+            key = name or getattr(fn, "__name__", repr(fn))
+            if getattr(obj, "data", None) and hasattr(obj, "chat_instance"):
+                # 所有按钮都进 callback_inline，按 action 拆开看
+                key = f"{key}:{obj.data.split('_')[0]}"
+            arrived = getattr(obj, "_replay_at", None)
+            started = time.perf_counter()
+            with self.lock:
+                self.in_flight += 1
+            ok = True
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                ok = False
+                raise
+            finally:
+                finished = time.perf_counter()
+                with self.lock:
+                    self.in_flight -= 1
+                    self.exec_ms[key].append((finished - started) * 1000)
+                    if arrived is not None:
+                        self.wait_ms[key].append((started - arrived) * 1000)
+                    if not ok:
+                        self.errors[key] += 1
+        return timed
+
+    def report(self):
+        out = {}
+        with self.lock:
+            for key, values in self.exec_ms.items():
+                values = sorted(values)
+                waits = sorted(self.wait_ms.get(key, []))
+                out[key] = {"count": len(values), "errors": self.errors[key],
+                            "p50_ms": round(percentile(values, 0.50), 1), "p95_ms": round(percentile(values, 0.95), 1),
+                            "p99_ms": round(percentile(values, 0.99), 1),
+                            "wait_p95_ms": round(percentile(waits, 0.95), 1),
+                            "wait_max_ms": round(waits[-1], 1) if waits else 0.0}
+        return out
+
+
+def instrument(app, stats):
+    bot = app.bot
+    for attr, handlers in list(vars(bot).items()):
+        if attr.endswith("_handlers") and isinstance(handlers, list):
+            for handler in handlers:
+                if isinstance(handler, dict) and callable(handler.get("function")):
+                    handler["function"] = stats.wrap(handler["function"])
+    # 识图任务在调度器里异步跑，单独统计；dispatch_photo_job 每次按模块全局名取它
+    app.process_photo_task = stats.wrap(app.process_photo_task, "photo_task")
+
+    register = bot.register_next_step_handler
+
+    def register_timed(message, callback, *args, **kwargs):
+        return register(message, stats.wrap(callback, f"next_step:{getattr(callback, '__name__', repr(callback))}"), *args, **kwargs)
+    bot.register_next_step_handler = register_timed
+
+
+class QueueSampler(threading.Thread):
+    def __init__(self, app, stats, interval=0.2):
+        super().__init__(daemon=True, name="replay-sampler")
+        self.app, self.stats, self.interval = app, stats, interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.t0 = time.perf_counter()
+
+    def depths(self):
+        app = self.app
+        pool = getattr(app.bot, "worker_pool", None)
+        return {
+            "telebot_pool": pool.tasks.qsize() if pool is not None and app.bot.threaded else 0,
+            "webhook_shards": sum(app.update_dispatcher.stats()["depths"]),
+            "photo_jobs": app.photo_scheduler.depth(),
+            "notify_events": app.notify_queue.qsize(),
+            "notify_sends": len(app._send_heap),
+            "in_flight": self.stats.in_flight,
+        }
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.samples.append((time.perf_counter() - self.t0, self.depths()))
+
+    def idle(self):
+        return not any(self.depths().values())
+
+    def report(self, buckets=10):
+        if not self.samples:
+            return {"max": {}, "timeline": []}
+        names = list(self.samples[0][1])
+        peak = {n: max(s[1][n] for s in self.samples) for n in names}
+        # 时间线：把整段回放切成 buckets 段，每段取各队列的最大值
+        end = self.samples[-1][0]
+        times = [s[0] for s in self.samples]
+        timeline = []
+        for i in range(buckets):
+            lo = bisect.bisect_left(times, end * i / buckets)
+            hi = max(lo + 1, bisect.bisect_left(times, end * (i + 1) / buckets))
+            chunk = self.samples[lo:hi]
+            if chunk:
+                timeline.append({"t": round(chunk[0][0], 1), **{n: max(s[1][n] for s in chunk) for n in names}})
+        return {"max": peak, "timeline": timeline}
+
+
+def replay_once(args, records):
+    env = FakeEnvironment(args)
+    # 回放时别把回放的流量又录一遍
+    os.environ["RECORD_FILE"] = ""
+    try:
+        app = env.start()
+        user_ids = sorted(set(recorded_user_ids(records)) | set(bench.bench_user_ids(args.users)))
+        env.seed(user_ids, args.items, args.subscriptions)
+        item_ids = [r["id"] for r in env.supabase.tables["items"] if r.get("status") == "active"]
+        builder = UpdateBuilder(item_ids, args.seed)
+        updates = [builder.build(r["update"]) for r in records]
+        offsets = schedule(records, args.speed, args.max_gap)
+
+        stats = HandlerStats()
+        instrument(app, stats)
+        if args.mode == "webhook":
+            app.bot.threaded = False
+            app.update_dispatcher.start()
+        sampler = QueueSampler(app, stats)
+        sampler.start()
+
+        rejected = 0
+        lag_ms = []
+        started = time.perf_counter()
+        for update, offset in zip(updates, offsets):
+            due = started + offset
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.perf_counter()
+            lag_ms.append((now - due) * 1000)
+            for kind in ("message", "edited_message", "callback_query"):
+                part = getattr(update, kind, None)
+                if part is not None:
+                    part._replay_at = due
+            if args.mode == "webhook":
+                if not app.update_dispatcher.submit(update):
+                    rejected += 1
+            else:
+                app.bot.process_new_updates([update])
+        fed = time.perf_counter() - started
+
+        # 等所有队列排空、没有在执行的处理函数（连续两次采样都空才算）
+        deadline = time.perf_counter() + args.drain_timeout
+        quiet = 0
+        while time.perf_counter() < deadline and quiet < 2:
+            quiet = quiet + 1 if sampler.idle() else 0
+            time.sleep(0.25)
+        drained = quiet >= 2
+        total = time.perf_counter() - started
+        sampler.stopped.set()
+        sampler.join()
+
+        lag_ms.sort()
+        return {
+            "speed": args.speed, "mode": args.mode, "updates": len(updates), "rejected": rejected,
+            "offered_per_s": round(len(updates) / offsets[-1], 2) if offsets and offsets[-1] else None,
+            "feed_seconds": round(fed, 2), "total_seconds": round(total, 2), "drained": drained,
+            "drain_seconds": round(total - fed, 2),
+            "feeder_lag_p95_ms": round(percentile(lag_ms, 0.95), 1),
+            "handlers": stats.report(), "queues": sampler.report(),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+    finally:
+        env.stop()
+
+
+def print_result(r):
+    offered = f"{r['offered_per_s']}/s" if r["offered_per_s"] else "-"
+    print(f"\n=== {r['speed']}x（{r['mode']}）：{r['updates']} 条更新，平均 {offered}，"
+          f"投递 {r['feed_seconds']}s，排空 {r['drain_seconds']}s{'' if r['drained'] else '（超时未排空）'}，"
+          f"拒收 {r['rejected']}，峰值 RSS {r['peak_rss_mb']} MB ===")
+    print(f"{'处理函数':<32}{'次数':>6}{'错误':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'等待p95':>10}{'等待max':>10}")
+    for name, h in sorted(r["handlers"].items(), key=lambda kv: -kv[1]["count"]):
+        print(f"{name:<32}{h['count']:>6}{h['errors']:>6}{h['p50_ms']:>9.0f}{h['p95_ms']:>9.0f}{h['p99_ms']:>9.0f}"
+              f"{h['wait_p95_ms']:>10.0f}{h['wait_max_ms']:>10.0f}")
+    queues = r["queues"]
+    if queues["timeline"]:
+        names = list(queues["max"])
+        print("\n队列积压（每段取最大值）：")
+        print(f"{'t(s)':>7}" + "".join(f"{n:>16}" for n in names))
+        for row in queues["timeline"]:
+            print(f"{row['t']:>7.1f}" + "".join(f"{row[n]:>16}" for n in names))
+        print(f"{'峰值':>6}" + "".join(f"{queues['max'][n]:>16}" for n in names))
+
+
+def print_summary(results):
+    print("\n=== 各倍速对比 ===")
+    names = sorted({n for r in results for n in r["queues"]["max"]})
+    print(f"{'倍速':>6}{'更新/s':>10}{'最慢p95':>10}{'等待p95':>10}{'排空s':>8}" + "".join(f"{n:>16}" for n in names))
+    for r in results:
+        handlers = r["handlers"].values()
+        worst = max((h["p95_ms"] for h in handlers), default=0)
+        wait = max((h["wait_p95_ms"] for h in handlers), default=0)
+        print(f"{r['speed']:>5}x{r['offered_per_s'] or 0:>10}{worst:>10.0f}{wait:>10.0f}{r['drain_seconds']:>8}"
+              + "".join(f"{r['queues']['max'].get(n, 0):>16}" for n in names))
+
+
+def strip_option(argv, names):
+    out, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        if arg in names:
+            skip = True
+            continue
+        if any(arg.startswith(n + "=") for n in names):
+            continue
+        out.append(arg)
+    return out
+
+
+def main():
+    p = argparse.ArgumentParser(description="按倍速回放录制的真实更新（本地替身）")
+    p.add_argument("recording", help="录制文件（RECORD_FILE），会一并读取滚动出来的 .1 .2 ...")
+    p.add_argument("--speeds", default="1", help="逗号分隔的倍速，例如 1,10,100")
+    p.add_argument("--mode", choices=("polling", "webhook"), default="polling",
+                   help="polling：走 telebot 线程池；webhook：走按聊天分片的队列")
+    p.add_argument("--limit", type=int, help="只回放前 N 条")
+    p.add_argument("--max-gap", type=float, default=0, help="录制里超过这么多秒的空闲先压缩到这个值（0 为不压缩）")
+    p.add_argument("--drain-timeout", type=float, default=300, help="投递完后最多等多久让队列排空")
+    p.add_argument("--out", help="把结果写到这个 JSON 文件")
+    add_fake_arguments(p)
+    args = p.parse_args()
+
+    speeds = [float(s) for s in args.speeds.split(",") if s.strip()]
+    if len(speeds) > 1:
+        # 每个倍速一个干净的进程，缓存、会话、线程池互不影响
+        results = []
+        base_argv = strip_option(sys.argv[1:], ("--speeds", "--out"))
+        for speed in speeds:
+            with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+                out_path = tmp.name
+            code = subprocess.call([sys.executable, os.path.abspath(__file__), *base_argv,
+                                    "--speeds", f"{speed:g}", "--out", out_path])
+            if code != 0:
+                print(f"{speed:g}x 回放失败，退出码 {code}", file=sys.stderr)
+                continue
+            with open(out_path, encoding="utf-8") as f:
+                results.append(json.load(f))
+            os.unlink(out_path)
+        print_summary(results)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        return
+
+    records = load_recording(args.recording)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("录制文件里没有更新。")
+        return
+    args.speed = speeds[0]
+    result = replay_once(args, records)
+    print_result(result)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+-- 华邻易市 · 数据库增量脚本
+-- 在 Supabase 控制台的 SQL Editor 里整段执行即可，重复执行是安全的。
+
+-- ============================================================
+-- 能量 / 信用分账本
+-- 所有 credits、trust_score 的变动都走 apply_ledger：一次调用里完成
+-- “条件扣减 + 写流水”，避免 Python 端先读后写导致的并发丢更新。
+-- ============================================================
+create table if not exists credit_ledger (
+    id            bigserial primary key,
+    telegram_id   bigint      not null,
+    credits_delta integer     not null default 0,
+    trust_delta   real        not null default 0,
+    credits_after integer,
+    trust_after   real,
+    reason        text,
+    created_at    timestamptz not null default now()
+);
+create index if not exists credit_ledger_user_idx on credit_ledger (telegram_id, created_at desc);
+
+-- p_min_balance：扣减后余额不能低于这个值，否则不扣、返回空
+-- p_sign_date：签到专用，只有今天还没签过才生效，并顺手写入 last_sign_date
+create or replace function apply_ledger(
+    p_user_id     bigint,
+    p_credits     integer default 0,
+    p_trust       real    default 0,
+    p_reason      text    default null,
+    p_min_balance integer default 0,
+    p_sign_date   date    default null
+) returns setof profiles
+language plpgsql as $$
+declare
+    r profiles;
+begin
+    update profiles
+       set credits        = coalesce(credits, 0) + p_credits,
+           trust_score    = coalesce(trust_score, 0) + p_trust,
+           last_sign_date = coalesce(p_sign_date, last_sign_date)
+     where telegram_id = p_user_id
+       and (p_credits >= 0 or coalesce(credits, 0) + p_credits >= p_min_balance)
+       and (p_sign_date is null or last_sign_date is distinct from p_sign_date)
+    returning * into r;
+
+    if not found then
+        return;
+    end if;
+
+    insert into credit_ledger (telegram_id, credits_delta, trust_delta, credits_after, trust_after, reason)
+    values (p_user_id, p_credits, p_trust, r.credits, r.trust_score, p_reason);
+
+    return next r;
+end;
+$$;
+
+-- 批量结算：p_entries 形如 [{"user_id": 1, "credits": -3, "reason": "search x3"}, ...]
+-- 余额不足的条目会被跳过，只返回实际结算成功的用户资料
+create or replace function apply_ledger_batch(p_entries jsonb)
+returns setof profiles
+language plpgsql as $$
+declare
+    e jsonb;
+begin
+    for e in select * from jsonb_array_elements(p_entries) loop
+        return query select * from apply_ledger(
+            (e->>'user_id')::bigint,
+            coalesce((e->>'credits')::integer, 0),
+            coalesce((e->>'trust')::real, 0),
+            e->>'reason'
+        );
+    end loop;
+end;
+$$;
+
+-- ============================================================
+-- 识图结果缓存
+-- 同一张图（file_unique_id 或压缩后 JPEG 的哈希）+ 同样的附言，直接复用上次的识别结果。
+-- 按 last_hit_at 做 LRU，超出上限的行由 trim_vision_cache 清掉。
+-- ============================================================
+create table if not exists vision_cache (
+    cache_key   text primary key,
+    title       text,
+    price       numeric,
+    description text,
+    image_url   text,
+    hits        integer     not null default 0,
+    created_at  timestamptz not null default now(),
+    last_hit_at timestamptz not null default now()
+);
+create index if not exists vision_cache_last_hit_idx on vision_cache (last_hit_at);
+
+create or replace function trim_vision_cache(p_max_rows integer)
+returns integer
+language sql as $$
+    with doomed as (
+        delete from vision_cache
+         where cache_key in (
+            select cache_key from vision_cache
+             order by last_hit_at desc
+            offset p_max_rows
+         )
+        returning 1
+    )
+    select count(*)::integer from doomed;
+$$;
+
+-- 命中时续期：hits 原子 +1，并发命中不会丢计数
+create or replace function touch_vision_cache(p_key text)
+returns void
+language sql as $$
+    update vision_cache set hits = hits + 1, last_hit_at = now() where cache_key = p_key;
+$$;
+
+-- ============================================================
+-- 逆地理编码缓存
+-- 卖家集中在几个街区，按 geohash 格子缓存 Gemini 给出的地址描述。
+-- items.location_geohash 记录卖家发送位置时的完整 geohash，用来给缓存预热。
+-- items.location_source 标记 location_text 的来源：'geocode' 是逆地理编码得到的，'manual' 是卖家手填的；
+-- 预热只用 'geocode' 的行，免得卖家后来改写的地址被当成整个格子的地址。
+-- ============================================================
+alter table items add column if not exists location_geohash text;
+alter table items add column if not exists location_source text;
+
+create table if not exists geocode_cache (
+    cell        text primary key,
+    address     text        not null,
+    hits        integer     not null default 0,
+    created_at  timestamptz not null default now(),
+    last_hit_at timestamptz not null default now()
+);
+
+-- 命中时续期：hits 原子 +1，并发命中不会丢计数
+create or replace function touch_geocode_cache(p_cell text)
+returns void
+language sql as $$
+    update geocode_cache set hits = hits + 1, last_hit_at = now() where cell = p_cell;
+$$;
+
+-- ============================================================
+-- 搜索结果键集分页
+-- /search 翻页按 (created_at, id) 倒序取下一页，这个索引让每一页都是一次索引区间扫描。
+-- ============================================================
+create index if not exists items_active_keyset_idx on items (status, created_at desc, id desc);
+
+-- ============================================================
+-- 我的发布看板
+-- 一次调用返回：信用分、各状态数量、当前一页（只含 id/name/price/status/created_at）。
+-- 多取一行给 Python 端判断还有没有下一页；p_backward 为真时取游标之前（更新）的一页。
+-- ============================================================
+create index if not exists items_owner_keyset_idx on items (telegram_id, created_at desc, id desc);
+
+create or replace function my_items_dashboard(
+    p_user_id   bigint,
+    p_cursor_ts timestamptz default null,
+    p_cursor_id bigint      default null,
+    p_backward  boolean     default false,
+    p_limit     integer     default 10
+) returns jsonb
+language sql stable as $$
+    select jsonb_build_object(
+        'trust_score', (select trust_score from profiles where telegram_id = p_user_id),
+        'counts', coalesce((
+            select jsonb_object_agg(status, n)
+              from (select status, count(*) as n from items
+                     where telegram_id = p_user_id group by status) c
+        ), '{}'::jsonb),
+        'items', coalesce((
+            select jsonb_agg(page order by page.created_at desc, page.id desc)
+              from (
+                select id, name, price, status, created_at
+                  from items
+                 where telegram_id = p_user_id
+                   and (p_cursor_ts is null
+                        or (not p_backward and (created_at, id) < (p_cursor_ts, p_cursor_id))
+                        or (p_backward and (created_at, id) > (p_cursor_ts, p_cursor_id)))
+                 order by case when p_backward then created_at end asc,
+                          case when p_backward then id end asc,
+                          created_at desc, id desc
+                 limit p_limit + 1
+              ) page
+        ), '[]'::jsonb)
+    );
+$$;
+
+-- ============================================================
+-- 商品 -> 卖家外键
+-- 让 PostgREST 能用 select=*,seller:profiles(trust_score) 一次取回商品和卖家信用分。
+-- 历史数据里可能有找不到资料的卖家，所以先 not valid，不校验旧行。
+-- ============================================================
+create unique index if not exists profiles_telegram_id_key on profiles (telegram_id);
+
+do $$
+begin
+    if not exists (select 1 from pg_constraint where conname = 'items_seller_fkey') then
+        alter table items
+            add constraint items_seller_fkey foreign key (telegram_id)
+            references profiles (telegram_id) not valid;
+    end if;
+end;
+$$;
+
+-- ============================================================
+-- 相册发布
+-- 同一相册的多张图合并成一条草稿：image_url 仍是封面，image_urls 存全部图片（按相册顺序）。
+-- ============================================================
+alter table items add column if not exists image_urls text[];
+alter table vision_cache add column if not exists image_urls text[];
@@ -0,0 +1,103 @@
+# 华邻易市 · trace 分析小工具
+# 读取 hualin0.3.py 写出的 traces.jsonl（含滚动出来的 .1 .2 ...），列出最慢的几条 trace，
+# 并沿“最晚结束的子 span”往下走，打印每条 trace 的关键路径。
+#
+# 用法：
+#   python trace_report.py                      # 默认读 traces.jsonl，列最慢的 10 条
+#   python trace_report.py -n 5 --root update.message
+#   python trace_report.py --file /data/traces.jsonl --min-ms 5000
+import argparse
+import glob
+import json
+import os
+import sys
+
+
+def load_traces(path):
+    # 滚动出来的 .1 最新、.N 最旧：先读旧的，最后读当前文件
+    rotated = [p for p in glob.glob(path + ".*") if p.rsplit(".", 1)[-1].isdigit()]
+    files = sorted(rotated, key=lambda p: int(p.rsplit(".", 1)[-1]), reverse=True)
+    if os.path.exists(path):
+        files.append(path)
+    traces = []
+    for name in files:
+        with open(name, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    traces.append(json.loads(line))
+                except ValueError:
+                    print(f"跳过无法解析的行: {name}", file=sys.stderr)
+    return traces
+
+
+def span_end(span):
+    return span["start"] + span["duration_ms"] / 1000
+
+
+def critical_path(trace):
+    """从根开始，每层挑最晚结束的子 span，返回 [(span, 自身耗时 ms), ...]"""
+    spans = trace["spans"]
+    children = {}
+    for sp in spans:
+        children.setdefault(sp["parent_id"], []).append(sp)
+    roots = children.get(None) or spans[:1]
+    node = max(roots, key=span_end)
+    path = []
+    while node is not None:
+        kids = children.get(node["span_id"], [])
+        busy_ms = 0.0
+        covered_until = node["start"]
+        for kid in sorted(kids, key=lambda k: k["start"]):
+            # 子 span 可能互相重叠（并行上传），按时间轴并集算，避免重复扣
+            kid_start = max(kid["start"], covered_until)
+            kid_end = span_end(kid)
+            if kid_end > kid_start:
+                busy_ms += (kid_end - kid_start) * 1000
+                covered_until = kid_end
+        path.append((node, max(0.0, node["duration_ms"] - busy_ms)))
+        node = max(kids, key=span_end) if kids else None
+    return path
+
+
+def describe(span):
+    attrs = span.get("attrs") or {}
+    keys = ("site", "table", "op", "method", "task", "status", "attempt")
+    detail = " ".join(f"{k}={attrs[k]}" for k in keys if k in attrs)
+    if span.get("error"):
+        detail += f" ❌ {span['error']}"
+    return f"{span['name']} {detail}".strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="列出最慢的 trace 及其关键路径")
+    parser.add_argument("--file", default=os.getenv("TRACE_FILE", "traces.jsonl"), help="trace 文件路径")
+    parser.add_argument("-n", type=int, default=10, help="显示多少条（默认 10）")
+    parser.add_argument("--root", help="只看根 span 名字以此开头的 trace，例如 update.message")
+    parser.add_argument("--min-ms", type=float, default=0, help="只看总耗时不低于这个值的 trace")
+    args = parser.parse_args()
+
+    traces = load_traces(args.file)
+    if args.root:
+        traces = [t for t in traces if t["root"].startswith(args.root)]
+    traces = [t for t in traces if t["duration_ms"] >= args.min_ms]
+    if not traces:
+        print("没有符合条件的 trace。")
+        return
+
+    traces.sort(key=lambda t: t["duration_ms"], reverse=True)
+    print(f"共 {len(traces)} 条 trace，最慢的 {min(args.n, len(traces))} 条：\n")
+    for trace in traces[:args.n]:
+        print(f"■ {trace['duration_ms']:.0f} ms  {trace['root']}  trace={trace['trace_id']}  spans={len(trace['spans'])}")
+        t0 = trace["start"]
+        for depth, (span, self_ms) in enumerate(critical_path(trace)):
+            offset_ms = (span["start"] - t0) * 1000
+            print(f"    {'  ' * depth}+{offset_ms:7.0f} ms  {span['duration_ms']:8.0f} ms"
+                  f"  (自身 {self_ms:6.0f} ms)  {describe(span)}")
+        print()
+
+
+if __name__ == "__main__":
+    main()